@@ -0,0 +1,226 @@
+import asyncio
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, AsyncIterable, AsyncIterator, BinaryIO, Dict, Optional
+
+# ==================== CONFIGURACIÓN ====================
+
+TTS_CACHE_ENABLED = os.getenv("TTS_CACHE_ENABLED", "1") != "0"
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", ".cache/tts")
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Las copias que se están sirviendo viven aquí; pasado este tiempo se consideran
+# huérfanas (worker caído a mitad de una respuesta) y se borran
+_SERVING_DIR = "serving"
+_SERVING_MAX_AGE_SECONDS = 3600
+
+# ==================== CACHÉ DE AUDIO ====================
+
+class AudioCache:
+    """
+    Audios generados guardados en disco, un archivo por clave de contenido.
+
+    El índice (tamaño y último acceso) vive en SQLite dentro de la misma carpeta,
+    así que lo comparten los workers de uvicorn del host. Al superar `max_bytes`
+    se borran primero los audios usados hace más tiempo.
+
+    Un acierto no devuelve la ruta del audio en caché sino un enlace duro
+    privado al mismo archivo: si la expulsión borra el audio mientras se está
+    sirviendo, el enlace mantiene vivo el contenido hasta `release`.
+    """
+
+    def __init__(self, directory: str = TTS_CACHE_DIR, max_bytes: int = TTS_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.directory, "index.sqlite3"), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS clips (
+                    key TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS clips_accessed ON clips (accessed)")
+            self._local.conn = conn
+        return conn
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def _count(self, stat: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[stat] += amount
+
+    def lookup(self, key: str) -> Optional[str]:
+        """
+        Ruta de una copia privada del audio de `key` si está en caché (y lo marca
+        como usado). Quien la recibe debe llamar a `release` al terminar de servirla.
+        """
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM clips WHERE key = ?", (key,)).fetchone() is None:
+            self._count("misses")
+            return None
+        serving = self._checkout(key)
+        if serving is None:
+            # Borrado a mano o por otro worker: la entrada ya no sirve
+            conn.execute("DELETE FROM clips WHERE key = ?", (key,))
+            self._count("misses")
+            return None
+        conn.execute("UPDATE clips SET accessed = ? WHERE key = ?", (time.time(), key))
+        self._count("hits")
+        return serving
+
+    def _checkout(self, key: str) -> Optional[str]:
+        directory = os.path.join(self.directory, _SERVING_DIR)
+        os.makedirs(directory, exist_ok=True)
+        serving = os.path.join(directory, f"{key}-{uuid.uuid4().hex}.mp3")
+        try:
+            try:
+                os.link(self.path(key), serving)
+            except FileNotFoundError:
+                return None
+            except OSError:
+                # Sistema de archivos sin enlaces duros: copia completa
+                shutil.copyfile(self.path(key), serving)
+            # El enlace comparte inodo con el original: se fecha ahora para el barrido
+            os.utime(serving)
+        except FileNotFoundError:
+            return None
+        return serving
+
+    def stream(self, key: str, chunk_size: int = 64 * 1024) -> Optional[AsyncIterator[bytes]]:
+        """`lookup` + `read` en una sola llamada (para hacerla entera en un hilo); None si no está."""
+        serving = self.lookup(key)
+        return self.read(serving, chunk_size) if serving is not None else None
+
+    def release(self, serving: str) -> None:
+        """Borra la copia devuelta por `lookup` una vez servida."""
+        try:
+            os.unlink(serving)
+        except FileNotFoundError:
+            pass
+
+    def read(self, serving: str, chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+        """
+        Contenido de una copia devuelta por `lookup` por bloques, sin bloquear el
+        event loop. El archivo se abre aquí mismo y la copia se libera en el acto
+        (el descriptor sigue leyendo), así que no queda nada en `serving/` aunque
+        el stream se cancele antes de empezar.
+        """
+        try:
+            f = open(serving, "rb")
+        finally:
+            self.release(serving)
+        return self._iter_file(f, chunk_size)
+
+    @staticmethod
+    async def _iter_file(f: BinaryIO, chunk_size: int) -> AsyncIterator[bytes]:
+        with f:
+            while True:
+                chunk = await asyncio.to_thread(f.read, chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def tee(self, key: str, chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+        """
+        Reenvía `chunks` tal cual y a la vez los escribe en disco.
+
+        El audio solo entra en la caché si el stream termina completo y no vacío;
+        si falla o el cliente se desconecta, el parcial se borra.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        fd, partial = tempfile.mkstemp(prefix=f"{key}-", suffix=".partial", dir=self.directory)
+        size = 0
+        try:
+            # Bloques de pocos KB a un archivo local: se escriben sin salir del event loop
+            with os.fdopen(fd, "wb") as out:
+                async for chunk in chunks:
+                    out.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            if size == 0:
+                os.unlink(partial)
+                return
+            os.replace(partial, self.path(key))
+        except BaseException:
+            try:
+                os.unlink(partial)
+            except FileNotFoundError:
+                pass
+            raise
+        self._store(key, size)
+
+    def _store(self, key: str, size: int) -> None:
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO clips (key, size, created, accessed) VALUES (?, ?, ?, ?)",
+            (key, size, now, now)
+        )
+        self._count("stores")
+        self._evict(conn)
+        self._sweep_serving()
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM clips").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Dejamos margen (90%) para no recortar en cada escritura
+        target = int(self.max_bytes * 0.9)
+        doomed = []
+        for key, size in conn.execute("SELECT key, size FROM clips ORDER BY accessed ASC").fetchall():
+            if total <= target:
+                break
+            doomed.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM clips WHERE key = ?", doomed)
+        for (key,) in doomed:
+            try:
+                os.unlink(self.path(key))
+            except FileNotFoundError:
+                pass
+        self._count("evictions", len(doomed))
+
+    def _sweep_serving(self) -> None:
+        directory = os.path.join(self.directory, _SERVING_DIR)
+        cutoff = time.time() - _SERVING_MAX_AGE_SECONDS
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        entries, size = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM clips").fetchone()
+        stats["entries"] = entries
+        stats["bytes"] = size
+        stats["enabled"] = TTS_CACHE_ENABLED
+        return stats
+
+audio_cache = AudioCache()
@@ -0,0 +1,264 @@
+import json
+import math
+import os
+import random
+import re
+import wave
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+from PIL import Image
+
+from spool_service import FileData, data_size, iter_blocks, open_data
+
+# ==================== CONFIGURACIÓN ====================
+
+# Límite de entrada (tokens) de cada modelo
+MODEL_TOKEN_LIMITS = {
+    "gemini-2.5-flash": 1_048_576,
+    "gemini-2.5-pro": 1_048_576,
+    "gemini-1.5-flash": 1_048_576,
+    "gemini-1.5-pro": 2_097_152
+}
+
+# Presupuesto por modelo; se puede bajar con GEMINI_TOKEN_BUDGETS='{"gemini-2.5-pro": 200000}'
+TOKEN_BUDGETS: Dict[str, int] = {**MODEL_TOKEN_LIMITS, **json.loads(os.getenv("GEMINI_TOKEN_BUDGETS", "{}"))}
+
+# Qué hacer si una petición supera el presupuesto: reject | truncate | sample | reroute
+TOKEN_BUDGET_POLICY = os.getenv("TOKEN_BUDGET_POLICY", "reject")
+
+TOKEN_BUDGET_POLICIES = ("reject", "truncate", "sample", "reroute")
+if TOKEN_BUDGET_POLICY not in TOKEN_BUDGET_POLICIES:
+    raise ValueError(f"TOKEN_BUDGET_POLICY debe ser uno de {TOKEN_BUDGET_POLICIES}")
+
+# Heurísticas de tokens por tipo de adjunto (documentación de Gemini)
+_CHARS_PER_TOKEN = 4
+_IMAGE_TOKENS = 258            # por imagen pequeña o por tile de 768x768
+_IMAGE_TILE = 768
+_PDF_PAGE_TOKENS = 258
+_AUDIO_TOKENS_PER_SECOND = 32
+_VIDEO_TOKENS_PER_SECOND = 263
+# Sin decodificar no conocemos la duración: se asume un bitrate típico
+_AUDIO_BYTES_PER_SECOND = 16_000    # ~128 kbps
+_VIDEO_BYTES_PER_SECOND = 125_000   # ~1 Mbps
+
+_PDF_PAGE = re.compile(rb"/Type\s*/Page[^s]")
+# Solapamiento entre bloques al contar páginas de un PDF en disco
+_PDF_SCAN_OVERLAP = 64
+
+class TokenBudgetExceeded(Exception):
+    """La petición supera el presupuesto del modelo y la política no permite enviarla."""
+
+    def __init__(self, model_name: str, estimated: int, budget: int):
+        super().__init__(
+            f"La petición (~{estimated} tokens) supera el presupuesto de {model_name} ({budget} tokens)"
+        )
+        self.model_name = model_name
+        self.estimated = estimated
+        self.budget = budget
+
+# ==================== SERIALIZACIÓN ====================
+
+def compact_json(value: Any) -> str:
+    """JSON sin espacios de indentación: los espacios también se pagan como tokens."""
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+# ==================== ESTIMACIÓN ====================
+
+def estimate_tokens(value: Any) -> int:
+    """Estimación local (sin llamar a count_tokens) del tamaño en tokens de un texto o dato."""
+    text = value if isinstance(value, str) else compact_json(value)
+    return len(text) // _CHARS_PER_TOKEN + 1
+
+def _image_tokens(data: FileData) -> int:
+    try:
+        with open_data(data) as f, Image.open(f) as image:
+            width, height = image.size
+    except Exception:
+        return _IMAGE_TOKENS
+    if width <= _IMAGE_TILE // 2 and height <= _IMAGE_TILE // 2:
+        return _IMAGE_TOKENS
+    return math.ceil(width / _IMAGE_TILE) * math.ceil(height / _IMAGE_TILE) * _IMAGE_TOKENS
+
+def _audio_tokens(data: FileData, mime_type: str) -> int:
+    seconds = data_size(data) / _AUDIO_BYTES_PER_SECOND
+    if "wav" in mime_type:
+        try:
+            with open_data(data) as f, wave.open(f) as audio:
+                seconds = audio.getnframes() / audio.getframerate()
+        except Exception:
+            pass
+    return math.ceil(seconds * _AUDIO_TOKENS_PER_SECOND)
+
+def _pdf_pages(data: FileData) -> int:
+    if not isinstance(data, os.PathLike):
+        return len(_PDF_PAGE.findall(data))
+    # En disco se recorre por bloques; solo se cuentan las coincidencias que
+    # terminan después del solapamiento (las anteriores ya se contaron)
+    pages = 0
+    tail = b""
+    with open_data(data) as f:
+        for block in iter_blocks(f):
+            window = tail + block
+            pages += sum(1 for match in _PDF_PAGE.finditer(window) if match.end() > len(tail))
+            tail = window[-_PDF_SCAN_OVERLAP:]
+    return pages
+
+def estimate_part_tokens(part: Any) -> int:
+    """
+    Tokens de una parte del contenido: texto o adjunto `{"mime_type", "data"}`,
+    con `data` en memoria o en disco (`os.PathLike`).
+    """
+    if isinstance(part, str):
+        return estimate_tokens(part)
+    if not isinstance(part, dict) or not isinstance(part.get("data"), (bytes, bytearray, os.PathLike)):
+        # Archivos subidos por la File API u otros objetos: tamaño desconocido
+        return _IMAGE_TOKENS
+    data = part["data"]
+    mime_type = part.get("mime_type", "")
+    if mime_type.startswith("image/"):
+        return _image_tokens(data)
+    if mime_type.startswith("audio/"):
+        return _audio_tokens(data, mime_type)
+    if mime_type.startswith("video/"):
+        return math.ceil(data_size(data) / _VIDEO_BYTES_PER_SECOND * _VIDEO_TOKENS_PER_SECOND)
+    if mime_type == "application/pdf":
+        return max(1, _pdf_pages(data)) * _PDF_PAGE_TOKENS
+    return data_size(data) // _CHARS_PER_TOKEN + 1
+
+def estimate_request_tokens(contents: Any) -> int:
+    parts = contents if isinstance(contents, list) else [contents]
+    return sum(estimate_part_tokens(part) for part in parts)
+
+def budget_for(model_name: str) -> int:
+    return TOKEN_BUDGETS.get(model_name, min(MODEL_TOKEN_LIMITS.values()))
+
+def _tier(model_name: str) -> str:
+    return "pro" if "pro" in model_name else "flash"
+
+def model_for_budget(estimated: int, exclude: str) -> Optional[str]:
+    """
+    Modelo que admite `estimated` tokens (para reroute): primero los de la misma
+    gama (pro/flash) que el original y, entre ellos, el de presupuesto más ajustado.
+    """
+    candidates = [
+        (_tier(name) != _tier(exclude), budget, name)
+        for name, budget in TOKEN_BUDGETS.items() if budget >= estimated and name != exclude
+    ]
+    return min(candidates)[2] if candidates else None
+
+# ==================== AJUSTE AL PRESUPUESTO ====================
+
+def sample_to_budget(value: Any, max_tokens: int, seed: int = 0) -> Any:
+    """
+    Reduce `value` muestreando uniformemente sus listas más largas hasta que
+    entre en `max_tokens`. Se conserva el orden original de los elementos.
+    """
+    rng = random.Random(seed)
+    value = json.loads(compact_json(value))
+    while estimate_tokens(value) > max_tokens:
+        holder, key, items = _largest_list(value)
+        if items is None or len(items) <= 1:
+            break
+        keep = sorted(rng.sample(range(len(items)), len(items) // 2))
+        sampled = [items[i] for i in keep]
+        if holder is None:
+            value = sampled
+        else:
+            holder[key] = sampled
+    return value
+
+def _largest_list(value: Any):
+    best = (None, None, value if isinstance(value, list) else None)
+    stack = [value]
+    while stack:
+        node = stack.pop()
+        children = node.items() if isinstance(node, dict) else enumerate(node) if isinstance(node, list) else ()
+        for key, child in children:
+            if isinstance(child, list) and (best[2] is None or len(child) > len(best[2])):
+                best = (node, key, child)
+            if isinstance(child, (dict, list)):
+                stack.append(child)
+    return best
+
+def truncate_contents(contents: Any, max_tokens: int) -> Any:
+    """
+    Recorta la parte de texto más larga para que la petición entre en `max_tokens`.
+
+    Se quita el centro: el inicio (instrucciones) y el final (esquema de respuesta)
+    del prompt se conservan.
+    """
+    parts = list(contents) if isinstance(contents, list) else [contents]
+    texts = [i for i, part in enumerate(parts) if isinstance(part, str)]
+    if not texts:
+        return contents
+    longest = max(texts, key=lambda i: len(parts[i]))
+    marker = "\n[... contenido truncado por presupuesto de tokens ...]"
+    excess = estimate_request_tokens(parts) - max_tokens
+    keep = max(0, len(parts[longest]) - (excess + 1) * _CHARS_PER_TOKEN - len(marker))
+    text = parts[longest]
+    parts[longest] = text[:keep - keep // 2] + marker + (text[len(text) - keep // 2:] if keep // 2 else "")
+    return parts if isinstance(contents, list) else parts[0]
+
+# ==================== USO POR PETICIÓN ====================
+
+class UsageTrace:
+    """Tokens estimados y reales (usage_metadata) de las llamadas hechas en una petición HTTP."""
+
+    def __init__(self):
+        self.calls: List[Dict[str, Any]] = []
+
+    def record(self, model_name: str, estimated: int, response: Any, action: Optional[str] = None) -> None:
+        usage = getattr(response, "usage_metadata", None)
+        call = {
+            "model": model_name,
+            "estimated_tokens": estimated,
+            "prompt_tokens": getattr(usage, "prompt_token_count", None),
+            "output_tokens": getattr(usage, "candidates_token_count", None),
+            "total_tokens": getattr(usage, "total_token_count", None)
+        }
+        if action:
+            call["budget_action"] = action
+        self.calls.append(call)
+
+    def summary(self) -> Dict[str, Any]:
+        def total(field: str) -> int:
+            return sum(call[field] or 0 for call in self.calls)
+
+        return {
+            "calls": len(self.calls),
+            "estimated_tokens": total("estimated_tokens"),
+            "prompt_tokens": total("prompt_tokens"),
+            "output_tokens": total("output_tokens"),
+            "total_tokens": total("total_tokens")
+        }
+
+    def headers(self) -> Dict[str, str]:
+        summary = self.summary()
+        return {
+            "X-Gemini-Calls": str(summary["calls"]),
+            "X-Tokens-Estimated": str(summary["estimated_tokens"]),
+            "X-Tokens-Prompt": str(summary["prompt_tokens"]),
+            "X-Tokens-Output": str(summary["output_tokens"])
+        }
+
+_usage_trace: ContextVar[Optional[UsageTrace]] = ContextVar("usage_trace", default=None)
+
+@contextmanager
+def track_usage() -> Iterator[UsageTrace]:
+    """Registra el uso de tokens de las llamadas hechas dentro del bloque."""
+    trace = UsageTrace()
+    token = _usage_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _usage_trace.reset(token)
+
+def current_usage() -> Optional[UsageTrace]:
+    return _usage_trace.get()
+
+def record_usage(model_name: str, estimated: int, response: Any, action: Optional[str] = None) -> None:
+    trace = _usage_trace.get()
+    if trace is not None:
+        trace.record(model_name, estimated, response, action)
@@ -0,0 +1,616 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple
+
+from spool_service import data_size, iter_blocks, open_data
+
+# ==================== CONFIGURACIÓN ====================
+
+CACHE_ENABLED = os.getenv("ANALYSIS_CACHE_ENABLED", "1") != "0"
+CACHE_PATH = os.getenv("ANALYSIS_CACHE_PATH", ".cache/analysis_cache.sqlite3")
+CACHE_TTL_SECONDS = int(os.getenv("ANALYSIS_CACHE_TTL", str(7 * 24 * 3600)))
+CACHE_MEMORY_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MEMORY_ENTRIES", "512"))
+CACHE_MAX_BYTES = int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Peticiones idénticas simultáneas comparten un solo cómputo (en el worker y entre workers)
+SINGLEFLIGHT_ENABLED = os.getenv("ANALYSIS_SINGLEFLIGHT_ENABLED", "1") != "0"
+# Pasado este tiempo sin terminar, otro worker puede quedarse con el cómputo (worker caído)
+SINGLEFLIGHT_LEASE_SECONDS = float(os.getenv("ANALYSIS_SINGLEFLIGHT_LEASE", "600"))
+# Cada cuánto mira el vigilante del worker si cambió la base (PRAGMA data_version);
+# solo si cambió lee las filas de los cómputos que se esperan de otros workers
+SINGLEFLIGHT_POLL_SECONDS = float(os.getenv("ANALYSIS_SINGLEFLIGHT_POLL", "0.2"))
+
+# Cada cuántas escrituras se revisa el tamaño total del nivel en disco
+_EVICTION_CHECK_EVERY = 50
+
+# ==================== CLAVES ====================
+
+def make_cache_key(namespace: str, *parts: Any) -> str:
+    """
+    Genera una clave SHA-256 a partir del contenido.
+
+    Los `bytes` (archivos) se hashean tal cual; el resto de partes (prompt,
+    modelo, nivel...) se serializan como JSON canónico. Un archivo en disco
+    (`os.PathLike`) se lee por bloques y da la misma clave que sus bytes.
+    """
+    digest = hashlib.sha256(namespace.encode("utf-8"))
+    for part in parts:
+        if isinstance(part, os.PathLike):
+            digest.update(data_size(part).to_bytes(8, "big"))
+            with open_data(part) as f:
+                for block in iter_blocks(f):
+                    digest.update(block)
+            continue
+        if isinstance(part, (bytes, bytearray, memoryview)):
+            data = bytes(part)
+        else:
+            data = json.dumps(part, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
+
+# ==================== TRAZA POR PETICIÓN ====================
+
+class CacheTrace:
+    """Acumula aciertos/fallos de caché durante una petición HTTP."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def headers(self) -> Dict[str, str]:
+        total = self.hits + self.misses
+        if total == 0:
+            status = "BYPASS"
+        elif self.misses == 0:
+            status = "HIT"
+        elif self.hits == 0:
+            status = "MISS"
+        else:
+            status = "PARTIAL"
+        return {"X-Cache": status, "X-Cache-Hits": f"{self.hits}/{total}"}
+
+_cache_trace: ContextVar[Optional[CacheTrace]] = ContextVar("cache_trace", default=None)
+
+@contextmanager
+def track_cache() -> Iterator[CacheTrace]:
+    """
+    Registra los accesos a caché hechos dentro del bloque.
+
+    Las tareas creadas dentro (p. ej. con asyncio.gather) heredan la misma traza.
+    """
+    trace = CacheTrace()
+    token = _cache_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _cache_trace.reset(token)
+
+def _record(hit: bool) -> None:
+    trace = _cache_trace.get()
+    if trace is None:
+        return
+    if hit:
+        trace.hits += 1
+    else:
+        trace.misses += 1
+
+# ==================== CACHÉ DE DOS NIVELES ====================
+
+class AnalysisCache:
+    """
+    Caché de resultados con dos niveles:
+
+    - Memoria: LRU por proceso (rápido, se pierde al reiniciar).
+    - Disco: SQLite en modo WAL, sobrevive reinicios y se comparte entre
+      workers de uvicorn en el mismo host.
+
+    Las entradas expiran por TTL y el nivel en disco se recorta por tamaño
+    total eliminando primero las menos usadas recientemente.
+    """
+
+    def __init__(
+        self,
+        path: str = CACHE_PATH,
+        ttl_seconds: int = CACHE_TTL_SECONDS,
+        memory_entries: int = CACHE_MEMORY_ENTRIES,
+        max_bytes: int = CACHE_MAX_BYTES
+    ):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._writes = 0
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "bytes_saved": 0
+        }
+
+    # ---------- SQLite ----------
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            self._local.conn = conn
+        return conn
+
+    def _evict_disk(self, now: float) -> None:
+        conn = self._conn()
+        cur = conn.execute("DELETE FROM entries WHERE created < ?", (now - self.ttl_seconds,))
+        evicted = cur.rowcount
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total > self.max_bytes:
+            # Dejamos margen (90%) para no recortar en cada escritura
+            target = int(self.max_bytes * 0.9)
+            rows = conn.execute("SELECT key, size FROM entries ORDER BY accessed ASC").fetchall()
+            doomed = []
+            for key, size in rows:
+                if total <= target:
+                    break
+                doomed.append((key,))
+                total -= size
+            conn.executemany("DELETE FROM entries WHERE key = ?", doomed)
+            evicted += len(doomed)
+        if evicted:
+            with self._lock:
+                self._stats["evictions"] += evicted
+
+    # ---------- API ----------
+
+    def get(self, key: str, input_bytes: int = 0) -> Optional[Any]:
+        """Busca `key` en memoria y luego en disco. `input_bytes` alimenta la métrica de bytes ahorrados."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, value = entry
+                if now - created <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    self._stats["bytes_saved"] += input_bytes
+                    return json.loads(value)
+                del self._memory[key]
+
+        conn = self._conn()
+        row = conn.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is not None and now - row[1] <= self.ttl_seconds:
+            conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self._remember(key, row[1], row[0])
+            with self._lock:
+                self._stats["disk_hits"] += 1
+                self._stats["bytes_saved"] += input_bytes
+            return json.loads(row[0])
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def set(self, key: str, value: Any) -> None:
+        now = time.time()
+        serialized = json.dumps(value, ensure_ascii=False)
+        self._remember(key, now, serialized)
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, serialized, len(serialized.encode("utf-8")), now, now)
+        )
+        with self._lock:
+            self._stats["stores"] += 1
+            self._writes += 1
+            check_eviction = self._writes % _EVICTION_CHECK_EVERY == 0
+        if check_eviction:
+            self._evict_disk(now)
+
+    def _remember(self, key: str, created: float, serialized: str) -> None:
+        with self._lock:
+            self._memory[key] = (created, serialized)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        self._conn().execute("DELETE FROM entries")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        entries, size = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        stats["disk_entries"] = entries
+        stats["disk_bytes"] = size
+        stats["enabled"] = CACHE_ENABLED
+        return stats
+
+analysis_cache = AnalysisCache()
+
+# ==================== CÓMPUTOS EN VUELO (SINGLE-FLIGHT) ====================
+
+# Los resultados publicados para otros workers se borran pasado este tiempo
+_FINISHED_RETENTION_SECONDS = 60
+
+class _Abandoned(Exception):
+    """El líder se canceló antes de terminar: quien esperaba lo intenta de nuevo."""
+
+class InFlight:
+    """
+    Cómputos en curso por clave de caché, para que peticiones idénticas
+    simultáneas (reintentos del frontend, varios curadores con el mismo
+    dataset) compartan una sola llamada a Gemini.
+
+    - En el worker: un Future por clave; lo esperan tanto hilos como corrutinas.
+    - Entre workers del host: una fila por clave en SQLite (la base de la
+      caché) que hace de lock con lease. El líder publica ahí el resultado, así
+      que también llega a los demás aunque sea un error que no se cachea.
+      Quien espera a otro worker se bloquea en un Future; un único hilo
+      vigilante por proceso lo resuelve cuando la fila termina, desaparece o
+      vence su lease, con una sola consulta para todas las claves esperadas.
+    """
+
+    def __init__(
+        self,
+        path: str = CACHE_PATH,
+        lease_seconds: float = SINGLEFLIGHT_LEASE_SECONDS,
+        poll_seconds: float = SINGLEFLIGHT_POLL_SECONDS
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self._token = uuid.uuid4().hex[:8]
+        self._flights: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Claves que este proceso espera de otros workers -> Future con el resultado publicado
+        self._remote: Dict[str, Future] = {}
+        self._watcher: Optional[threading.Thread] = None
+        self._watcher_pid = 0
+        self._wake = threading.Event()
+        self._stats = {"leaders": 0, "coalesced": 0, "coalesced_remote": 0}
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS inflight (
+                    key TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    started REAL NOT NULL,
+                    finished REAL,
+                    value TEXT
+                )
+            """)
+            self._local.conn = conn
+        return conn
+
+    @property
+    def _owner(self) -> str:
+        # Con el pid actual: los workers creados con fork heredan el mismo objeto
+        return f"{os.getpid()}-{self._token}"
+
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            self._stats[stat] += 1
+
+    # ---------- En el worker ----------
+
+    def _join(self, key: str) -> Tuple[bool, Future]:
+        """(es_líder, future): el primero que pide la clave la calcula, el resto espera."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._stats["coalesced"] += 1
+                return False, flight
+            flight = self._flights[key] = Future()
+            return True, flight
+
+    def _finish(self, key: str, flight: Future, value: Any = None, error: Optional[BaseException] = None) -> None:
+        with self._lock:
+            self._flights.pop(key, None)
+        if error is not None:
+            flight.set_exception(error)
+        else:
+            # Cada seguidor recibe su propia copia (el líder puede modificar la suya)
+            flight.set_result(json.dumps(value, ensure_ascii=False, default=str))
+
+    # ---------- Entre workers ----------
+
+    def _claim(self, key: str) -> bool:
+        """Toma la fila de `key` si está libre, terminada o con el lease vencido."""
+        now = time.time()
+        cur = self._conn().execute(
+            """
+            INSERT INTO inflight (key, owner, started, finished, value) VALUES (?, ?, ?, NULL, NULL)
+            ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, started = excluded.started, finished = NULL, value = NULL
+            WHERE inflight.finished IS NOT NULL OR inflight.started < ?
+            """,
+            (key, self._owner, now, now - self.lease_seconds)
+        )
+        return cur.rowcount == 1
+
+    def _publish(self, key: str, value: Any) -> None:
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "UPDATE inflight SET finished = ?, value = ? WHERE key = ? AND owner = ?",
+            (now, json.dumps(value, ensure_ascii=False, default=str), key, self._owner)
+        )
+        conn.execute(
+            "DELETE FROM inflight WHERE finished IS NOT NULL AND finished < ?",
+            (now - _FINISHED_RETENTION_SECONDS,)
+        )
+
+    def _release(self, key: str) -> None:
+        self._conn().execute("DELETE FROM inflight WHERE key = ? AND owner = ?", (key, self._owner))
+
+    def _wait_remote(self, key: str) -> Future:
+        """
+        Future que el vigilante resuelve con el resultado publicado por otro
+        worker, o con None si la fila desaparece o vence su lease (hay que
+        intentar tomar el cómputo).
+        """
+        waiter: Future = Future()
+        with self._lock:
+            self._remote[key] = waiter
+            if self._watcher is None or self._watcher_pid != os.getpid():
+                self._watcher_pid = os.getpid()
+                self._watcher = threading.Thread(target=self._watch, name="singleflight-watcher", daemon=True)
+                self._watcher.start()
+        # Clave nueva: el vigilante la consulta ya, sin esperar a que cambie la base
+        self._wake.set()
+        return waiter
+
+    def _unwatch(self, key: str, waiter: Future) -> None:
+        with self._lock:
+            if self._remote.get(key) is waiter:
+                del self._remote[key]
+
+    def _watch(self) -> None:
+        conn = self._conn()
+        version = None
+        leases: Dict[str, float] = {}
+        while True:
+            woken = self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+            with self._lock:
+                keys = list(self._remote)
+                if not keys:
+                    self._watcher = None
+                    return
+            current = conn.execute("PRAGMA data_version").fetchone()[0]
+            now = time.time()
+            # Sin escrituras de otras conexiones ni leases vencidos no hay nada que leer
+            if not woken and current == version and all(leases.get(key, 0) > now for key in keys):
+                continue
+            version = current
+            rows = {}
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows.update((row[0], row[1:]) for row in conn.execute(
+                    f"SELECT key, started, finished, value FROM inflight WHERE key IN ({', '.join('?' * len(chunk))})",
+                    chunk
+                ))
+            leases = {}
+            for key in keys:
+                row = rows.get(key)
+                if row is not None and row[1] is None and now - row[0] < self.lease_seconds:
+                    leases[key] = row[0] + self.lease_seconds
+                    continue
+                with self._lock:
+                    waiter = self._remote.pop(key, None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(row[2] if row is not None and row[1] is not None else None)
+
+    def _lead(self, key: str, compute: Callable[[], Any]) -> Any:
+        while True:
+            if self._claim(key):
+                self._count("leaders")
+                _record(False)
+                try:
+                    value = compute()
+                except BaseException:
+                    self._release(key)
+                    raise
+                self._publish(key, value)
+                return value
+            waiter = self._wait_remote(key)
+            try:
+                value = waiter.result()
+            finally:
+                self._unwatch(key, waiter)
+            if value is not None:
+                self._count("coalesced_remote")
+                _record(True)
+                return json.loads(value)
+
+    async def _lead_async(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        # Las operaciones en SQLite pueden esperar el lock de escritura: van en un hilo
+        while True:
+            if await asyncio.to_thread(self._claim, key):
+                self._count("leaders")
+                _record(False)
+                try:
+                    value = await compute()
+                except BaseException:
+                    await asyncio.shield(asyncio.to_thread(self._release, key))
+                    raise
+                await asyncio.to_thread(self._publish, key, value)
+                return value
+            waiter = self._wait_remote(key)
+            try:
+                value = await asyncio.wrap_future(waiter)
+            finally:
+                self._unwatch(key, waiter)
+            if value is not None:
+                self._count("coalesced_remote")
+                _record(True)
+                return json.loads(value)
+
+    # ---------- API ----------
+
+    def run(self, key: str, compute: Callable[[], Any]) -> Any:
+        """Ejecuta `compute` o espera al cómputo idéntico que ya está en curso."""
+        while True:
+            leader, flight = self._join(key)
+            if not leader:
+                try:
+                    snapshot = flight.result()
+                except _Abandoned:
+                    continue
+                _record(True)
+                return json.loads(snapshot)
+            try:
+                value = self._lead(key, compute)
+            except Exception as e:
+                self._finish(key, flight, error=e)
+                raise
+            except BaseException:
+                self._finish(key, flight, error=_Abandoned())
+                raise
+            self._finish(key, flight, value)
+            return value
+
+    async def run_async(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """Versión asíncrona de `run`."""
+        while True:
+            leader, flight = self._join(key)
+            if not leader:
+                try:
+                    # shield: si se cancela este seguidor, el Future compartido sigue vivo
+                    snapshot = await asyncio.shield(asyncio.wrap_future(flight))
+                except _Abandoned:
+                    continue
+                _record(True)
+                return json.loads(snapshot)
+            try:
+                value = await self._lead_async(key, compute)
+            except Exception as e:
+                self._finish(key, flight, error=e)
+                raise
+            except BaseException:
+                self._finish(key, flight, error=_Abandoned())
+                raise
+            self._finish(key, flight, value)
+            return value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._flights)
+        stats["enabled"] = SINGLEFLIGHT_ENABLED
+        return stats
+
+in_flight = InFlight()
+
+# ==================== HELPERS ====================
+
+def _is_cacheable(value: Any) -> bool:
+    """Los resultados fallidos nunca se guardan."""
+    return not (isinstance(value, dict) and "error" in value)
+
+def cached(
+    namespace: str,
+    key_parts: Tuple[Any, ...],
+    compute: Callable[[], Any],
+    input_bytes: int = 0,
+    bypass: bool = False,
+    cacheable: Callable[[Any], bool] = _is_cacheable
+) -> Any:
+    """
+    Devuelve el resultado cacheado o ejecuta `compute` y lo guarda. Si ya hay un
+    cómputo idéntico en curso (en este worker o en otro), espera su resultado.
+    Con `bypass` siempre se calcula de nuevo: no se une a cómputos en curso.
+    """
+    if not CACHE_ENABLED and not SINGLEFLIGHT_ENABLED:
+        return compute()
+    key = make_cache_key(namespace, *key_parts)
+    if CACHE_ENABLED and not bypass:
+        value = analysis_cache.get(key, input_bytes)
+        if value is not None:
+            _record(True)
+            return value
+
+    def compute_and_store() -> Any:
+        value = compute()
+        if CACHE_ENABLED and cacheable(value):
+            analysis_cache.set(key, value)
+        return value
+
+    if bypass or not SINGLEFLIGHT_ENABLED:
+        _record(False)
+        return compute_and_store()
+    return in_flight.run(key, compute_and_store)
+
+async def cached_async(
+    namespace: str,
+    key_parts: Tuple[Any, ...],
+    compute: Callable[[], Awaitable[Any]],
+    input_bytes: int = 0,
+    bypass: bool = False,
+    cacheable: Callable[[Any], bool] = _is_cacheable
+) -> Any:
+    """
+    Versión asíncrona de `cached`.
+
+    Calcular la clave (hash de ficheros por bloques) y leer/escribir en
+    SQLite bloquean, así que se hacen en un hilo para no frenar el loop.
+    """
+    if not CACHE_ENABLED and not SINGLEFLIGHT_ENABLED:
+        return await compute()
+    key = await asyncio.to_thread(make_cache_key, namespace, *key_parts)
+    if CACHE_ENABLED and not bypass:
+        value = await asyncio.to_thread(analysis_cache.get, key, input_bytes)
+        if value is not None:
+            _record(True)
+            return value
+
+    async def compute_and_store() -> Any:
+        value = await compute()
+        if CACHE_ENABLED and cacheable(value):
+            await asyncio.to_thread(analysis_cache.set, key, value)
+        return value
+
+    if bypass or not SINGLEFLIGHT_ENABLED:
+        _record(False)
+        return await compute_and_store()
+    return await in_flight.run_async(key, compute_and_store)
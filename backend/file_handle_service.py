@@ -0,0 +1,206 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import google.generativeai as genai
+
+from spool_service import digest_stream
+
+# ==================== CONFIGURACIÓN ====================
+
+FILE_HANDLE_CACHE_PATH = os.getenv("FILE_HANDLE_CACHE_PATH", ".cache/file_handles.sqlite3")
+# La File API borra los archivos a las 48 h; se usa si la respuesta no trae expiration_time
+FILE_HANDLE_TTL_SECONDS = int(os.getenv("FILE_HANDLE_TTL", str(48 * 3600)))
+# Un handle que vence antes de este margen se considera vencido (se vuelve a subir)
+FILE_HANDLE_EXPIRY_MARGIN = int(os.getenv("FILE_HANDLE_EXPIRY_MARGIN", "600"))
+# Sondeo del procesamiento (videos): empieza rápido y se espacia hasta el máximo
+FILE_PROCESSING_POLL_SECONDS = float(os.getenv("FILE_PROCESSING_POLL_SECONDS", "1"))
+FILE_PROCESSING_POLL_MAX_SECONDS = float(os.getenv("FILE_PROCESSING_POLL_MAX_SECONDS", "15"))
+FILE_PROCESSING_POLL_BACKOFF = 1.5
+# Tiempo máximo total esperando a que un archivo quede ACTIVE
+FILE_PROCESSING_TIMEOUT = float(os.getenv("FILE_PROCESSING_TIMEOUT", "900"))
+
+def _expires_at(file: Any) -> float:
+    try:
+        expires = file.expiration_time.timestamp()
+    except Exception:
+        expires = 0
+    return expires if expires > 0 else time.time() + FILE_HANDLE_TTL_SECONDS
+
+def _poll_delays() -> Iterator[float]:
+    delay = FILE_PROCESSING_POLL_SECONDS
+    while True:
+        yield delay
+        delay = min(delay * FILE_PROCESSING_POLL_BACKOFF, FILE_PROCESSING_POLL_MAX_SECONDS)
+
+def _check_deadline(file: Any, deadline: float) -> None:
+    if time.monotonic() >= deadline:
+        raise TimeoutError(f"{file.name} sigue en procesamiento al vencer el plazo")
+
+# ==================== CACHÉ DE HANDLES ====================
+
+class FileHandleCache:
+    """
+    Archivos ya subidos a la File API, indexados por el SHA-256 del contenido.
+
+    El mismo archivo (aunque cambie de ruta) se sube una sola vez mientras el
+    archivo remoto siga vivo. Los handles se guardan en memoria y en SQLite,
+    así que una nueva ejecución reutiliza lo subido por la anterior; al
+    acercarse el vencimiento se vuelve a subir.
+    """
+
+    def __init__(self, path: str = FILE_HANDLE_CACHE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._memory: Dict[str, Tuple[Any, float]] = {}
+        # (ruta, tamaño, mtime) -> sha256, para no releer el archivo en cada llamada
+        self._digests: Dict[Tuple[str, int, int], str] = {}
+        # Un lock por contenido: dos hilos con el mismo archivo no lo suben dos veces
+        self._upload_locks: Dict[str, threading.Lock] = {}
+        self.uploads = 0
+        self.hits = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS file_handles (
+                    digest TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    mime_type TEXT,
+                    expires REAL NOT NULL,
+                    created REAL NOT NULL
+                )
+            """)
+            self._local.conn = conn
+        return conn
+
+    def digest(self, path: str) -> str:
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        digest = self._digests.get(key)
+        if digest is None:
+            with open(path, "rb") as f:
+                digest, _ = digest_stream(f)
+            self._digests[key] = digest
+        return digest
+
+    def _remember(self, digest: str, file: Any, expires: float) -> None:
+        with self._lock:
+            self._memory[digest] = (file, expires)
+
+    def _lookup(self, digest: str) -> Optional[Any]:
+        deadline = time.time() + FILE_HANDLE_EXPIRY_MARGIN
+        with self._lock:
+            entry = self._memory.get(digest)
+        if entry is not None and entry[1] > deadline:
+            return entry[0]
+
+        row = self._conn().execute(
+            "SELECT name, expires FROM file_handles WHERE digest = ?", (digest,)
+        ).fetchone()
+        if row is None or row[1] <= deadline:
+            return None
+        try:
+            # Subido por otra ejecución: se confirma que sigue existiendo (no sube nada)
+            file = genai.get_file(row[0])
+        except Exception:
+            return None
+        if file.state.name == "FAILED":
+            return None
+        self._remember(digest, file, row[1])
+        return file
+
+    def _store(self, digest: str, file: Any) -> None:
+        expires = _expires_at(file)
+        self._remember(digest, file, expires)
+        self._conn().execute(
+            "INSERT OR REPLACE INTO file_handles (digest, name, mime_type, expires, created) VALUES (?, ?, ?, ?, ?)",
+            (digest, file.name, file.mime_type, expires, time.time())
+        )
+
+    def invalidate(self, digest: str) -> None:
+        with self._lock:
+            self._memory.pop(digest, None)
+        self._conn().execute("DELETE FROM file_handles WHERE digest = ?", (digest,))
+
+    def _activated(self, digest: str, file: Any) -> Any:
+        if file.state.name == "FAILED":
+            self.invalidate(digest)
+            raise ValueError(f"File processing failed: {file.state.name}")
+        self._store(digest, file)
+        return file
+
+    def _wait_until_active(self, digest: str, file: Any, deadline: Optional[float] = None) -> Any:
+        if file.state.name != "PROCESSING":
+            return self._activated(digest, file) if file.state.name == "FAILED" else file
+        deadline = deadline or time.monotonic() + FILE_PROCESSING_TIMEOUT
+        for delay in _poll_delays():
+            _check_deadline(file, deadline)
+            time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+            file = genai.get_file(file.name)
+            if file.state.name != "PROCESSING":
+                return self._activated(digest, file)
+
+    async def _wait_until_active_async(self, digest: str, file: Any, deadline: Optional[float] = None) -> Any:
+        if file.state.name != "PROCESSING":
+            return self._activated(digest, file) if file.state.name == "FAILED" else file
+        deadline = deadline or time.monotonic() + FILE_PROCESSING_TIMEOUT
+        for delay in _poll_delays():
+            _check_deadline(file, deadline)
+            await asyncio.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+            file = await asyncio.to_thread(genai.get_file, file.name)
+            if file.state.name != "PROCESSING":
+                return self._activated(digest, file)
+
+    def _handle(self, path: str, mime_type: Optional[str], display_name: Optional[str]) -> Tuple[str, Any]:
+        """(sha256, handle) del archivo, subiéndolo solo si no hay uno vigente. No espera el procesamiento."""
+        digest = self.digest(path)
+        with self._lock:
+            upload_lock = self._upload_locks.setdefault(digest, threading.Lock())
+        with upload_lock:
+            file = self._lookup(digest)
+            if file is not None:
+                self.hits += 1
+            else:
+                file = genai.upload_file(path=path, mime_type=mime_type, display_name=display_name)
+                self.uploads += 1
+                self._store(digest, file)
+            return digest, file
+
+    def get_or_upload(self, path: str, mime_type: Optional[str] = None, display_name: Optional[str] = None) -> Any:
+        """Handle listo para usar (estado ACTIVE) del archivo en `path`, subiéndolo solo si hace falta."""
+        digest, file = self._handle(path, mime_type, display_name)
+        return self._wait_until_active(digest, file)
+
+    async def get_or_upload_async(
+        self,
+        path: str,
+        mime_type: Optional[str] = None,
+        display_name: Optional[str] = None,
+        upload_semaphore: Optional[asyncio.Semaphore] = None,
+        deadline: Optional[float] = None
+    ) -> Any:
+        """
+        Versión asíncrona de `get_or_upload`. La espera del procesamiento no
+        ocupa un hilo, así que muchos archivos pueden procesarse a la vez;
+        `upload_semaphore` limita solo las subidas simultáneas y `deadline`
+        (time.monotonic) fija un límite común a todo un lote.
+        """
+        if upload_semaphore is None:
+            digest, file = await asyncio.to_thread(self._handle, path, mime_type, display_name)
+        else:
+            async with upload_semaphore:
+                digest, file = await asyncio.to_thread(self._handle, path, mime_type, display_name)
+        return await self._wait_until_active_async(digest, file, deadline)
+
+file_handles = FileHandleCache()
@@ -1,9 +1,32 @@
 import google.generativeai as genai
+import asyncio
 import os
 import json
+import threading
+import time
 from dotenv import load_dotenv
-from typing import Dict, Any, List, Optional
+from typing import IO, Dict, Any, Awaitable, Callable, List, Optional, Tuple
 from enum import Enum
+from google.api_core.exceptions import ResourceExhausted
+
+from budget_service import (
+    TOKEN_BUDGET_POLICY,
+    TokenBudgetExceeded,
+    budget_for,
+    compact_json,
+    estimate_request_tokens,
+    estimate_tokens,
+    model_for_budget,
+    record_usage,
+    sample_to_budget,
+    truncate_contents
+)
+from cache_service import cached, cached_async
+from mapreduce_service import MAPREDUCE_CHUNK_TOKENS, map_reduce, map_reduce_async, pack_chunks
+from profile_service import iter_json_records, profile_json, profile_records, profile_report_sections
+from resilience_service import call_with_resilience, call_with_resilience_async
+from scheduler_service import SCHEDULER_429_RETRIES, SCHEDULER_ENABLED, gemini_scheduler
+from spool_service import FileData, data_size, digest_stream, read_data
 
 load_dotenv()
 
@@ -45,29 +68,32 @@ ANÁLISIS REQUERIDO:
 - Riesgos potenciales
 """
 
-def get_analysis_prompt(analysis_level: str, user_goal: str) -> str:
-    """Genera prompt según nivel de análisis"""
-    
-    base_schema = {
-        "summary": "string - Resumen conciso del contenido",
-        "data_quality_score": "number - Puntuación 0-100",
-        "data_quality_details": {
-            "resolution": "string - Alta/Media/Baja",
-            "clarity": "string - Excelente/Buena/Regular/Mala",
-            "completeness": "number - % de datos completos",
-            "consistency": "string - Evaluación de consistencia"
-        },
-        "biases": {
-            "detected": "boolean",
-            "types": ["array de tipos de sesgo"],
-            "severity": "string - Bajo/Medio/Alto/Crítico",
-            "details": "string - Descripción detallada"
-        },
-        "usable_for_training": "boolean",
-        "usability_score": "number - Puntuación 0-100",
-        "recommendations": ["array de recomendaciones"],
-        "risks": ["array de riesgos potenciales"]
-    }
+BASE_ANALYSIS_SCHEMA = {
+    "summary": "string - Resumen conciso del contenido",
+    "data_quality_score": "number - Puntuación 0-100",
+    "data_quality_details": {
+        "resolution": "string - Alta/Media/Baja",
+        "clarity": "string - Excelente/Buena/Regular/Mala",
+        "completeness": "number - % de datos completos",
+        "consistency": "string - Evaluación de consistencia"
+    },
+    "biases": {
+        "detected": "boolean",
+        "types": ["array de tipos de sesgo"],
+        "severity": "string - Bajo/Medio/Alto/Crítico",
+        "details": "string - Descripción detallada"
+    },
+    "usable_for_training": "boolean",
+    "usability_score": "number - Puntuación 0-100",
+    "recommendations": ["array de recomendaciones"],
+    "risks": ["array de riesgos potenciales"]
+}
+
+# Se serializa UNA sola vez al importar el módulo
+BASE_ANALYSIS_SCHEMA_JSON = compact_json(BASE_ANALYSIS_SCHEMA)
+
+def _render_analysis_prompt(analysis_level: str, user_goal: str) -> str:
+    """Arma el prompt completo según nivel de análisis (se usa para precompilar plantillas)"""
     
     if analysis_level == AnalysisLevel.BASIC.value:
         return f"""
@@ -92,7 +118,7 @@ Genera un JSON con análisis BÁSICO:
 OBJETIVO DEL USUARIO: {user_goal}
 
 Genera un JSON COMPLETO con análisis EXPERTO:
-{json.dumps(base_schema, indent=2)}
+{BASE_ANALYSIS_SCHEMA_JSON}
 
 INCLUYE ADEMÁS:
 - "data_distribution": Análisis de distribución de datos
@@ -110,211 +136,483 @@ INCLUYE ADEMÁS:
 OBJETIVO DEL USUARIO: {user_goal}
 
 Genera un JSON con análisis {'AVANZADO' if analysis_level == AnalysisLevel.ADVANCED.value else 'ESTÁNDAR'}:
-{json.dumps(base_schema, indent=2)}
+{BASE_ANALYSIS_SCHEMA_JSON}
 """
 
-# ==================== FUNCIONES PRINCIPALES ====================
+# Plantillas precompiladas por nivel: (texto antes del objetivo, texto después).
+# En cada petición solo se concatena el objetivo del usuario.
+_USER_GOAL_SLOT = "\x00user_goal\x00"
 
-def analyze_file_with_gemini(
-    file_bytes: bytes, 
-    mime_type: str, 
-    user_prompt: str,
-    model_name: str = GeminiModel.FLASH_2_5.value,
-    analysis_level: str = AnalysisLevel.STANDARD.value
-) -> Dict[str, Any]:
+ANALYSIS_PROMPT_TEMPLATES: Dict[str, Tuple[str, str]] = {
+    level.value: tuple(_render_analysis_prompt(level.value, _USER_GOAL_SLOT).split(_USER_GOAL_SLOT))
+    for level in AnalysisLevel
+}
+
+def get_analysis_prompt(analysis_level: str, user_goal: str) -> str:
+    """Genera prompt según nivel de análisis"""
+    prefix, suffix = ANALYSIS_PROMPT_TEMPLATES.get(
+        analysis_level, ANALYSIS_PROMPT_TEMPLATES[AnalysisLevel.STANDARD.value]
+    )
+    return prefix + user_goal + suffix
+
+# ==================== REGISTRO DE MODELOS ====================
+
+FILE_ANALYSIS_CONFIG = {
+    "response_mime_type": "application/json",
+    "temperature": 0.2,  # Más determinístico para análisis
+    "top_p": 0.8,
+    "top_k": 40
+}
+
+JSON_DATASET_CONFIG = {
+    "response_mime_type": "application/json",
+    "temperature": 0.1
+}
+
+JSON_RESPONSE_CONFIG = {"response_mime_type": "application/json"}
+
+_model_registry: Dict[Tuple[str, Tuple], genai.GenerativeModel] = {}
+_model_registry_lock = threading.Lock()
+# id(model) -> (nombre, configuración), para presupuestos y reroute
+_model_specs: Dict[int, Tuple[str, Optional[Dict[str, Any]]]] = {}
+
+def get_model(model_name: str, generation_config: Optional[Dict[str, Any]] = None) -> genai.GenerativeModel:
     """
-    Analiza archivos usando Gemini con configuración avanzada.
-    
-    Args:
-        file_bytes: Bytes del archivo
-        mime_type: Tipo MIME del archivo
-        user_prompt: Objetivo del usuario
-        model_name: Modelo de Gemini a usar
-        analysis_level: Nivel de profundidad del análisis
+    Devuelve un GenerativeModel reutilizable.
+
+    Se construye una sola vez por (modelo, configuración de generación) y se
+    comparte entre peticiones en lugar de crear uno nuevo en cada llamada.
+    """
+    key = (model_name, tuple(sorted((generation_config or {}).items())))
+    model = _model_registry.get(key)
+    if model is None:
+        with _model_registry_lock:
+            model = _model_registry.get(key)
+            if model is None:
+                model = genai.GenerativeModel(model_name, generation_config=generation_config)
+                _model_registry[key] = model
+                _model_specs[id(model)] = (model_name, generation_config)
+    return model
+
+# ==================== PRESUPUESTO DE TOKENS ====================
+
+_PROMPT_RESERVE_TOKENS = 4000
+
+def _embed(value: Any, model_name: str) -> str:
+    """
+    Serializa datos para incrustarlos en un prompt (JSON compacto).
+
+    Con TOKEN_BUDGET_POLICY=sample, si los datos no entran en el presupuesto del
+    modelo se muestrean sus listas más largas en lugar de rechazar la petición.
+    """
+    budget = budget_for(model_name)
+    if TOKEN_BUDGET_POLICY == "sample" and estimate_tokens(value) > budget:
+        # Se reserva espacio para las instrucciones y el esquema del prompt
+        value = sample_to_budget(value, max(budget // 2, budget - _PROMPT_RESERVE_TOKENS))
+    return compact_json(value)
+
+def _apply_budget(model: genai.GenerativeModel, contents: Any) -> Tuple[genai.GenerativeModel, Any, int, Optional[str]]:
+    """
+    Estima los tokens antes de llamar y aplica la política si se pasa del
+    presupuesto: truncar, cambiar a un modelo con más contexto o rechazar.
+    """
+    model_name, generation_config = _model_specs.get(id(model), (getattr(model, "model_name", ""), None))
+    model_name = model_name.replace("models/", "")
+    estimated = estimate_request_tokens(contents)
+    budget = budget_for(model_name)
+    if estimated <= budget:
+        return model, contents, estimated, None
+
+    if TOKEN_BUDGET_POLICY == "truncate":
+        contents = truncate_contents(contents, budget)
+        truncated = estimate_request_tokens(contents)
+        if truncated <= budget:
+            return model, contents, truncated, "truncated"
+    elif TOKEN_BUDGET_POLICY == "reroute":
+        target = model_for_budget(estimated, exclude=model_name)
+        if target is not None:
+            return get_model(target, generation_config), contents, estimated, f"rerouted:{target}"
+    raise TokenBudgetExceeded(model_name, estimated, budget)
+
+def _model_label(model: genai.GenerativeModel) -> str:
+    return _model_specs.get(id(model), (getattr(model, "model_name", ""),))[0]
+
+# ==================== ARCHIVOS GRANDES (FILE API) ====================
+
+# Por encima de este tamaño el archivo se sube con la File API en lugar de ir
+# inline en la petición (Gemini limita la petición inline a 20 MB)
+GEMINI_FILE_API_THRESHOLD = int(os.getenv("GEMINI_FILE_API_THRESHOLD", str(16 * 1024 * 1024)))
+FILE_API_POLL_SECONDS = float(os.getenv("GEMINI_FILE_API_POLL_SECONDS", "2"))
+# Espera máxima a que la File API termine de procesar un archivo subido
+FILE_API_MAX_WAIT_SECONDS = float(os.getenv("GEMINI_FILE_API_MAX_WAIT", "600"))
+
+def _is_file_ref(part: Any) -> bool:
+    return isinstance(part, dict) and isinstance(part.get("data"), os.PathLike)
+
+def _has_file_refs(contents: Any) -> bool:
+    return isinstance(contents, list) and any(_is_file_ref(part) for part in contents)
+
+def _upload_file_part(part: Dict[str, Any]):
+    """
+    Sube el archivo y espera a que quede ACTIVE. Si falla o sigue procesándose
+    pasado FILE_API_MAX_WAIT_SECONDS lanza un error y borra lo subido.
     """
+    uploaded = genai.upload_file(os.fspath(part["data"]), mime_type=part["mime_type"])
+    deadline = time.monotonic() + FILE_API_MAX_WAIT_SECONDS
     try:
-        model = genai.GenerativeModel(
-            model_name,
-            generation_config={
-                "response_mime_type": "application/json",
-                "temperature": 0.2,  # Más determinístico para análisis
-                "top_p": 0.8,
-                "top_k": 40
-            }
-        )
+        while uploaded.state.name == "PROCESSING":
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(
+                    f"{uploaded.name} sigue en procesamiento tras {FILE_API_MAX_WAIT_SECONDS:g} s"
+                )
+            time.sleep(min(FILE_API_POLL_SECONDS, remaining))
+            uploaded = genai.get_file(uploaded.name)
+        if uploaded.state.name != "ACTIVE":
+            raise ValueError(f"La File API no pudo procesar el archivo ({uploaded.name}: {uploaded.state.name})")
+    except Exception:
+        _delete_uploaded([uploaded])
+        raise
+    return uploaded
 
-        file_part = {
-            "mime_type": mime_type,
-            "data": file_bytes
-        }
-
-        prompt = get_analysis_prompt(analysis_level, user_prompt)
-        response = model.generate_content([prompt, file_part])
-        
-        result = json.loads(response.text)
-        result["model_used"] = model_name
-        result["analysis_level"] = analysis_level
-        
-        return result
+def _resolve_file_parts(contents: Any) -> Tuple[Any, List[Any]]:
+    """
+    Convierte las partes `{"mime_type", "data": <archivo en disco>}` justo antes
+    de llamar: inline si son pequeñas, subidas por la File API si no.
 
-    except Exception as e:
-        print(f"❌ Error en Gemini: {e}")
-        return {
-            "error": str(e), 
-            "status": "failed",
-            "model_used": model_name
-        }
+    Devuelve el contenido listo y los archivos subidos (para borrarlos después).
+    """
+    if not _has_file_refs(contents):
+        return contents, []
+    resolved: List[Any] = []
+    uploaded: List[Any] = []
+    try:
+        for part in contents:
+            if _is_file_ref(part):
+                if data_size(part["data"]) > GEMINI_FILE_API_THRESHOLD:
+                    part = _upload_file_part(part)
+                    uploaded.append(part)
+                else:
+                    part = {"mime_type": part["mime_type"], "data": read_data(part["data"])}
+            resolved.append(part)
+    except Exception:
+        _delete_uploaded(uploaded)
+        raise
+    return resolved, uploaded
 
-def analyze_json_dataset(
-    json_data: Dict[str, Any],
-    user_prompt: str,
-    model_name: str = GeminiModel.PRO_2_5.value
-) -> Dict[str, Any]:
+def _delete_uploaded(uploaded: List[Any]) -> None:
+    for file in uploaded:
+        try:
+            genai.delete_file(file.name)
+        except Exception as e:
+            print(f"⚠️ No se pudo borrar {file.name} de la File API: {e}")
+
+# ==================== LLAMADAS AL MODELO ====================
+# Todas las llamadas pasan por el planificador (scheduler_service): esperan turno
+# según la cuota del modelo y la prioridad de la petición. Un 429 no se devuelve al
+# cliente: pausa el modelo y la llamada vuelve a la cola.
+# Por encima, resilience_service pone plazo a cada intento, reintenta los errores
+# transitorios y, si el circuito del modelo está abierto, usa un modelo alternativo.
+
+def _variant(model: genai.GenerativeModel, model_name: str) -> genai.GenerativeModel:
+    """`model` con otro nombre de modelo y la misma configuración (para el fallback)."""
+    if _model_label(model).replace("models/", "") == model_name:
+        return model
+    return get_model(model_name, _model_specs.get(id(model), ("", None))[1])
+
+def _fallback_action(action: Optional[str], requested: str, used: str) -> Optional[str]:
+    return action if used == requested else (action or f"fallback:{used}")
+
+def _served_by(model_name: str) -> Callable[[Any], bool]:
     """
-    Analiza datasets en formato JSON usando Gemini Pro para lógica compleja.
-    
-    Perfecto para: datasets estructurados, configuraciones, resultados de API
+    Predicado de caché: solo se guarda lo que respondió el modelo pedido. Un
+    resultado de fallback o reroute no debe quedar bajo la clave de `model_name`.
+    """
+    return lambda value: "error" not in value and value.get("model_used") == model_name
+
+def _prompt_tokens(response: Any) -> Optional[int]:
+    return getattr(getattr(response, "usage_metadata", None), "prompt_token_count", None)
+
+def _scheduled(model: genai.GenerativeModel, estimated: int, call: Callable[[], Any]) -> Any:
+    if not SCHEDULER_ENABLED:
+        return call()
+    model_name = _model_label(model).replace("models/", "")
+    for attempt in range(SCHEDULER_429_RETRIES + 1):
+        with gemini_scheduler.acquire(model_name, estimated) as permit:
+            try:
+                response = call()
+            except ResourceExhausted:
+                if attempt == SCHEDULER_429_RETRIES:
+                    raise
+                gemini_scheduler.rate_limited(model_name)
+                continue
+            permit.settle(_prompt_tokens(response))
+            return response
+
+async def _scheduled_async(model: genai.GenerativeModel, estimated: int, call: Callable[[], Awaitable[Any]]) -> Any:
+    if not SCHEDULER_ENABLED:
+        return await call()
+    model_name = _model_label(model).replace("models/", "")
+    for attempt in range(SCHEDULER_429_RETRIES + 1):
+        async with gemini_scheduler.acquire_async(model_name, estimated) as permit:
+            try:
+                response = await call()
+            except ResourceExhausted:
+                if attempt == SCHEDULER_429_RETRIES:
+                    raise
+                gemini_scheduler.rate_limited(model_name)
+                continue
+            permit.settle(_prompt_tokens(response))
+            return response
+
+def _generate(model: genai.GenerativeModel, contents: Any) -> Tuple[str, Any]:
+    """
+    Punto único de llamada SÍNCRONA a Gemini.
+
+    Devuelve `(modelo que respondió, respuesta)`: por el fallback o el reroute
+    puede no ser el modelo pedido.
     """
+    model, contents, estimated, action = _apply_budget(model, contents)
+    contents, uploaded = _resolve_file_parts(contents)
+    requested = _model_label(model).replace("models/", "")
+
+    def attempt(model_name: str, timeout: float) -> Any:
+        target = _variant(model, model_name)
+        return _scheduled(target, estimated, lambda: target.generate_content(contents, request_options={"timeout": timeout}))
+
     try:
-        model = genai.GenerativeModel(
-            model_name,
-            generation_config={
-                "response_mime_type": "application/json",
-                "temperature": 0.1
-            }
-        )
+        used, response = call_with_resilience(requested, attempt)
+    finally:
+        if uploaded:
+            _delete_uploaded(uploaded)
+    record_usage(used, estimated, response, _fallback_action(action, requested, used))
+    return used, response
 
-        prompt = f"""
-{EXPERT_SYSTEM_PROMPT}
+async def _generate_async(model: genai.GenerativeModel, contents: Any) -> Tuple[str, Any]:
+    """
+    Punto único de llamada ASÍNCRONA a Gemini.
 
-OBJETIVO: {user_prompt}
+    No bloquea el event loop: un solo worker puede mantener muchas
+    llamadas en vuelo mientras sigue atendiendo /health, /speak, etc.
+    La estimación de tokens abre PDFs/imágenes con Pillow, así que
+    también corre en un hilo. Devuelve lo mismo que `_generate`.
+    """
+    model, contents, estimated, action = await asyncio.to_thread(_apply_budget, model, contents)
+    if _has_file_refs(contents):
+        contents, uploaded = await asyncio.to_thread(_resolve_file_parts, contents)
+    else:
+        uploaded = []
+    requested = _model_label(model).replace("models/", "")
 
-DATOS JSON A ANALIZAR:
-{json.dumps(json_data, indent=2)}
+    async def attempt(model_name: str, timeout: float) -> Any:
+        target = _variant(model, model_name)
+        return await _scheduled_async(target, estimated, lambda: asyncio.wait_for(
+            target.generate_content_async(contents, request_options={"timeout": timeout}), timeout
+        ))
 
-Genera un análisis PROFUNDO del JSON incluyendo:
-{{
-    "data_structure": {{
-        "schema_valid": true/false,
-        "fields_count": number,
-        "nested_levels": number,
-        "data_types": {{"field": "type"}}
-    }},
-    "data_quality": {{
-        "completeness": 0-100,
-        "consistency_score": 0-100,
-        "missing_values": {{"field": count}},
-        "duplicates": number,
-        "outliers_detected": boolean
-    }},
-    "statistical_analysis": {{
-        "numeric_fields": [{{"field": "name", "mean": 0, "std": 0, "min": 0, "max": 0}}],
-        "categorical_fields": [{{"field": "name", "unique_values": 0, "most_common": ""}}]
-    }},
-    "biases": {{
+    try:
+        used, response = await call_with_resilience_async(requested, attempt)
+    finally:
+        if uploaded:
+            await asyncio.to_thread(_delete_uploaded, uploaded)
+    record_usage(used, estimated, response, _fallback_action(action, requested, used))
+    return used, response
+
+# ==================== CONSTRUCCIÓN DE PETICIONES ====================
+# Cada función pública tiene versión síncrona y asíncrona (sufijo `_async`).
+# Ambas comparten el armado del modelo/prompt y el parseo de la respuesta.
+
+def _file_analysis_request(
+    file_bytes: FileData,
+    mime_type: str,
+    user_prompt: str,
+    model_name: str,
+    analysis_level: str
+) -> Tuple[genai.GenerativeModel, List[Any]]:
+    model = get_model(model_name, FILE_ANALYSIS_CONFIG)
+
+    file_part = {
+        "mime_type": mime_type,
+        "data": file_bytes
+    }
+
+    prompt = get_analysis_prompt(analysis_level, user_prompt)
+    return model, [prompt, file_part]
+
+def _file_analysis_result(response, model_used: str, analysis_level: str) -> Dict[str, Any]:
+    result = json.loads(response.text)
+    result["model_used"] = model_used
+    result["analysis_level"] = analysis_level
+    return result
+
+def _file_analysis_error(e: Exception, model_name: str) -> Dict[str, Any]:
+    print(f"❌ Error en Gemini: {e}")
+    return {
+        "error": str(e),
+        "status": "failed",
+        "model_used": model_name
+    }
+
+JSON_INSIGHTS_SCHEMA = """{
+    "biases": {
         "detected": boolean,
         "types": ["temporal", "selection", "sampling"],
         "severity": "Bajo/Medio/Alto",
         "recommendations": ["acciones correctivas"]
-    }},
-    "ml_readiness": {{
+    },
+    "ml_readiness": {
         "usable_for_training": boolean,
         "usability_score": 0-100,
         "preprocessing_needed": ["steps"],
         "feature_engineering_suggestions": ["suggestions"]
-    }},
+    },
     "recommendations": ["Lista de recomendaciones priorizadas"],
     "summary": "Resumen ejecutivo"
-}}
-"""
+}"""
 
-        response = model.generate_content(prompt)
-        result = json.loads(response.text)
-        result["model_used"] = model_name
-        result["dataset_size"] = len(str(json_data))
-        
-        return result
-
-    except Exception as e:
-        return {"error": str(e), "status": "failed"}
+def _json_dataset_request(
+    profile: Dict[str, Any],
+    user_prompt: str,
+    model_name: str,
+    part: Optional[Tuple[int, int]] = None
+) -> Tuple[genai.GenerativeModel, str]:
+    model = get_model(model_name, JSON_DATASET_CONFIG)
 
-def compare_datasets(
-    datasets: List[Dict[str, Any]],
-    comparison_criteria: str,
-    model_name: str = GeminiModel.PRO_2_5.value
-) -> Dict[str, Any]:
-    """
-    Compara múltiples datasets y genera recomendaciones.
-    
-    Útil para: seleccionar el mejor dataset, identificar complementariedades
-    """
-    try:
-        model = genai.GenerativeModel(
-            model_name,
-            generation_config={"response_mime_type": "application/json"}
+    # Solo el perfil calculado localmente + una muestra pequeña, nunca el dataset completo
+    sample = profile["sample"]
+    summary = {key: value for key, value in profile.items() if key != "sample"}
+    part_note = ""
+    if part is not None:
+        part_note = (
+            f"\nPARTE {part[0] + 1} DE {part[1]}: el perfil solo incluye un subconjunto de los campos. "
+            "Analiza únicamente estos campos; los resultados parciales se combinarán después.\n"
         )
+    prompt = f"""
+{EXPERT_SYSTEM_PROMPT}
 
-        prompt = f"""
-Eres un experto en Data Science. Compara estos datasets según: {comparison_criteria}
+OBJETIVO: {user_prompt}
+{part_note}
+PERFIL DEL DATASET (calculado localmente sobre TODOS los registros; las cifras son exactas
+salvo donde se indica "approximate"/"*_exact": false):
+{compact_json(summary)}
 
-DATASETS:
-{json.dumps(datasets, indent=2)}
+MUESTRA REPRESENTATIVA ({len(sample)} de {profile["records"]} registros):
+{compact_json(sample)}
 
-Genera:
-{{
+No recalcules estructura, calidad ni estadísticas: ya están en el perfil. Interprétalas y genera:
+{JSON_INSIGHTS_SCHEMA}
+"""
+    return model, prompt
+
+def _json_dataset_chunks(profile: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Sub-perfiles por grupos de campos si el perfil no entra en una sola llamada (None si entra)."""
+    if estimate_tokens(profile) <= MAPREDUCE_CHUNK_TOKENS:
+        return None
+    header = {key: value for key, value in profile.items() if key not in ("fields", "sample")}
+    chunks = pack_chunks(list(profile["fields"].items()))
+    return [
+        # La muestra va solo en la primera parte
+        {**header, "fields": dict(item for _, item in chunk), "sample": profile["sample"] if position == 0 else []}
+        for position, chunk in enumerate(chunks)
+    ]
+
+def _json_dataset_result(result: Dict[str, Any], profile: Dict[str, Any], served: List[str]) -> Dict[str, Any]:
+    # Las secciones numéricas vienen del perfil local, no del modelo
+    result.update(profile_report_sections(profile))
+    # Con map-reduce pueden haber respondido varios modelos (fallback en alguna parte)
+    result["model_used"] = ", ".join(dict.fromkeys(served))
+    result["dataset_size"] = profile["approx_bytes"]
+    result["records"] = profile["records"]
+    result["profile"] = {key: value for key, value in profile.items() if key != "sample"}
+    return result
+
+COMPARE_SCHEMA = """{
     "overall_ranking": [
-        {{"dataset_index": 0, "score": 0-100, "reason": "string"}}
+        {"dataset_index": 0, "score": 0-100, "reason": "string"}
     ],
-    "comparison_matrix": {{
-        "quality": [{{"dataset": 0, "score": 0-100}}],
-        "bias_level": [{{"dataset": 0, "score": 0-100}}],
-        "usability": [{{"dataset": 0, "score": 0-100}}]
-    }},
-    "best_for_training": {{
+    "comparison_matrix": {
+        "quality": [{"dataset": 0, "score": 0-100}],
+        "bias_level": [{"dataset": 0, "score": 0-100}],
+        "usability": [{"dataset": 0, "score": 0-100}]
+    },
+    "best_for_training": {
         "dataset_index": 0,
         "confidence": 0-100,
         "reasons": ["razones"]
-    }},
-    "combination_strategy": {{
+    },
+    "combination_strategy": {
         "should_combine": boolean,
         "datasets_to_combine": [0, 1],
         "combination_method": "string",
         "expected_improvement": "percentage"
-    }},
+    },
     "summary": "Resumen ejecutivo"
-}}
+}"""
+
+def _compare_request(
+    datasets: List[Dict[str, Any]],
+    comparison_criteria: str,
+    model_name: str
+) -> Tuple[genai.GenerativeModel, str]:
+    model = get_model(model_name, JSON_RESPONSE_CONFIG)
+
+    prompt = f"""
+Eres un experto en Data Science. Compara estos datasets según: {comparison_criteria}
+
+DATASETS:
+{_embed(datasets, model_name)}
+
+Genera:
+{COMPARE_SCHEMA}
 """
+    return model, prompt
 
-        response = model.generate_content(prompt)
-        return json.loads(response.text)
+def _compare_chunk_request(
+    chunk: List[Tuple[int, Any]],
+    comparison_criteria: str,
+    model_name: str,
+    position: int,
+    total: int
+) -> Tuple[genai.GenerativeModel, str]:
+    model = get_model(model_name, JSON_RESPONSE_CONFIG)
+    datasets = {str(index): dataset for index, dataset in chunk}
 
-    except Exception as e:
-        return {"error": str(e), "status": "failed"}
+    prompt = f"""
+Eres un experto en Data Science. Compara estos datasets según: {comparison_criteria}
 
-def generate_synthetic_data_plan(
+PARTE {position + 1} DE {total}: solo se incluye un subconjunto de los datasets. Las claves son el
+`dataset_index` global; úsalas tal cual. Los resultados parciales se combinarán después.
+
+DATASETS:
+{_embed(datasets, model_name)}
+
+Genera:
+{COMPARE_SCHEMA}
+"""
+    return model, prompt
+
+def _compare_item(dataset: Any) -> Any:
+    """Un dataset que por sí solo no entra en una llamada se reemplaza por su perfil local."""
+    if estimate_tokens(dataset) <= MAPREDUCE_CHUNK_TOKENS:
+        return dataset
+    profile = profile_json(dataset)
+    return {"local_profile": {key: value for key, value in profile.items() if key != "sample"}}
+
+def _synthetic_plan_request(
     original_data_summary: Dict[str, Any],
     target_improvements: List[str],
-    model_name: str = GeminiModel.PRO_2_5.value
-) -> Dict[str, Any]:
-    """
-    Genera un plan para crear datos sintéticos que mejoren el dataset.
-    
-    Útil para: aumentar diversidad, balancear clases, reducir sesgos
-    """
-    try:
-        model = genai.GenerativeModel(
-            model_name,
-            generation_config={"response_mime_type": "application/json"}
-        )
+    model_name: str
+) -> Tuple[genai.GenerativeModel, str]:
+    model = get_model(model_name, JSON_RESPONSE_CONFIG)
 
-        prompt = f"""
+    prompt = f"""
 Eres un experto en Synthetic Data Generation y Data Augmentation.
 
 DATOS ORIGINALES:
-{json.dumps(original_data_summary, indent=2)}
+{_embed(original_data_summary, model_name)}
 
 MEJORAS OBJETIVO:
-{json.dumps(target_improvements, indent=2)}
+{compact_json(target_improvements)}
 
 Genera un PLAN DETALLADO:
 {{
@@ -347,33 +645,19 @@ Genera un PLAN DETALLADO:
     }}
 }}
 """
+    return model, prompt
 
-        response = model.generate_content(prompt)
-        return json.loads(response.text)
-
-    except Exception as e:
-        return {"error": str(e), "status": "failed"}
-
-def analyze_bias_detailed(
-    file_bytes: bytes,
+def _bias_request(
+    file_bytes: FileData,
     mime_type: str,
     focus_areas: List[str],
-    model_name: str = GeminiModel.PRO_2_5.value
-) -> Dict[str, Any]:
-    """
-    Análisis PROFUNDO de sesgos con recomendaciones específicas.
-    
-    focus_areas: ["gender", "race", "age", "geographic", "temporal", "selection"]
-    """
-    try:
-        model = genai.GenerativeModel(
-            model_name,
-            generation_config={"response_mime_type": "application/json"}
-        )
+    model_name: str
+) -> Tuple[genai.GenerativeModel, List[Any]]:
+    model = get_model(model_name, JSON_RESPONSE_CONFIG)
 
-        file_part = {"mime_type": mime_type, "data": file_bytes}
+    file_part = {"mime_type": mime_type, "data": file_bytes}
 
-        prompt = f"""
+    prompt = f"""
 Eres un experto en Fairness in AI y Bias Detection.
 
 ÁREAS DE ENFOQUE: {', '.join(focus_areas)}
@@ -434,122 +718,758 @@ Analiza EXHAUSTIVAMENTE los sesgos en este archivo:
     "summary": "Resumen ejecutivo de sesgos"
 }}
 """
+    return model, [prompt, file_part]
 
-        response = model.generate_content([prompt, file_part])
-        return json.loads(response.text)
-
-    except Exception as e:
-        return {"error": str(e), "status": "failed"}
-
-def generate_data_quality_report(
-    analysis_results: List[Dict[str, Any]],
-    model_name: str = GeminiModel.PRO_2_5.value
-) -> Dict[str, Any]:
-    """
-    Genera un reporte ejecutivo consolidado de múltiples análisis.
-    """
-    try:
-        model = genai.GenerativeModel(
-            model_name,
-            generation_config={"response_mime_type": "application/json"}
-        )
-
-        prompt = f"""
-Eres un Data Science Manager. Genera un REPORTE EJECUTIVO consolidado.
-
-ANÁLISIS INDIVIDUALES:
-{json.dumps(analysis_results, indent=2)}
-
-Genera:
-{{
+REPORT_SCHEMA = """{
     "executive_summary": "Resumen de 3-5 líneas",
     "key_findings": [
-        {{"finding": "string", "impact": "Alto/Medio/Bajo", "action_required": boolean}}
+        {"finding": "string", "impact": "Alto/Medio/Bajo", "action_required": boolean}
     ],
     "overall_quality_score": 0-100,
     "overall_usability_score": 0-100,
     "critical_issues": [
-        {{"issue": "string", "severity": "Crítico/Alto", "recommendation": "string"}}
+        {"issue": "string", "severity": "Crítico/Alto", "recommendation": "string"}
     ],
-    "dataset_statistics": {{
+    "dataset_statistics": {
         "total_files": number,
         "usable_for_training": number,
         "requires_preprocessing": number,
         "rejected": number
-    }},
-    "bias_summary": {{
+    },
+    "bias_summary": {
         "files_with_bias": number,
         "bias_types_found": ["tipos"],
         "average_severity": "string"
-    }},
-    "recommendations": {{
+    },
+    "recommendations": {
         "immediate": ["acciones urgentes"],
         "short_term": ["acciones 1-2 semanas"],
         "long_term": ["acciones estratégicas"]
-    }},
+    },
     "next_steps": [
-        {{"step": 1, "action": "string", "priority": "Alta/Media/Baja"}}
+        {"step": 1, "action": "string", "priority": "Alta/Media/Baja"}
     ],
     "estimated_timeline": "string",
     "estimated_cost_savings": "string (opcional)"
-}}
+}"""
+
+def _report_request(
+    analysis_results: List[Dict[str, Any]],
+    model_name: str,
+    part: Optional[Tuple[int, int]] = None
+) -> Tuple[genai.GenerativeModel, str]:
+    model = get_model(model_name, JSON_RESPONSE_CONFIG)
+
+    part_note = ""
+    if part is not None:
+        part_note = (
+            f"\nPARTE {part[0] + 1} DE {part[1]}: solo se incluye un subconjunto de los análisis. "
+            "Los conteos deben referirse únicamente a estos análisis; los reportes parciales se combinarán después.\n"
+        )
+    prompt = f"""
+Eres un Data Science Manager. Genera un REPORTE EJECUTIVO consolidado.
+{part_note}
+ANÁLISIS INDIVIDUALES:
+{_embed(analysis_results, model_name)}
+
+Genera:
+{REPORT_SCHEMA}
 """
+    return model, prompt
+
+def _reduce_request(
+    partials: List[Dict[str, Any]],
+    task: str,
+    schema: str,
+    model_name: str,
+    generation_config: Dict[str, Any] = JSON_RESPONSE_CONFIG
+) -> Tuple[genai.GenerativeModel, str]:
+    model = get_model(model_name, generation_config)
+
+    prompt = f"""
+Eres un experto en Data Science. {task}
+
+El input original era demasiado grande y se analizó por partes. Resultados parciales:
+{compact_json(partials)}
+
+Combínalos en UN SOLO resultado que cubra todas las partes, con exactamente este esquema.
+Suma los conteos, recalcula promedios, puntajes y rankings con todas las partes y elimina
+hallazgos o recomendaciones repetidos:
+{schema}
+"""
+    return model, prompt
+
+def _call_json(request: Tuple[genai.GenerativeModel, Any], served: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Llama y parsea el JSON; si se pasa `served`, anota en él qué modelo respondió."""
+    model, contents = request
+    used, response = _generate(model, contents)
+    if served is not None:
+        served.append(used)
+    return json.loads(response.text)
+
+async def _call_json_async(request: Tuple[genai.GenerativeModel, Any], served: Optional[List[str]] = None) -> Dict[str, Any]:
+    model, contents = request
+    used, response = await _generate_async(model, contents)
+    if served is not None:
+        served.append(used)
+    return json.loads(response.text)
+
+TRANSCRIPTION_PROMPT = """
+        Eres un transcriptor experto. 
+        Transcribe el siguiente audio exactamente como se escucha. 
+        Si hay ruido o silencio, ignóralo. 
+        Devuelve SOLO el texto transcrito, sin explicaciones adicionales.
+        """
+
+def _transcription_request(audio_bytes: FileData, mime_type: str) -> Tuple[genai.GenerativeModel, List[Any]]:
+    # Usamos Flash porque es el mejor y más rápido para audio actualmente
+    model = get_model(GeminiModel.FLASH_2_5.value)
 
-        response = model.generate_content(prompt)
+    audio_part = {
+        "mime_type": mime_type,
+        "data": audio_bytes
+    }
+    return model, [TRANSCRIPTION_PROMPT, audio_part]
+
+# ==================== FUNCIONES PRINCIPALES ====================
+
+def analyze_file_with_gemini(
+    file_bytes: FileData, 
+    mime_type: str, 
+    user_prompt: str,
+    model_name: str = GeminiModel.FLASH_2_5.value,
+    analysis_level: str = AnalysisLevel.STANDARD.value,
+    use_cache: bool = True
+) -> Dict[str, Any]:
+    """
+    Analiza archivos usando Gemini con configuración avanzada.
+    
+    Args:
+        file_bytes: Bytes del archivo o ruta a él en disco (se sube por la File API si es grande)
+        mime_type: Tipo MIME del archivo
+        user_prompt: Objetivo del usuario
+        model_name: Modelo de Gemini a usar
+        analysis_level: Nivel de profundidad del análisis
+        use_cache: Si es False se ignora la caché (el resultado nuevo sí se guarda)
+    """
+    def compute() -> Dict[str, Any]:
+        try:
+            model, contents = _file_analysis_request(file_bytes, mime_type, user_prompt, model_name, analysis_level)
+            used, response = _generate(model, contents)
+            return _file_analysis_result(response, used, analysis_level)
+        except Exception as e:
+            return _file_analysis_error(e, model_name)
+
+    return cached(
+        "file_analysis", (file_bytes, mime_type, user_prompt, model_name, analysis_level),
+        compute, input_bytes=data_size(file_bytes), bypass=not use_cache, cacheable=_served_by(model_name)
+    )
+
+async def analyze_file_with_gemini_async(
+    file_bytes: FileData, 
+    mime_type: str, 
+    user_prompt: str,
+    model_name: str = GeminiModel.FLASH_2_5.value,
+    analysis_level: str = AnalysisLevel.STANDARD.value,
+    use_cache: bool = True
+) -> Dict[str, Any]:
+    """Versión asíncrona de `analyze_file_with_gemini`."""
+    async def compute() -> Dict[str, Any]:
+        try:
+            model, contents = _file_analysis_request(file_bytes, mime_type, user_prompt, model_name, analysis_level)
+            used, response = await _generate_async(model, contents)
+            return _file_analysis_result(response, used, analysis_level)
+        except Exception as e:
+            return _file_analysis_error(e, model_name)
+
+    return await cached_async(
+        "file_analysis", (file_bytes, mime_type, user_prompt, model_name, analysis_level),
+        compute, input_bytes=data_size(file_bytes), bypass=not use_cache, cacheable=_served_by(model_name)
+    )
+
+JSON_REDUCE_TASK = "Combina los análisis parciales de un mismo dataset (cada parte cubre un grupo de campos)."
+COMPARE_REDUCE_TASK = "Combina comparaciones parciales de datasets según: {criteria}."
+REPORT_REDUCE_TASK = "Combina reportes ejecutivos parciales en un único REPORTE EJECUTIVO consolidado."
+
+def _json_insights(
+    profile: Dict[str, Any],
+    user_prompt: str,
+    model_name: str,
+    served: List[str]
+) -> Dict[str, Any]:
+    parts = _json_dataset_chunks(profile)
+    if parts is None:
+        return _call_json(_json_dataset_request(profile, user_prompt, model_name), served)
+    result, stats = map_reduce(
+        pack_chunks(parts, max_items=1),
+        lambda chunk, position, total: _call_json(
+            _json_dataset_request(chunk[0][1], user_prompt, model_name, part=(position, total)), served
+        ),
+        lambda partials: _call_json(
+            _reduce_request(partials, JSON_REDUCE_TASK, JSON_INSIGHTS_SCHEMA, model_name, JSON_DATASET_CONFIG), served
+        )
+    )
+    result["map_reduce"] = stats
+    return result
+
+async def _json_insights_async(
+    profile: Dict[str, Any],
+    user_prompt: str,
+    model_name: str,
+    served: List[str]
+) -> Dict[str, Any]:
+    parts = _json_dataset_chunks(profile)
+    if parts is None:
+        return await _call_json_async(_json_dataset_request(profile, user_prompt, model_name), served)
+    result, stats = await map_reduce_async(
+        pack_chunks(parts, max_items=1),
+        lambda chunk, position, total: _call_json_async(
+            _json_dataset_request(chunk[0][1], user_prompt, model_name, part=(position, total)), served
+        ),
+        lambda partials: _call_json_async(
+            _reduce_request(partials, JSON_REDUCE_TASK, JSON_INSIGHTS_SCHEMA, model_name, JSON_DATASET_CONFIG), served
+        )
+    )
+    result["map_reduce"] = stats
+    return result
+
+def analyze_json_dataset(
+    json_data: Dict[str, Any],
+    user_prompt: str,
+    model_name: str = GeminiModel.PRO_2_5.value,
+    use_cache: bool = True
+) -> Dict[str, Any]:
+    """
+    Analiza datasets en formato JSON usando Gemini Pro para lógica compleja.
+
+    Las estadísticas se calculan localmente (`profile_service`) y el modelo solo
+    recibe el perfil y una muestra.
+    
+    Perfecto para: datasets estructurados, configuraciones, resultados de API
+    """
+    def compute() -> Dict[str, Any]:
+        try:
+            profile = profile_json(json_data)
+            served: List[str] = []
+            return _json_dataset_result(_json_insights(profile, user_prompt, model_name, served), profile, served)
+        except Exception as e:
+            return {"error": str(e), "status": "failed"}
+
+    return cached(
+        "json_dataset", (json_data, user_prompt, model_name),
+        compute, input_bytes=len(str(json_data)), bypass=not use_cache, cacheable=_served_by(model_name)
+    )
+
+async def analyze_json_dataset_async(
+    json_data: Dict[str, Any],
+    user_prompt: str,
+    model_name: str = GeminiModel.PRO_2_5.value,
+    use_cache: bool = True
+) -> Dict[str, Any]:
+    """Versión asíncrona de `analyze_json_dataset`."""
+    async def compute() -> Dict[str, Any]:
+        try:
+            profile = await asyncio.to_thread(profile_json, json_data)
+            served: List[str] = []
+            insights = await _json_insights_async(profile, user_prompt, model_name, served)
+            return _json_dataset_result(insights, profile, served)
+        except Exception as e:
+            return {"error": str(e), "status": "failed"}
+
+    return await cached_async(
+        "json_dataset", (json_data, user_prompt, model_name),
+        compute, input_bytes=len(str(json_data)), bypass=not use_cache, cacheable=_served_by(model_name)
+    )
+
+def analyze_json_file(
+    stream: IO[bytes],
+    user_prompt: str,
+    model_name: str = GeminiModel.PRO_2_5.value,
+    use_cache: bool = True
+) -> Dict[str, Any]:
+    """
+    Igual que `analyze_json_dataset`, pero lee un archivo JSON/NDJSON en streaming.
+
+    Pensado para datasets grandes (millones de registros): nunca se carga el
+    archivo completo en memoria. La caché se indexa por el SHA-256 del archivo.
+    """
+    digest, size = digest_stream(stream)
+
+    def compute() -> Dict[str, Any]:
+        try:
+            profile = profile_records(iter_json_records(stream))
+            served: List[str] = []
+            return _json_dataset_result(_json_insights(profile, user_prompt, model_name, served), profile, served)
+        except Exception as e:
+            return {"error": str(e), "status": "failed"}
+
+    return cached(
+        "json_dataset_file", (digest, user_prompt, model_name),
+        compute, input_bytes=size, bypass=not use_cache, cacheable=_served_by(model_name)
+    )
+
+async def analyze_json_file_async(
+    stream: IO[bytes],
+    user_prompt: str,
+    model_name: str = GeminiModel.PRO_2_5.value,
+    use_cache: bool = True
+) -> Dict[str, Any]:
+    """Versión asíncrona de `analyze_json_file`."""
+    digest, size = await asyncio.to_thread(digest_stream, stream)
+
+    async def compute() -> Dict[str, Any]:
+        try:
+            profile = await asyncio.to_thread(profile_records, iter_json_records(stream))
+            served: List[str] = []
+            insights = await _json_insights_async(profile, user_prompt, model_name, served)
+            return _json_dataset_result(insights, profile, served)
+        except Exception as e:
+            return {"error": str(e), "status": "failed"}
+
+    return await cached_async(
+        "json_dataset_file", (digest, user_prompt, model_name),
+        compute, input_bytes=size, bypass=not use_cache, cacheable=_served_by(model_name)
+    )
+
+def compare_datasets(
+    datasets: List[Dict[str, Any]],
+    comparison_criteria: str,
+    model_name: str = GeminiModel.PRO_2_5.value
+) -> Dict[str, Any]:
+    """
+    Compara múltiples datasets y genera recomendaciones.
+    
+    Útil para: seleccionar el mejor dataset, identificar complementariedades.
+    Si los datasets no entran en una sola llamada se comparan por partes (map-reduce).
+    """
+    try:
+        if estimate_tokens(datasets) <= MAPREDUCE_CHUNK_TOKENS:
+            model, prompt = _compare_request(datasets, comparison_criteria, model_name)
+            _, response = _generate(model, prompt)
+            return json.loads(response.text)
+        result, stats = map_reduce(
+            pack_chunks([_compare_item(dataset) for dataset in datasets]),
+            lambda chunk, position, total: _call_json(
+                _compare_chunk_request(chunk, comparison_criteria, model_name, position, total)
+            ),
+            lambda partials: _call_json(_reduce_request(
+                partials, COMPARE_REDUCE_TASK.format(criteria=comparison_criteria), COMPARE_SCHEMA, model_name
+            ))
+        )
+        result["map_reduce"] = stats
+        return result
+    except Exception as e:
+        return {"error": str(e), "status": "failed"}
+
+async def compare_datasets_async(
+    datasets: List[Dict[str, Any]],
+    comparison_criteria: str,
+    model_name: str = GeminiModel.PRO_2_5.value
+) -> Dict[str, Any]:
+    """Versión asíncrona de `compare_datasets`."""
+    try:
+        if estimate_tokens(datasets) <= MAPREDUCE_CHUNK_TOKENS:
+            model, prompt = _compare_request(datasets, comparison_criteria, model_name)
+            _, response = await _generate_async(model, prompt)
+            return json.loads(response.text)
+        items = await asyncio.to_thread(lambda: [_compare_item(dataset) for dataset in datasets])
+        result, stats = await map_reduce_async(
+            pack_chunks(items),
+            lambda chunk, position, total: _call_json_async(
+                _compare_chunk_request(chunk, comparison_criteria, model_name, position, total)
+            ),
+            lambda partials: _call_json_async(_reduce_request(
+                partials, COMPARE_REDUCE_TASK.format(criteria=comparison_criteria), COMPARE_SCHEMA, model_name
+            ))
+        )
+        result["map_reduce"] = stats
+        return result
+    except Exception as e:
+        return {"error": str(e), "status": "failed"}
+
+def generate_synthetic_data_plan(
+    original_data_summary: Dict[str, Any],
+    target_improvements: List[str],
+    model_name: str = GeminiModel.PRO_2_5.value
+) -> Dict[str, Any]:
+    """
+    Genera un plan para crear datos sintéticos que mejoren el dataset.
+    
+    Útil para: aumentar diversidad, balancear clases, reducir sesgos
+    """
+    try:
+        model, prompt = _synthetic_plan_request(original_data_summary, target_improvements, model_name)
+        _, response = _generate(model, prompt)
+        return json.loads(response.text)
+    except Exception as e:
+        return {"error": str(e), "status": "failed"}
+
+async def generate_synthetic_data_plan_async(
+    original_data_summary: Dict[str, Any],
+    target_improvements: List[str],
+    model_name: str = GeminiModel.PRO_2_5.value
+) -> Dict[str, Any]:
+    """Versión asíncrona de `generate_synthetic_data_plan`."""
+    try:
+        model, prompt = _synthetic_plan_request(original_data_summary, target_improvements, model_name)
+        _, response = await _generate_async(model, prompt)
         return json.loads(response.text)
+    except Exception as e:
+        return {"error": str(e), "status": "failed"}
+
+def analyze_bias_detailed(
+    file_bytes: FileData,
+    mime_type: str,
+    focus_areas: List[str],
+    model_name: str = GeminiModel.PRO_2_5.value,
+    use_cache: bool = True
+) -> Dict[str, Any]:
+    """
+    Análisis PROFUNDO de sesgos con recomendaciones específicas.
+    
+    focus_areas: ["gender", "race", "age", "geographic", "temporal", "selection"]
+    """
+    def compute() -> Dict[str, Any]:
+        try:
+            model, contents = _bias_request(file_bytes, mime_type, focus_areas, model_name)
+            used, response = _generate(model, contents)
+            return {**json.loads(response.text), "model_used": used}
+        except Exception as e:
+            return {"error": str(e), "status": "failed"}
+
+    return cached(
+        "bias_detailed", (file_bytes, mime_type, focus_areas, model_name),
+        compute, input_bytes=data_size(file_bytes), bypass=not use_cache, cacheable=_served_by(model_name)
+    )
+
+async def analyze_bias_detailed_async(
+    file_bytes: FileData,
+    mime_type: str,
+    focus_areas: List[str],
+    model_name: str = GeminiModel.PRO_2_5.value,
+    use_cache: bool = True
+) -> Dict[str, Any]:
+    """Versión asíncrona de `analyze_bias_detailed`."""
+    async def compute() -> Dict[str, Any]:
+        try:
+            model, contents = _bias_request(file_bytes, mime_type, focus_areas, model_name)
+            used, response = await _generate_async(model, contents)
+            return {**json.loads(response.text), "model_used": used}
+        except Exception as e:
+            return {"error": str(e), "status": "failed"}
+
+    return await cached_async(
+        "bias_detailed", (file_bytes, mime_type, focus_areas, model_name),
+        compute, input_bytes=data_size(file_bytes), bypass=not use_cache, cacheable=_served_by(model_name)
+    )
+
+def generate_data_quality_report(
+    analysis_results: List[Dict[str, Any]],
+    model_name: str = GeminiModel.PRO_2_5.value
+) -> Dict[str, Any]:
+    """
+    Genera un reporte ejecutivo consolidado de múltiples análisis.
+
+    Con muchos análisis se generan reportes parciales y se consolidan (map-reduce).
+    """
+    try:
+        if estimate_tokens(analysis_results) <= MAPREDUCE_CHUNK_TOKENS:
+            model, prompt = _report_request(analysis_results, model_name)
+            _, response = _generate(model, prompt)
+            return json.loads(response.text)
+        result, stats = map_reduce(
+            pack_chunks(analysis_results),
+            lambda chunk, position, total: _call_json(
+                _report_request([item for _, item in chunk], model_name, part=(position, total))
+            ),
+            lambda partials: _call_json(_reduce_request(partials, REPORT_REDUCE_TASK, REPORT_SCHEMA, model_name))
+        )
+        result["map_reduce"] = stats
+        return result
+    except Exception as e:
+        return {"error": str(e), "status": "failed"}
 
+async def generate_data_quality_report_async(
+    analysis_results: List[Dict[str, Any]],
+    model_name: str = GeminiModel.PRO_2_5.value
+) -> Dict[str, Any]:
+    """Versión asíncrona de `generate_data_quality_report`."""
+    try:
+        if estimate_tokens(analysis_results) <= MAPREDUCE_CHUNK_TOKENS:
+            model, prompt = _report_request(analysis_results, model_name)
+            _, response = await _generate_async(model, prompt)
+            return json.loads(response.text)
+        result, stats = await map_reduce_async(
+            pack_chunks(analysis_results),
+            lambda chunk, position, total: _call_json_async(
+                _report_request([item for _, item in chunk], model_name, part=(position, total))
+            ),
+            lambda partials: _call_json_async(_reduce_request(partials, REPORT_REDUCE_TASK, REPORT_SCHEMA, model_name))
+        )
+        result["map_reduce"] = stats
+        return result
     except Exception as e:
         return {"error": str(e), "status": "failed"}
 
 # ==================== FUNCIONES AUXILIARES ====================
 
-def quick_analysis(file_bytes: bytes, mime_type: str, user_prompt: str) -> Dict[str, Any]:
+def quick_analysis(file_bytes: FileData, mime_type: str, user_prompt: str, use_cache: bool = True) -> Dict[str, Any]:
     """Análisis rápido con Flash 2.5 (mantiene compatibilidad con frontend actual)"""
     return analyze_file_with_gemini(
         file_bytes, 
         mime_type, 
         user_prompt,
         model_name=GeminiModel.FLASH_2_5.value,
-        analysis_level=AnalysisLevel.STANDARD.value
+        analysis_level=AnalysisLevel.STANDARD.value,
+        use_cache=use_cache
+    )
+
+async def quick_analysis_async(file_bytes: FileData, mime_type: str, user_prompt: str, use_cache: bool = True) -> Dict[str, Any]:
+    """Versión asíncrona de `quick_analysis`."""
+    return await analyze_file_with_gemini_async(
+        file_bytes, 
+        mime_type, 
+        user_prompt,
+        model_name=GeminiModel.FLASH_2_5.value,
+        analysis_level=AnalysisLevel.STANDARD.value,
+        use_cache=use_cache
     )
 
-def deep_analysis(file_bytes: bytes, mime_type: str, user_prompt: str) -> Dict[str, Any]:
+def deep_analysis(file_bytes: FileData, mime_type: str, user_prompt: str, use_cache: bool = True) -> Dict[str, Any]:
     """Análisis profundo con Pro 2.5"""
     return analyze_file_with_gemini(
         file_bytes, 
         mime_type, 
         user_prompt,
         model_name=GeminiModel.PRO_2_5.value,
-        analysis_level=AnalysisLevel.EXPERT.value
+        analysis_level=AnalysisLevel.EXPERT.value,
+        use_cache=use_cache
+    )
+
+async def deep_analysis_async(file_bytes: FileData, mime_type: str, user_prompt: str, use_cache: bool = True) -> Dict[str, Any]:
+    """Versión asíncrona de `deep_analysis`."""
+    return await analyze_file_with_gemini_async(
+        file_bytes, 
+        mime_type, 
+        user_prompt,
+        model_name=GeminiModel.PRO_2_5.value,
+        analysis_level=AnalysisLevel.EXPERT.value,
+        use_cache=use_cache
+    )
+
+# ==================== CASCADA FLASH → PRO ====================
+
+# Si es 1, /deep-analysis y /analyze-advanced usan la cascada por defecto
+CASCADE_DEFAULT = os.getenv("ANALYSIS_CASCADE", "0") == "1"
+CASCADE_MIN_CONFIDENCE = float(os.getenv("CASCADE_MIN_CONFIDENCE", "70"))
+# Puntajes dentro de esta zona gris se confirman con Pro
+CASCADE_GREY_MIN = float(os.getenv("CASCADE_GREY_MIN", "40"))
+CASCADE_GREY_MAX = float(os.getenv("CASCADE_GREY_MAX", "70"))
+
+CASCADE_CONFIDENCE_PROMPT = """
+Agrega además el campo "confidence" (0-100): qué tan seguro estás de este análisis.
+Usa valores bajos si el archivo es ambiguo, difícil de leer o está en el límite de ser útil.
+"""
+
+_SCORE_FIELDS = ("data_quality_score", "usability_score")
+
+def _is_score(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and 0 <= value <= 100
+
+def validate_analysis(result: Dict[str, Any], analysis_level: str) -> List[str]:
+    """Problemas de esquema de un resultado de análisis de archivo (lista vacía si es válido)."""
+    required = (
+        ["summary", "biases", *_SCORE_FIELDS, "usable_for_training"]
+        if analysis_level == AnalysisLevel.BASIC.value else list(BASE_ANALYSIS_SCHEMA)
+    )
+    problems = [f"falta {key}" for key in required if key not in result]
+    problems += [f"{key} fuera de 0-100" for key in _SCORE_FIELDS if key in result and not _is_score(result[key])]
+    if "usable_for_training" in result and not isinstance(result["usable_for_training"], bool):
+        problems.append("usable_for_training no es booleano")
+    if "biases" in result and not isinstance(result["biases"], dict):
+        problems.append("biases no es un objeto")
+    return problems
+
+def _cascade_escalation(result: Dict[str, Any], analysis_level: str) -> Optional[str]:
+    """Motivo para escalar a Pro, o None si el resultado de Flash es suficiente."""
+    if "error" in result:
+        return "flash_error"
+    if validate_analysis(result, analysis_level):
+        return "schema_invalid"
+    confidence = result.get("confidence")
+    if not _is_score(confidence) or confidence < CASCADE_MIN_CONFIDENCE:
+        return "low_confidence"
+    if any(CASCADE_GREY_MIN <= result[key] <= CASCADE_GREY_MAX for key in _SCORE_FIELDS):
+        return "grey_zone"
+    return None
+
+def _cascade_request(
+    file_bytes: FileData,
+    mime_type: str,
+    user_prompt: str,
+    model_name: str,
+    analysis_level: str
+) -> Tuple[genai.GenerativeModel, List[Any]]:
+    model, (prompt, file_part) = _file_analysis_request(file_bytes, mime_type, user_prompt, model_name, analysis_level)
+    return model, [prompt + CASCADE_CONFIDENCE_PROMPT, file_part]
+
+def _cascade_result(
+    result: Dict[str, Any],
+    reason: Optional[str],
+    timings: Dict[str, int],
+    escalation_error: Optional[str] = None
+) -> Dict[str, Any]:
+    # El nivel sale del modelo que respondió: si Pro cayó al fallback de Flash, no es "pro"
+    tier = "pro" if result.get("model_used") in (GeminiModel.PRO_2_5.value, GeminiModel.PRO_1_5.value) else "flash"
+    result["cascade"] = {"tier": tier, "escalated": reason is not None, "reason": reason, **timings}
+    if escalation_error:
+        result["cascade"]["escalation_error"] = escalation_error
+    return result
+
+def _cascade_cacheable(result: Dict[str, Any]) -> bool:
+    """Solo se cachea si respondió el modelo que tocaba en la cascada (sin fallback)."""
+    cascade = result.get("cascade", {})
+    expected = GeminiModel.FLASH_2_5.value
+    if cascade.get("escalated") and "escalation_error" not in cascade:
+        expected = GeminiModel.PRO_2_5.value
+    return "error" not in result and result.get("model_used") == expected
+
+def _elapsed_ms(started: float) -> int:
+    return round((time.perf_counter() - started) * 1000)
+
+def cascade_analysis(
+    file_bytes: FileData,
+    mime_type: str,
+    user_prompt: str,
+    analysis_level: str = AnalysisLevel.EXPERT.value,
+    use_cache: bool = True
+) -> Dict[str, Any]:
+    """
+    Cascada Flash → Pro: analiza primero con Flash 2.5 y solo escala a Pro 2.5
+    si la confianza es baja, algún puntaje cae en la zona gris o la salida no
+    cumple el esquema. `cascade.tier` indica qué modelo produjo el resultado
+    (según `model_used`, así que refleja un posible fallback).
+    """
+    def run(model_name: str) -> Dict[str, Any]:
+        try:
+            model, contents = _cascade_request(file_bytes, mime_type, user_prompt, model_name, analysis_level)
+            used, response = _generate(model, contents)
+            return _file_analysis_result(response, used, analysis_level)
+        except Exception as e:
+            return _file_analysis_error(e, model_name)
+
+    def compute() -> Dict[str, Any]:
+        started = time.perf_counter()
+        flash = run(GeminiModel.FLASH_2_5.value)
+        timings = {"flash_ms": _elapsed_ms(started)}
+        reason = _cascade_escalation(flash, analysis_level)
+        if reason is None:
+            return _cascade_result(flash, None, timings)
+
+        started = time.perf_counter()
+        pro = run(GeminiModel.PRO_2_5.value)
+        timings["pro_ms"] = _elapsed_ms(started)
+        if "error" in pro and "error" not in flash:
+            # Si Pro falla nos quedamos con el resultado de Flash
+            return _cascade_result(flash, reason, timings, escalation_error=pro["error"])
+        return _cascade_result(pro, reason, timings)
+
+    return cached(
+        "file_analysis_cascade", (file_bytes, mime_type, user_prompt, analysis_level),
+        compute, input_bytes=data_size(file_bytes), bypass=not use_cache, cacheable=_cascade_cacheable
+    )
+
+async def cascade_analysis_async(
+    file_bytes: FileData,
+    mime_type: str,
+    user_prompt: str,
+    analysis_level: str = AnalysisLevel.EXPERT.value,
+    use_cache: bool = True
+) -> Dict[str, Any]:
+    """Versión asíncrona de `cascade_analysis`."""
+    async def run(model_name: str) -> Dict[str, Any]:
+        try:
+            model, contents = _cascade_request(file_bytes, mime_type, user_prompt, model_name, analysis_level)
+            used, response = await _generate_async(model, contents)
+            return _file_analysis_result(response, used, analysis_level)
+        except Exception as e:
+            return _file_analysis_error(e, model_name)
+
+    async def compute() -> Dict[str, Any]:
+        started = time.perf_counter()
+        flash = await run(GeminiModel.FLASH_2_5.value)
+        timings = {"flash_ms": _elapsed_ms(started)}
+        reason = _cascade_escalation(flash, analysis_level)
+        if reason is None:
+            return _cascade_result(flash, None, timings)
+
+        started = time.perf_counter()
+        pro = await run(GeminiModel.PRO_2_5.value)
+        timings["pro_ms"] = _elapsed_ms(started)
+        if "error" in pro and "error" not in flash:
+            return _cascade_result(flash, reason, timings, escalation_error=pro["error"])
+        return _cascade_result(pro, reason, timings)
+
+    return await cached_async(
+        "file_analysis_cascade", (file_bytes, mime_type, user_prompt, analysis_level),
+        compute, input_bytes=data_size(file_bytes), bypass=not use_cache, cacheable=_cascade_cacheable
     )
-# --- AGREGA ESTO AL FINAL DE TU gemini_service.py ---
 
 def transcribe_audio_with_gemini(
-    audio_bytes: bytes, 
-    mime_type: str = "audio/mp3"
+    audio_bytes: FileData, 
+    mime_type: str = "audio/mp3",
+    use_cache: bool = True
 ) -> str:
     """
-    Transcribe audio a texto usando la capacidad multimodal de Gemini 1.5 Flash.
+    Transcribe audio a texto usando la capacidad multimodal de Gemini Flash.
+    Si Gemini falla, la excepción se propaga (y no se cachea nada).
     """
-    try:
-        # Usamos Flash 1.5 porque es el mejor y más rápido para audio actualmente
-        model = genai.GenerativeModel("gemini-2.5-flash")
-        
-        audio_part = {
-            "mime_type": mime_type,
-            "data": audio_bytes
-        }
-
-        prompt = """
-        Eres un transcriptor experto. 
-        Transcribe el siguiente audio exactamente como se escucha. 
-        Si hay ruido o silencio, ignóralo. 
-        Devuelve SOLO el texto transcrito, sin explicaciones adicionales.
-        """
+    def compute() -> str:
+        model, contents = _transcription_request(audio_bytes, mime_type)
+        _, response = _generate(model, contents)
+        return response.text.strip()
+
+    return cached(
+        "transcription", (audio_bytes, mime_type),
+        compute, input_bytes=data_size(audio_bytes), bypass=not use_cache
+    )
 
-        response = model.generate_content([prompt, audio_part])
+async def transcribe_audio_with_gemini_async(
+    audio_bytes: FileData, 
+    mime_type: str = "audio/mp3",
+    use_cache: bool = True
+) -> str:
+    """Versión asíncrona de `transcribe_audio_with_gemini`."""
+    async def compute() -> str:
+        model, contents = _transcription_request(audio_bytes, mime_type)
+        _, response = await _generate_async(model, contents)
         return response.text.strip()
 
-    except Exception as e:
-        print(f"❌ Error transcribiendo audio con Gemini: {e}")
-        return "Error al transcribir el audio."
\ No newline at end of file
+    return await cached_async(
+        "transcription", (audio_bytes, mime_type),
+        compute, input_bytes=data_size(audio_bytes), bypass=not use_cache
+    )
+
+# ==================== MICRO-BENCHMARK ====================
+
+if __name__ == "__main__":
+    # Compara el costo por petición (sin red) de armar modelo + prompt:
+    # antes (modelo nuevo y prompt renderizado en cada llamada) vs. ahora (registro + plantillas).
+    import timeit
+
+    goal = "Analiza la calidad de estos datos y detecta sesgos"
+    runs = 2000
+
+    def before():
+        genai.GenerativeModel(GeminiModel.PRO_2_5.value, generation_config=dict(FILE_ANALYSIS_CONFIG))
+        json.dumps(BASE_ANALYSIS_SCHEMA, indent=2)
+        _render_analysis_prompt(AnalysisLevel.EXPERT.value, goal)
+
+    def after():
+        get_model(GeminiModel.PRO_2_5.value, FILE_ANALYSIS_CONFIG)
+        get_analysis_prompt(AnalysisLevel.EXPERT.value, goal)
+
+    assert _render_analysis_prompt(AnalysisLevel.EXPERT.value, goal) == get_analysis_prompt(AnalysisLevel.EXPERT.value, goal)
+    for label, fn in (("antes", before), ("ahora", after)):
+        seconds = timeit.timeit(fn, number=runs)
+        print(f"{label}: {seconds / runs * 1e6:.1f} µs por petición")
@@ -1,10 +1,111 @@
+import asyncio
 import os
-import time
 import json
-from typing import Dict, Any, List, Optional
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from typing import Dict, Any, AsyncIterator, Awaitable, Callable, Iterable, Iterator, List, Optional, Tuple
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 
+from dedup_service import (
+    DEDUP_MAX_DISTANCE,
+    IMAGE_EXTENSIONS,
+    duplicate_index,
+    duplicate_report,
+    fingerprint,
+    plan_batch
+)
+from file_handle_service import FILE_PROCESSING_TIMEOUT, FileHandleCache, file_handles
+from manifest_service import MANIFEST_FILENAME, BatchManifest, iter_directory_files
+
+IMAGE_QUALITY_SCHEMA = """{
+            "resolution_analysis": {"width": int, "height": int, "aspect_ratio": str},
+            "lighting_score": int (0-100),
+            "blur_detection": bool,
+            "noise_level": str (Low/Medium/High),
+            "artifacts_detected": [str],
+            "composition": str,
+            "suitability_for_training": bool
+        }"""
+
+SOCIAL_BIAS_SCHEMA = """{
+            "demographic_breakdown": {
+                "gender_distribution": {"male": int, "female": int, "non_binary": int},
+                "age_groups": [str],
+                "ethnic_diversity_score": int (0-100)
+            },
+            "contextual_bias": {
+                "setting": str,
+                "socioeconomic_indicators": [str],
+                "cultural_markers": [str]
+            },
+            "fairness_score": int (0-100),
+            "risk_assessment": "Low/Medium/High/Critical",
+            "mitigation_suggestions": [str]
+        }"""
+
+# Cómo se piden calidad y sesgos de cada imagen en batch_process_directory:
+# separate = dos llamadas seguidas, concurrent = dos llamadas en paralelo,
+# fused = una sola llamada multimodal que devuelve ambos esquemas
+IMAGE_MODES = ("separate", "concurrent", "fused")
+
+VIDEO_EXTENSIONS = ("mp4", "mov", "avi")
+OMNI_EXTENSIONS = (*IMAGE_EXTENSIONS, "pdf", *VIDEO_EXTENSIONS)
+# Archivos analizados en paralelo por batch_process_directory
+OMNI_BATCH_WORKERS = int(os.getenv("OMNI_BATCH_WORKERS", "4"))
+# Subidas de video simultáneas (la espera del procesamiento no tiene límite)
+OMNI_VIDEO_UPLOADS = int(os.getenv("OMNI_VIDEO_UPLOADS", "4"))
+
+# Pool compartido para el modo "concurrent": el análisis de sesgos va aquí y
+# el de calidad corre en el hilo que llama, así no se crea un pool por imagen
+_image_pool = ThreadPoolExecutor(max_workers=OMNI_BATCH_WORKERS, thread_name_prefix="omni-image")
+
+VIDEO_ANALYSIS_PROMPT = """
+        Analyze this video frame by frame for dynamic data collection.
+        Return JSON:
+        {
+            "video_metadata": {"duration": str, "frame_rate": float},
+            "temporal_events": [
+                {"timestamp": str, "event_description": str, "objects_detected": [str]}
+            ],
+            "audio_transcription_summary": str,
+            "action_recognition": [str],
+            "overall_data_utility": int (0-100)
+        }
+        """
+
+class _VideoPipeline:
+    """
+    Bucle asyncio en un hilo propio: los videos de un lote se suben, esperan
+    su procesamiento y se analizan ahí mientras el pool atiende el resto.
+    """
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.futures: List[Future] = []
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, coro: Awaitable[Any]) -> None:
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+            self._thread.start()
+        self.futures.append(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    def join(self) -> None:
+        wait(self.futures)
+
+    def close(self) -> None:
+        if self.loop is None:
+            return
+        for future in self.futures:
+            future.cancel()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        self.loop = None
+
 class OptimaOmniAnalysis:
     def __init__(self, api_key: str):
         genai.configure(api_key=api_key)
@@ -22,55 +123,84 @@ class OptimaOmniAnalysis:
             "top_k": 32,
             "max_output_tokens": 4096,
         }
+        self.last_duplicate_report: Optional[Dict[str, Any]] = None
+        self.last_manifest_report: Optional[Dict[str, Any]] = None
+        # Compartida por todos los métodos (y entre ejecuciones): cada contenido se sube una vez
+        self.file_handles: FileHandleCache = file_handles
 
     def analyze_image_quality(self, image_path: str) -> Dict[str, Any]:
-        sample_file = genai.upload_file(path=image_path, display_name="Image Analysis Sample")
+        sample_file = self.file_handles.get_or_upload(image_path, display_name="Image Analysis Sample")
         
-        prompt = """
+        prompt = f"""
         Analyze the technical quality of this image for computer vision training datasets.
         Return a JSON object with the following schema:
-        {
-            "resolution_analysis": {"width": int, "height": int, "aspect_ratio": str},
-            "lighting_score": int (0-100),
-            "blur_detection": bool,
-            "noise_level": str (Low/Medium/High),
-            "artifacts_detected": [str],
-            "composition": str,
-            "suitability_for_training": bool
-        }
+        {IMAGE_QUALITY_SCHEMA}
         """
         
         response = self.flash_model.generate_content([sample_file, prompt])
         return json.loads(response.text)
 
     def detect_social_bias(self, media_path: str) -> Dict[str, Any]:
-        sample_file = genai.upload_file(path=media_path, display_name="Bias Audit Sample")
+        sample_file = self.file_handles.get_or_upload(media_path, display_name="Bias Audit Sample")
         
-        prompt = """
+        prompt = f"""
         Perform a deep ethical audit on this media file. Identify underrepresented groups and potential biases.
         Return a JSON object:
-        {
-            "demographic_breakdown": {
-                "gender_distribution": {"male": int, "female": int, "non_binary": int},
-                "age_groups": [str],
-                "ethnic_diversity_score": int (0-100)
-            },
-            "contextual_bias": {
-                "setting": str,
-                "socioeconomic_indicators": [str],
-                "cultural_markers": [str]
-            },
-            "fairness_score": int (0-100),
-            "risk_assessment": "Low/Medium/High/Critical",
-            "mitigation_suggestions": [str]
-        }
+        {SOCIAL_BIAS_SCHEMA}
         """
         
         response = self.pro_model.generate_content([sample_file, prompt])
         return json.loads(response.text)
 
+    def analyze_image_fused(self, image_path: str) -> Dict[str, Any]:
+        """
+        Calidad técnica y auditoría de sesgos en una sola llamada (pro_model).
+
+        Devuelve {"quality_metrics", "bias_audit"} con los mismos esquemas que
+        las llamadas por separado; si la respuesta omite una de las dos partes,
+        esa parte se pide con su llamada individual.
+        """
+        sample_file = self.file_handles.get_or_upload(image_path, display_name="Image Analysis Sample")
+
+        prompt = f"""
+        Perform two independent analyses of this image:
+        1. The technical quality of the image for computer vision training datasets.
+        2. A deep ethical audit. Identify underrepresented groups and potential biases.
+        Return a single JSON object with both results:
+        {{
+            "quality_metrics": {IMAGE_QUALITY_SCHEMA},
+            "bias_audit": {SOCIAL_BIAS_SCHEMA}
+        }}
+        """
+
+        response = self.pro_model.generate_content([sample_file, prompt])
+        result = json.loads(response.text)
+        quality = result.get("quality_metrics")
+        bias = result.get("bias_audit")
+        return {
+            "quality_metrics": quality if isinstance(quality, dict) else self.analyze_image_quality(image_path),
+            "bias_audit": bias if isinstance(bias, dict) else self.detect_social_bias(image_path)
+        }
+
+    def analyze_image(self, image_path: str, mode: str = "separate") -> Dict[str, Any]:
+        """Calidad técnica + sesgos de una imagen según `mode` (ver IMAGE_MODES)."""
+        if mode == "fused":
+            return self.analyze_image_fused(image_path)
+        if mode == "concurrent":
+            bias = _image_pool.submit(self.detect_social_bias, image_path)
+            try:
+                quality = self.analyze_image_quality(image_path)
+            except BaseException:
+                bias.cancel()
+                raise
+            return {"quality_metrics": quality, "bias_audit": bias.result()}
+        return {
+            "quality_metrics": self.analyze_image_quality(image_path),
+            "bias_audit": self.detect_social_bias(image_path)
+        }
+
     def process_pdf_document(self, pdf_path: str) -> Dict[str, Any]:
-        doc_file = genai.upload_file(path=pdf_path, display_name="PDF Document")
+        doc_file = self.file_handles.get_or_upload(pdf_path, display_name="PDF Document")
         
         prompt = """
         Extract and structure all data from this PDF document.
@@ -91,31 +221,49 @@ class OptimaOmniAnalysis:
         return json.loads(response.text)
 
     def analyze_video_stream(self, video_path: str) -> Dict[str, Any]:
-        video_file = genai.upload_file(path=video_path)
-        
-        while video_file.state.name == "PROCESSING":
-            time.sleep(2)
-            video_file = genai.get_file(video_file.name)
+        # Espera a que termine el procesamiento (lanza ValueError si falla)
+        video_file = self.file_handles.get_or_upload(video_path)
 
-        if video_file.state.name == "FAILED":
-            raise ValueError(f"Video processing failed: {video_file.state.name}")
+        response = self.pro_model.generate_content([video_file, VIDEO_ANALYSIS_PROMPT])
+        return json.loads(response.text)
 
-        prompt = """
-        Analyze this video frame by frame for dynamic data collection.
-        Return JSON:
-        {
-            "video_metadata": {"duration": str, "frame_rate": float},
-            "temporal_events": [
-                {"timestamp": str, "event_description": str, "objects_detected": [str]}
-            ],
-            "audio_transcription_summary": str,
-            "action_recognition": [str],
-            "overall_data_utility": int (0-100)
-        }
+    async def analyze_video_async(
+        self,
+        video_path: str,
+        upload_semaphore: Optional[asyncio.Semaphore] = None,
+        deadline: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """Versión asíncrona de `analyze_video_stream`: la espera del procesamiento no ocupa un hilo."""
+        video_file = await self.file_handles.get_or_upload_async(
+            video_path, upload_semaphore=upload_semaphore, deadline=deadline
+        )
+        response = await self.pro_model.generate_content_async([video_file, VIDEO_ANALYSIS_PROMPT])
+        return json.loads(response.text)
+
+    async def analyze_videos_async(
+        self,
+        video_paths: List[str],
+        concurrency: int = OMNI_VIDEO_UPLOADS,
+        timeout: float = FILE_PROCESSING_TIMEOUT
+    ) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+        """
+        Sube varios videos en paralelo (como mucho `concurrency` subidas a la
+        vez), sondea su procesamiento con backoff y analiza cada uno en cuanto
+        queda ACTIVE. Produce (ruta, resultado) en orden de finalización; un
+        video que falla o sigue procesándose pasado `timeout` da un resultado
+        con status "error".
         """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        deadline = time.monotonic() + timeout
 
-        response = self.pro_model.generate_content([video_file, prompt])
-        return json.loads(response.text)
+        async def analyze(video_path: str) -> Tuple[str, Dict[str, Any]]:
+            try:
+                return video_path, await self.analyze_video_async(video_path, semaphore, deadline)
+            except Exception as e:
+                return video_path, {"status": "error", "error_message": str(e)}
+
+        for next_done in asyncio.as_completed([analyze(path) for path in video_paths]):
+            yield await next_done
 
     def generate_synthetic_augmentation(self, base_data_json: Dict[str, Any], count: int = 5) -> List[Dict[str, Any]]:
         prompt = f"""
@@ -131,48 +279,328 @@ class OptimaOmniAnalysis:
         response = self.pro_model.generate_content(prompt)
         return json.loads(response.text)
 
-    def batch_process_directory(self, directory_path: str) -> List[Dict[str, Any]]:
-        results = []
-        files = [f for f in os.listdir(directory_path) if os.path.isfile(os.path.join(directory_path, f))]
-        
-        for filename in files:
-            file_path = os.path.join(directory_path, filename)
-            file_ext = filename.split('.')[-1].lower()
-            
-            try:
-                if file_ext in ['jpg', 'jpeg', 'png', 'webp']:
-                    quality = self.analyze_image_quality(file_path)
-                    bias = self.detect_social_bias(file_path)
-                    results.append({
-                        "filename": filename,
-                        "type": "image",
-                        "quality_metrics": quality,
-                        "bias_audit": bias
-                    })
-                elif file_ext == 'pdf':
-                    pdf_data = self.process_pdf_document(file_path)
-                    results.append({
-                        "filename": filename,
-                        "type": "document",
-                        "content_analysis": pdf_data
-                    })
-                elif file_ext in ['mp4', 'mov', 'avi']:
-                    video_data = self.analyze_video_stream(file_path)
-                    results.append({
-                        "filename": filename,
-                        "type": "video",
-                        "temporal_analysis": video_data
-                    })
-            except Exception as e:
-                results.append({
-                    "filename": filename,
-                    "status": "error",
-                    "error_message": str(e)
-                })
-                
-        return results
+    def _plan_image_duplicates(self, image_paths: List[str], max_distance: int):
+        fingerprints = []
+        for path in image_paths:
+            with open(path, "rb") as f:
+                fingerprints.append(fingerprint(f.read(), is_image=True))
+        return plan_batch(fingerprints, max_distance)
+
+    def _analyze_path(self, file_path: str, label: str, file_ext: str, image_mode: str) -> Dict[str, Any]:
+        if file_ext in IMAGE_EXTENSIONS:
+            return {"filename": label, "type": "image", **self.analyze_image(file_path, image_mode)}
+        if file_ext == "pdf":
+            return {"filename": label, "type": "document", "content_analysis": self.process_pdf_document(file_path)}
+        return {"filename": label, "type": "video", "temporal_analysis": self.analyze_video_stream(file_path)}
+
+    @staticmethod
+    def _known_result(manifest: BatchManifest, digest: str, rel_path: str) -> Optional[Dict[str, Any]]:
+        known = manifest.by_content(digest)
+        if known is None:
+            return None
+        result = {key: value for key, value in known["result"].items() if key != "duplicate_of"}
+        return {**result, "filename": rel_path}
+
+    async def _process_video(
+        self,
+        task: Tuple[int, str, str, os.stat_result, str],
+        manifest: BatchManifest,
+        upload_semaphore: asyncio.Semaphore,
+        on_done: Callable[[Any, Any], None],
+        deadline: Optional[float] = None
+    ) -> None:
+        _, file_path, rel_path, _, _ = task
+        try:
+            digest = await asyncio.to_thread(self.file_handles.digest, file_path)
+            known = self._known_result(manifest, digest, rel_path)
+            if known is not None:
+                outcome = ("reused", known, digest, None)
+            else:
+                analysis = await self.analyze_video_async(file_path, upload_semaphore, deadline)
+                outcome = ("analyzed", {"filename": rel_path, "type": "video", "temporal_analysis": analysis}, digest, None)
+        except Exception as e:
+            outcome = ("failed", {"filename": rel_path, "status": "error", "error_message": str(e)}, None, None)
+        on_done(task, outcome)
+
+    def _process_file(
+        self,
+        task: Tuple[int, str, str, os.stat_result, str],
+        manifest: BatchManifest,
+        image_mode: str,
+        dedup_hash: Optional[int],
+        max_distance: int
+    ) -> Tuple[str, Dict[str, Any], Optional[str], Optional[Dict[str, Any]]]:
+        """
+        (origen, resultado, sha256, coincidencia previa) de un archivo. Se
+        reutiliza el resultado de otro archivo con el mismo contenido del
+        manifiesto o, con dedup, de una imagen casi idéntica de otra ejecución.
+        """
+        _, file_path, rel_path, _, file_ext = task
+        try:
+            digest = self.file_handles.digest(file_path)
+            known = self._known_result(manifest, digest, rel_path)
+            if known is not None:
+                return "reused", known, digest, None
+            if dedup_hash is not None:
+                match = duplicate_index.find("omni_image", dedup_hash, max_distance)
+                if match is not None:
+                    return "reused", {
+                        **match["result"],
+                        "filename": rel_path,
+                        "duplicate_of": {
+                            "source": "previous_run",
+                            "filename": match["label"],
+                            "distance": match["distance"]
+                        }
+                    }, digest, match
+            entry = self._analyze_path(file_path, rel_path, file_ext, image_mode)
+            if dedup_hash is not None:
+                duplicate_index.add("omni_image", dedup_hash, digest, rel_path, entry)
+            return "analyzed", entry, digest, None
+        except Exception as e:
+            return "failed", {"filename": rel_path, "status": "error", "error_message": str(e)}, None, None
+
+    @staticmethod
+    def _run_pool(tasks: Iterable[Any], process: Callable[[Any], Any], on_done: Callable[[Any, Any], None], workers: int) -> None:
+        # Ventana acotada de tareas en vuelo: el recorrido de la carpeta avanza
+        # a medida que terminan los archivos en lugar de encolarlos todos
+        window = max(1, workers) * 4
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            pending = {}
+            for task in tasks:
+                pending[pool.submit(process, task)] = task
+                if len(pending) >= window:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        on_done(pending.pop(future), future.result())
+            for future in as_completed(pending):
+                on_done(pending[future], future.result())
+
+    def batch_process_directory(
+        self,
+        directory_path: str,
+        dedup: bool = False,
+        max_distance: int = DEDUP_MAX_DISTANCE,
+        image_mode: str = "separate",
+        workers: int = OMNI_BATCH_WORKERS,
+        manifest_path: Optional[str] = None,
+        resume: bool = True
+    ) -> List[Dict[str, Any]]:
+        """
+        Analiza `directory_path` y sus subcarpetas con `workers` hilos.
+
+        Cada resultado se agrega en cuanto termina a un manifiesto JSONL
+        (`manifest_path`, por defecto `.optima_manifest.jsonl` en la carpeta) con
+        ruta, tamaño, mtime y SHA-256. Al volver a ejecutar, los archivos sin
+        cambios o con un contenido ya analizado reutilizan su resultado y solo se
+        analizan los nuevos o modificados (`resume=False` empieza de cero). El
+        resumen queda en self.last_manifest_report.
+
+        Con dedup=True solo se analiza un representante por grupo de imágenes
+        casi idénticas (hash perceptual) y su resultado se copia al resto; el
+        reporte de grupos queda en self.last_duplicate_report. En ese modo el
+        recorrido de la carpeta se completa antes de empezar.
+        """
+        if image_mode not in IMAGE_MODES:
+            raise ValueError(f"image_mode debe ser uno de {IMAGE_MODES}")
+
+        manifest = BatchManifest(manifest_path or os.path.join(directory_path, MANIFEST_FILENAME), resume)
+        skip_paths = {os.path.abspath(manifest.path), os.path.abspath(manifest.path) + ".tmp"}
+        seen: List[str] = []
+        results: Dict[int, Dict[str, Any]] = {}
+        counts = {"analyzed": 0, "unchanged": 0, "reused": 0, "duplicates": 0, "failed": 0}
+        self.last_duplicate_report = None
+
+        def pending_files() -> Iterator[Tuple[int, str, str, os.stat_result, str]]:
+            for file_path, stat in iter_directory_files(directory_path):
+                file_ext = file_path.rsplit(".", 1)[-1].lower()
+                if file_ext not in OMNI_EXTENSIONS or os.path.abspath(file_path) in skip_paths:
+                    continue
+                rel_path = os.path.relpath(file_path, directory_path)
+                seen.append(rel_path)
+                record = manifest.unchanged(rel_path, stat)
+                if record is not None:
+                    results[len(seen) - 1] = record["result"]
+                    counts["unchanged"] += 1
+                    continue
+                yield len(seen) - 1, file_path, rel_path, stat, file_ext
+
+        tasks: Iterable[Tuple[int, str, str, os.stat_result, str]] = pending_files()
+        plan = None
+        image_position: Dict[int, int] = {}
+        reused: Dict[int, Dict[str, Any]] = {}
+        if dedup:
+            tasks = list(tasks)
+            images = [task for task in tasks if task[4] in IMAGE_EXTENSIONS]
+            image_position = {task[0]: position for position, task in enumerate(images)}
+            plan = self._plan_image_duplicates([task[1] for task in images], max_distance)
+
+        def is_member(task) -> bool:
+            position = image_position.get(task[0])
+            return position is not None and plan.representative[position] != position
+
+        def process(task):
+            position = image_position.get(task[0])
+            dedup_hash = plan.hashes[position] if position is not None else None
+            return self._process_file(task, manifest, image_mode, dedup_hash, max_distance)
+
+        # Los resultados llegan del pool y del hilo de videos
+        record_lock = threading.Lock()
+
+        def on_done(task, outcome) -> None:
+            index, _, rel_path, stat, _ = task
+            kind, entry, digest, match = outcome
+            with record_lock:
+                results[index] = entry
+                counts[kind] += 1
+                if match is not None:
+                    reused[image_position[index]] = match
+                if kind != "failed":
+                    manifest.record(rel_path, stat, digest, entry)
+
+        # Los videos no ocupan un worker mientras Gemini los procesa: se suben y
+        # esperan en paralelo en su propio bucle asyncio, con un plazo común
+        # (como analyze_videos_async) pasado el cual el video cuenta como fallido
+        videos = _VideoPipeline()
+        upload_semaphore = asyncio.Semaphore(max(1, OMNI_VIDEO_UPLOADS))
+        video_deadline = time.monotonic() + FILE_PROCESSING_TIMEOUT
+
+        def pool_tasks() -> Iterator[Tuple[int, str, str, os.stat_result, str]]:
+            for task in tasks:
+                if task[4] in VIDEO_EXTENSIONS:
+                    videos.submit(self._process_video(task, manifest, upload_semaphore, on_done, video_deadline))
+                elif not is_member(task):
+                    yield task
+
+        try:
+            self._run_pool(pool_tasks(), process, on_done, workers)
+            videos.join()
+            if plan:
+                # Copias del resultado del representante; si este falló, la imagen se analiza sola
+                retry = []
+                for task in (task for task in tasks if is_member(task)):
+                    index, _, rel_path, stat, _ = task
+                    position = image_position[index]
+                    rep = plan.representative[position]
+                    rep_task = images[rep]
+                    rep_entry = results[rep_task[0]]
+                    if rep_entry.get("status") == "error":
+                        retry.append(task)
+                        continue
+                    results[index] = {
+                        **rep_entry,
+                        "filename": rel_path,
+                        "duplicate_of": {
+                            "source": "batch",
+                            "filename": rep_task[2],
+                            "distance": plan.distance[position]
+                        }
+                    }
+                    counts["duplicates"] += 1
+                    manifest.record(rel_path, stat, plan.digests[position], results[index])
+                self._run_pool(retry, process, on_done, workers)
+                self.last_duplicate_report = duplicate_report(plan, [task[2] for task in images], reused)
+            manifest.compact(seen)
+        finally:
+            videos.close()
+            manifest.close()
+
+        self.last_manifest_report = {"manifest": manifest.path, "files": len(seen), **counts}
+        return [results[index] for index in range(len(seen))]
+
+# ==================== BENCHMARK ====================
+
+def _benchmark_image_modes(images: int = 20, rtt: float = 0.3, tokens_per_second: float = 400) -> None:
+    """
+    Compara IMAGE_MODES contra un modelo falso local: llamadas, tiempo y tokens por imagen.
+
+    Cada llamada falsa tarda `rtt` más el tiempo de generar su salida; los tokens
+    se estiman como 258 por imagen más texto / 4, igual que la API.
+    """
+    import tempfile
+    from datetime import datetime, timedelta, timezone
+    from types import SimpleNamespace
+
+    from PIL import Image
+
+    stats = {"calls": 0, "prompt_tokens": 0, "output_tokens": 0}
+    stats_lock = threading.Lock()
+    quality = {
+        "resolution_analysis": {"width": 256, "height": 256, "aspect_ratio": "1:1"},
+        "lighting_score": 72, "blur_detection": False, "noise_level": "Low",
+        "artifacts_detected": [], "composition": "centered subject", "suitability_for_training": True
+    }
+    bias = {
+        "demographic_breakdown": {
+            "gender_distribution": {"male": 1, "female": 1, "non_binary": 0},
+            "age_groups": ["25-34"], "ethnic_diversity_score": 40
+        },
+        "contextual_bias": {"setting": "urban", "socioeconomic_indicators": [], "cultural_markers": []},
+        "fairness_score": 61, "risk_assessment": "Medium",
+        "mitigation_suggestions": ["add more diverse samples"]
+    }
+
+    class FakeModel:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def generate_content(self, contents):
+            prompt = " ".join(part for part in contents if isinstance(part, str))
+            if '"quality_metrics"' in prompt:
+                body = {"quality_metrics": quality, "bias_audit": bias}
+            elif "technical quality" in prompt:
+                body = quality
+            else:
+                body = bias
+            text = json.dumps(body)
+            prompt_tokens = len(prompt) // 4 + 258 * sum(not isinstance(part, str) for part in contents)
+            output_tokens = len(text) // 4
+            with stats_lock:
+                stats["calls"] += 1
+                stats["prompt_tokens"] += prompt_tokens
+                stats["output_tokens"] += output_tokens
+            time.sleep(rtt + output_tokens / tokens_per_second)
+            return SimpleNamespace(text=text)
+
+    def fake_upload(path, mime_type=None, display_name=None):
+        expires = datetime.now(timezone.utc) + timedelta(hours=48)
+        return SimpleNamespace(
+            name=f"files/{os.path.basename(path)}", mime_type=mime_type or "image/png",
+            state=SimpleNamespace(name="ACTIVE"), expiration_time=expires
+        )
+
+    genai.GenerativeModel = FakeModel
+    genai.upload_file = fake_upload
+    workdir = tempfile.mkdtemp()
+    folder = os.path.join(workdir, "images")
+    os.makedirs(folder)
+    for i in range(images):
+        Image.effect_noise((256, 256), 20 + i).save(os.path.join(folder, f"img_{i}.png"))
+
+    engine = OptimaOmniAnalysis(api_key="benchmark")
+    engine.file_handles = FileHandleCache(os.path.join(workdir, "file_handles.sqlite3"))
+    print(f"{images} imágenes, rtt={rtt * 1000:.0f} ms, salida a {tokens_per_second:.0f} tokens/s")
+    print(f"{'modo':<11}{'llamadas/img':>13}{'ms/img':>9}{'tokens entrada/img':>20}{'tokens salida/img':>19}")
+    for mode in IMAGE_MODES:
+        stats.update(calls=0, prompt_tokens=0, output_tokens=0)
+        started = time.perf_counter()
+        results = engine.batch_process_directory(folder, image_mode=mode, resume=False)
+        elapsed = time.perf_counter() - started
+        assert all("quality_metrics" in r and "bias_audit" in r for r in results)
+        print(f"{mode:<11}{stats['calls'] / images:>13.1f}{elapsed * 1000 / images:>9.0f}"
+              f"{stats['prompt_tokens'] / images:>20.0f}{stats['output_tokens'] / images:>19.0f}")
 
 if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:2] == ["benchmark"]:
+        # python general.py benchmark [imágenes] [rtt_ms]
+        _benchmark_image_modes(
+            int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+            float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.3
+        )
+        sys.exit()
+
     engine = OptimaOmniAnalysis(api_key="YOUR_API_KEY_HERE")
     
     sample_image = "dataset/raw/sample_01.jpg"
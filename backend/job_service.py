@@ -0,0 +1,378 @@
+import asyncio
+import json
+import os
+import pathlib
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from gemini_service import analyze_bias_detailed_async, analyze_file_with_gemini_async, cascade_analysis_async
+from scheduler_service import Priority, call_context
+
+load_dotenv()
+
+# ==================== CONFIGURACIÓN ====================
+
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", ".cache/jobs.sqlite3")
+JOB_DATA_DIR = os.getenv("JOB_DATA_DIR", ".cache/jobs")
+# Workers dentro de cada proceso de la API (0 = solo workers dedicados)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.5"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+JOB_KINDS = ("advanced", "bias")
+
+# ==================== COLA PERSISTENTE ====================
+
+class JobStore:
+    """
+    Cola de trabajos persistente sobre SQLite (sin broker externo).
+
+    Cada job tiene N items (uno por archivo). Los workers reclaman items con
+    un "lease" que renuevan mientras procesan; si un proceso muere, el lease
+    expira y otro worker retoma el item. Así los jobs sobreviven reinicios.
+    """
+
+    def __init__(self, db_path: str = JOB_DB_PATH, data_dir: str = JOB_DATA_DIR):
+        self.db_path = db_path
+        self.data_dir = data_dir
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    total INTEGER NOT NULL,
+                    created REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS job_items (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    filename TEXT,
+                    mime_type TEXT NOT NULL,
+                    path TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    result TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    lease_until REAL,
+                    worker TEXT,
+                    updated REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS job_items_status ON job_items (status, id);
+                CREATE INDEX IF NOT EXISTS job_items_job ON job_items (job_id, idx);
+            """)
+            self._local.conn = conn
+        return conn
+
+    # ---------- Alta de jobs ----------
+
+    def create_job(
+        self,
+        kind: str,
+        params: Dict[str, Any],
+        files: List[Tuple[Optional[str], str, BinaryIO]]
+    ) -> str:
+        """
+        Registra un job. `files` son tuplas (nombre, mime, archivo abierto);
+        el contenido se copia a disco por bloques, sin cargarlo entero en RAM.
+        """
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.data_dir, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+
+        now = time.time()
+        rows = []
+        for idx, (filename, mime_type, file_obj) in enumerate(files):
+            path = os.path.join(job_dir, str(idx))
+            with open(path, "wb") as out:
+                shutil.copyfileobj(file_obj, out, 1024 * 1024)
+            rows.append((job_id, idx, filename, mime_type, path, now))
+
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, params, total, created) VALUES (?, ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(params), len(rows), now)
+            )
+            conn.executemany(
+                "INSERT INTO job_items (job_id, idx, filename, mime_type, path, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            shutil.rmtree(job_dir, ignore_errors=True)
+            raise
+        return job_id
+
+    # ---------- Workers ----------
+
+    def claim_item(self, worker_id: str) -> Optional[sqlite3.Row]:
+        """Reclama atómicamente el siguiente item pendiente (o con lease vencido)."""
+        conn = self._conn()
+        while True:
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                item = conn.execute(
+                    """
+                    SELECT job_items.*, jobs.kind, jobs.params FROM job_items
+                    JOIN jobs ON jobs.id = job_items.job_id
+                    WHERE job_items.status = 'pending'
+                       OR (job_items.status = 'running' AND job_items.lease_until < ?)
+                    ORDER BY job_items.id LIMIT 1
+                    """,
+                    (now,)
+                ).fetchone()
+                if item is None:
+                    conn.execute("COMMIT")
+                    return None
+
+                if item["attempts"] >= JOB_MAX_ATTEMPTS:
+                    # Se cayó demasiadas veces procesándolo: lo damos por fallido
+                    conn.execute(
+                        "UPDATE job_items SET status = 'failed', result = ?, updated = ? WHERE id = ?",
+                        (json.dumps({"error": "Se superó el número máximo de intentos", "status": "failed"}), now, item["id"])
+                    )
+                    conn.execute("COMMIT")
+                    self._discard_payload(item["path"])
+                    continue
+
+                conn.execute(
+                    """
+                    UPDATE job_items
+                    SET status = 'running', attempts = attempts + 1, lease_until = ?, worker = ?, updated = ?
+                    WHERE id = ?
+                    """,
+                    (now + JOB_LEASE_SECONDS, worker_id, now, item["id"])
+                )
+                conn.execute("COMMIT")
+                return item
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def renew_lease(self, item_id: int, worker_id: str) -> None:
+        self._conn().execute(
+            "UPDATE job_items SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'running'",
+            (time.time() + JOB_LEASE_SECONDS, item_id, worker_id)
+        )
+
+    def complete_item(self, item: sqlite3.Row, worker_id: str, result: Dict[str, Any]) -> None:
+        status = "done" if result.get("status") == "success" else "failed"
+        cur = self._conn().execute(
+            """
+            UPDATE job_items SET status = ?, result = ?, lease_until = NULL, updated = ?
+            WHERE id = ? AND worker = ? AND status = 'running'
+            """,
+            (status, json.dumps(result, ensure_ascii=False), time.time(), item["id"], worker_id)
+        )
+        # Si otro worker retomó el item (lease vencido), su resultado es el que vale
+        if cur.rowcount:
+            self._discard_payload(item["path"])
+
+    def _discard_payload(self, path: Optional[str]) -> None:
+        # Los bytes del archivo ya no hacen falta una vez guardado el resultado
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    # ---------- Consultas ----------
+
+    def job_status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        conn = self._conn()
+        job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None:
+            return None
+        counts = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+        for row in conn.execute(
+            "SELECT status, COUNT(*) AS n FROM job_items WHERE job_id = ? GROUP BY status", (job_id,)
+        ):
+            counts[row["status"]] = row["n"]
+
+        finished = counts["done"] + counts["failed"]
+        if finished == job["total"]:
+            status = "completed"
+        elif counts["running"] or finished:
+            status = "running"
+        else:
+            status = "queued"
+
+        return {
+            "job_id": job_id,
+            "kind": job["kind"],
+            "status": status,
+            "total": job["total"],
+            "completed": finished,
+            "succeeded": counts["done"],
+            "failed": counts["failed"],
+            "pending": counts["pending"] + counts["running"],
+            "progress": round(finished / job["total"], 4) if job["total"] else 1.0,
+            "created": job["created"]
+        }
+
+    def job_results(self, job_id: str, since: int = -1) -> List[Dict[str, Any]]:
+        """Resultados terminados (parciales o completos) con índice mayor que `since`."""
+        rows = self._conn().execute(
+            """
+            SELECT idx, result FROM job_items
+            WHERE job_id = ? AND status IN ('done', 'failed') AND idx > ?
+            ORDER BY idx
+            """,
+            (job_id, since)
+        ).fetchall()
+        return [{"index": row["idx"], **json.loads(row["result"])} for row in rows]
+
+job_store = JobStore()
+
+# ==================== PROCESAMIENTO ====================
+
+async def _process_item(item: sqlite3.Row) -> Dict[str, Any]:
+    params = json.loads(item["params"])
+    try:
+        # Se pasa la ruta: los bytes se leen (o se sube por la File API) al llamar a Gemini
+        file_bytes = pathlib.Path(item["path"])
+
+        if item["kind"] == "advanced":
+            if params.get("cascade"):
+                analysis = await cascade_analysis_async(
+                    file_bytes, item["mime_type"], params["prompt"], analysis_level=params["analysis_level"]
+                )
+            else:
+                analysis = await analyze_file_with_gemini_async(
+                    file_bytes, item["mime_type"], params["prompt"],
+                    model_name=params["model"], analysis_level=params["analysis_level"]
+                )
+            if "error" in analysis:
+                return {"filename": item["filename"], "error": analysis["error"], "status": "failed"}
+            return {"filename": item["filename"], "analysis": analysis, "status": "success"}
+
+        if item["kind"] == "bias":
+            result = await analyze_bias_detailed_async(
+                file_bytes, item["mime_type"], params["focus_areas"], model_name=params["model"]
+            )
+            if "error" in result:
+                return {"filename": item["filename"], "error": result["error"], "status": "failed"}
+            return {"filename": item["filename"], "bias_analysis": result, "status": "success"}
+
+        return {"filename": item["filename"], "error": f"Tipo de job desconocido: {item['kind']}", "status": "failed"}
+    except Exception as e:
+        return {"filename": item["filename"], "error": str(e), "status": "failed"}
+
+async def _idle(stop: asyncio.Event, seconds: float) -> None:
+    try:
+        await asyncio.wait_for(stop.wait(), timeout=seconds)
+    except asyncio.TimeoutError:
+        pass
+
+async def run_worker(store: JobStore, worker_id: str, stop: asyncio.Event) -> None:
+    """
+    Bucle de un worker: reclama items, los procesa y guarda el resultado.
+
+    Las escrituras en SQLite van a un hilo: con el lock de escritura tomado por
+    otro proceso pueden esperar hasta el timeout, y no deben frenar el event loop.
+    Un error de SQLite ("database is locked") no mata al worker: se registra, se
+    espera JOB_POLL_INTERVAL y se sigue. Si el lease no se puede renovar antes de
+    vencer, el análisis se cancela (otro worker retomará el item).
+    """
+    while not stop.is_set():
+        processing: Optional[asyncio.Task] = None
+        try:
+            item = await asyncio.to_thread(store.claim_item, worker_id)
+            if item is None:
+                await _idle(stop, JOB_POLL_INTERVAL)
+                continue
+
+            # Prioridad de lote; cada job es un cliente distinto para repartir la cuota entre jobs
+            with call_context(Priority.BATCH, f"job:{item['job_id']}"):
+                processing = asyncio.create_task(_process_item(item))
+            renewed = time.monotonic()
+            while True:
+                # Renovamos el lease mientras el análisis sigue en curso
+                done, _ = await asyncio.wait({processing}, timeout=JOB_LEASE_SECONDS / 3)
+                if done:
+                    break
+                try:
+                    await asyncio.to_thread(store.renew_lease, item["id"], worker_id)
+                    renewed = time.monotonic()
+                except sqlite3.Error as e:
+                    # Un fallo suelto se tolera mientras quede lease; después el item ya no es nuestro
+                    if time.monotonic() - renewed >= JOB_LEASE_SECONDS:
+                        raise
+                    print(f"⚠️ Worker {worker_id}: no se pudo renovar el lease del item {item['id']}: {e}")
+            await asyncio.to_thread(store.complete_item, item, worker_id, processing.result())
+        except Exception as e:
+            print(f"❌ Worker {worker_id}: {e}")
+            if processing is not None and not processing.done():
+                processing.cancel()
+                await asyncio.wait({processing})
+            await _idle(stop, JOB_POLL_INTERVAL)
+        except asyncio.CancelledError:
+            if processing is not None:
+                processing.cancel()
+            raise
+
+class JobWorkerPool:
+    """Arranca/detiene N workers asíncronos dentro del event loop actual."""
+
+    def __init__(self, store: JobStore, workers: int):
+        self.store = store
+        self.workers = workers
+        self._stop = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        prefix = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._tasks = [
+            asyncio.create_task(run_worker(self.store, f"{prefix}-{n}", self._stop))
+            for n in range(self.workers)
+        ]
+
+    async def stop(self) -> None:
+        self._stop.set()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+# ==================== WORKERS DEDICADOS ====================
+
+if __name__ == "__main__":
+    # Workers independientes de la API:  python job_service.py --workers 4
+    # (útil con JOB_WORKERS=0 en los procesos de uvicorn)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Workers de la cola de jobs de Optima")
+    parser.add_argument("--workers", type=int, default=max(JOB_WORKERS, 1))
+    args = parser.parse_args()
+
+    async def main():
+        pool = JobWorkerPool(job_store, args.workers)
+        pool.start()
+        print(f"🛠️  {args.workers} workers procesando jobs desde {JOB_DB_PATH}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await pool.stop()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -1,32 +1,87 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query, Request, Response
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, AsyncIterator, Awaitable, Callable, Tuple
+import asyncio
 import io
+import json
+import os
+import time
 
 # 1. IMPORTAMOS TUS SERVICIOS EXISTENTES Y LOS NUEVOS
+# Usamos las versiones asíncronas para no bloquear el event loop
 from gemini_service import (
-    analyze_file_with_gemini,
-    analyze_json_dataset,
-    compare_datasets,
-    generate_synthetic_data_plan,
-    analyze_bias_detailed,
-    generate_data_quality_report,
-    quick_analysis,
-    deep_analysis,
-    transcribe_audio_with_gemini, # <--- NUEVA FUNCIÓN IMPORTADA
+    analyze_file_with_gemini_async,
+    analyze_json_dataset_async,
+    analyze_json_file_async,
+    compare_datasets_async,
+    generate_synthetic_data_plan_async,
+    analyze_bias_detailed_async,
+    generate_data_quality_report_async,
+    quick_analysis_async,
+    deep_analysis_async,
+    transcribe_audio_with_gemini_async,
+    cascade_analysis_async,
+    CASCADE_DEFAULT,
     GeminiModel,
     AnalysisLevel
 )
 
+from budget_service import current_usage, track_usage
+from resilience_service import resilience
+from scheduler_service import Priority, call_context, gemini_scheduler
+from cache_service import analysis_cache, in_flight, make_cache_key, track_cache
+from dedup_service import DEDUP_MAX_DISTANCE, duplicate_index, duplicate_report, fingerprint_stream, plan_batch
+from job_service import JOB_KINDS, JOB_WORKERS, JobWorkerPool, job_store
+from prescreen_service import is_prescreenable, prescreen_image, should_reject
+from spool_service import (
+    UPLOAD_MEMORY_BYTES,
+    FileData,
+    SpooledUpload,
+    UploadTooLarge,
+    check_request_size,
+    spool_upload
+)
+from starlette.background import BackgroundTask
+from starlette.formparsers import MultiPartParser
+
 # 2. IMPORTAMOS EL SERVICIO DE VOZ (ELEVENLABS)
-from tts_service import text_to_speech_stream
+from tts_service import (
+    TTS_PIPELINE_MIN_CHARS,
+    TTSError,
+    close_tts_client,
+    open_pipelined_stream,
+    open_speech_stream,
+    speech_cache_key,
+    split_speech_segments
+)
+from audio_cache_service import TTS_CACHE_ENABLED, audio_cache
+from upload_service import STORAGE_ENABLED, StorageError, start_ingest, storage_ingest
+from transcription_service import (
+    TRANSCRIBE_LONG_AUDIO_SECONDS,
+    TranscriptAssembler,
+    is_wav,
+    iter_segment_transcripts,
+    plan_segments,
+    wav_duration
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Workers de la cola de jobs dentro de este proceso (JOB_WORKERS=0 para desactivarlos)
+    pool = JobWorkerPool(job_store, JOB_WORKERS)
+    pool.start()
+    yield
+    await pool.stop()
+    await close_tts_client()
 
 app = FastAPI(
     title="DataClean AI - Enhanced API",
     description="API multimodal: Análisis de Datos + Voz (TTS) + Escucha (STT)",
-    version="2.1.0"
+    version="2.1.0",
+    lifespan=lifespan
 )
 
 # CORS
@@ -38,12 +93,337 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class TokenUsageMiddleware:
+    """Añade a cada respuesta los tokens estimados y reales de las llamadas a Gemini que hizo."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        with track_usage() as usage:
+            async def send_with_usage(message):
+                if message["type"] == "http.response.start" and usage.calls:
+                    headers = list(message.get("headers", []))
+                    headers += [(name.lower().encode(), value.encode()) for name, value in usage.headers().items()]
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            await self.app(scope, receive, send_with_usage)
+
+app.add_middleware(TokenUsageMiddleware)
+
+# Prioridad de las llamadas a Gemini según el endpoint (el resto es interactivo)
+ROUTE_PRIORITIES = {
+    "/analyze-batch": Priority.BATCH,
+    "/analyze-advanced": Priority.BATCH,
+    "/deep-analysis": Priority.REPORT,
+    "/generate-report": Priority.REPORT,
+    "/synthetic-data-plan": Priority.REPORT,
+    "/analyze-bias-detailed": Priority.REPORT
+}
+
+class GeminiPriorityMiddleware:
+    """
+    Asigna prioridad y cliente a las llamadas a Gemini de cada petición. El
+    cliente es la cabecera `X-Client-Id` o, si no viene, la IP.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers", []))
+        client = headers.get(b"x-client-id", b"").decode("latin-1") or (scope.get("client") or ("anon",))[0]
+        with call_context(ROUTE_PRIORITIES.get(scope["path"], Priority.INTERACTIVE), client):
+            await self.app(scope, receive, send)
+
+app.add_middleware(GeminiPriorityMiddleware)
+
+# Starlette guarda en memoria cada archivo de hasta 1 MB mientras dura la petición;
+# con lotes de muchos archivos pequeños eso se acumula, así que se baja el umbral
+MultiPartParser.spool_max_size = UPLOAD_MEMORY_BYTES
+
+@app.exception_handler(UploadTooLarge)
+async def upload_too_large_handler(request, exc: UploadTooLarge):
+    return JSONResponse(status_code=413, content={"detail": str(exc)})
+
+# ==================== CONCURRENCIA ====================
+
+# Límite GLOBAL de análisis simultáneos por worker (todas las peticiones juntas)
+MAX_CONCURRENT_ANALYSES = int(os.getenv("MAX_CONCURRENT_ANALYSES", "8"))
+_analysis_semaphore = asyncio.Semaphore(MAX_CONCURRENT_ANALYSES)
+
+async def iter_file_results(
+    files: List[UploadFile],
+    analyze_one: Callable[[UploadFile], Awaitable[Dict[str, Any]]],
+    concurrency: Optional[int] = None
+) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Ejecuta `analyze_one` sobre cada archivo en paralelo, respetando el límite
+    global y el límite por petición (`concurrency`, acotado por el global).
+
+    Produce tuplas (índice, resultado) en orden de FINALIZACIÓN. Un fallo en un
+    archivo no afecta al resto.
+    """
+    limit = min(concurrency or MAX_CONCURRENT_ANALYSES, MAX_CONCURRENT_ANALYSES)
+    request_semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(index: int, file: UploadFile) -> Tuple[int, Dict[str, Any]]:
+        async with request_semaphore, _analysis_semaphore:
+            try:
+                return index, await analyze_one(file)
+            except Exception as e:
+                return index, {"filename": file.filename, "error": str(e), "status": "failed"}
+
+    tasks = [asyncio.create_task(run(index, file)) for index, file in enumerate(files)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # Si el cliente se desconecta a mitad del stream, no seguimos gastando llamadas
+        for task in tasks:
+            task.cancel()
+
+async def collect_results(
+    results: AsyncIterator[Tuple[int, Dict[str, Any]]],
+    total: int
+) -> List[Dict[str, Any]]:
+    """Reúne los resultados de un iterador (índice, resultado) en el orden original."""
+    ordered: List[Dict[str, Any]] = [{} for _ in range(total)]
+    async for index, result in results:
+        ordered[index] = result
+    return ordered
+
+async def analyze_files_concurrently(
+    files: List[UploadFile],
+    analyze_one: Callable[[UploadFile], Awaitable[Dict[str, Any]]],
+    concurrency: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """Igual que `iter_file_results`, pero devuelve la lista completa en el orden de `files`."""
+    return await collect_results(iter_file_results(files, analyze_one, concurrency), len(files))
+
+# ==================== DEDUPLICACIÓN DE LOTES ====================
+
+async def _fingerprint_upload(file: UploadFile, semaphore: asyncio.Semaphore) -> Tuple[str, Optional[int]]:
+    async with semaphore:
+        # Por bloques desde el archivo de Starlette; Pillow decodifica leyendo del mismo archivo
+        is_image = (file.content_type or "").startswith("image/")
+        return await asyncio.to_thread(fingerprint_stream, file.file, is_image)
+
+async def iter_deduplicated_results(
+    files: List[UploadFile],
+    analyze_one: Callable[[UploadFile], Awaitable[Dict[str, Any]]],
+    concurrency: Optional[int],
+    context: str,
+    max_distance: int,
+    report: Dict[str, Any],
+    reuse_previous: bool = True,
+    store_copy: Optional[Callable[[UploadFile], Awaitable[Dict[str, Any]]]] = None
+) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Como `iter_file_results`, pero solo analiza un representante por grupo de
+    duplicados (exactos o perceptuales) y replica su resultado al resto del grupo.
+
+    Con `reuse_previous` también reutiliza resultados de ejecuciones anteriores con
+    el mismo `context` (prompt + modelo + nivel); sin él (`bypass_cache`) todo
+    representante se analiza de nuevo. Al terminar deja el reporte de duplicados en `report`.
+
+    Los resultados copiados no heredan el `storage` del original: si hay
+    `store_copy`, cada archivo que no se analiza se sube por su cuenta (en
+    paralelo desde el principio) y su resultado va en `storage`.
+    """
+    hashing_semaphore = asyncio.Semaphore(MAX_CONCURRENT_ANALYSES)
+    fingerprints = await asyncio.gather(*(_fingerprint_upload(file, hashing_semaphore) for file in files))
+    plan = plan_batch(list(fingerprints), max_distance)
+
+    representatives = plan.representatives
+    positions = {id(files[index]): index for index in representatives}
+    reused: Dict[int, Dict[str, Any]] = {}
+    for index in representatives if reuse_previous else []:
+        if plan.hashes[index] is not None:
+            match = duplicate_index.find(context, plan.hashes[index], max_distance)
+            if match is not None:
+                reused[index] = match
+
+    analyzed = set(representatives) - set(reused)
+    storing: Dict[int, "asyncio.Task[Dict[str, Any]]"] = {}
+    if store_copy is not None:
+        storing = {
+            index: asyncio.create_task(store_copy(file))
+            for index, file in enumerate(files) if index not in analyzed
+        }
+
+    async def copy_of(index: int, result: Dict[str, Any], duplicate_of: Dict[str, Any]) -> Dict[str, Any]:
+        copy = {key: value for key, value in result.items() if key != "storage"}
+        copy.update(filename=files[index].filename, duplicate_of=duplicate_of)
+        if index in storing:
+            copy["storage"] = await storing[index]
+        return copy
+
+    async def analyze_representative(file: UploadFile) -> Dict[str, Any]:
+        index = positions[id(file)]
+        if index in reused:
+            match = reused[index]
+            return await copy_of(index, match["result"], {
+                "source": "previous_run", "filename": match["label"], "distance": match["distance"]
+            })
+        result = await analyze_one(file)
+        if result.get("status") == "success" and plan.hashes[index] is not None:
+            duplicate_index.add(context, plan.hashes[index], plan.digests[index], file.filename, result)
+        return result
+
+    representative_files = [files[index] for index in representatives]
+    try:
+        async for position, result in iter_file_results(representative_files, analyze_representative, concurrency):
+            rep = representatives[position]
+            yield rep, result
+            for member in plan.members(rep):
+                yield member, await copy_of(member, result, {
+                    "source": "batch",
+                    "index": rep,
+                    "filename": files[rep].filename,
+                    "distance": plan.distance[member]
+                })
+    finally:
+        # Si el cliente corta el stream, las subidas pendientes no siguen solas
+        for task in storing.values():
+            task.cancel()
+
+    report.update(duplicate_report(plan, [file.filename for file in files], reused))
+
+def iter_batch_results(
+    files: List[UploadFile],
+    analyze_one: Callable[[UploadFile], Awaitable[Dict[str, Any]]],
+    concurrency: Optional[int],
+    dedup_context: Optional[str],
+    dedup_distance: int,
+    report: Dict[str, Any],
+    bypass_cache: bool = False,
+    store_copy: Optional[Callable[[UploadFile], Awaitable[Dict[str, Any]]]] = None
+) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+    """Elige entre análisis normal o deduplicado (si hay `dedup_context`)."""
+    if dedup_context is None:
+        return iter_file_results(files, analyze_one, concurrency)
+    return iter_deduplicated_results(
+        files, analyze_one, concurrency, dedup_context, dedup_distance, report,
+        reuse_previous=not bypass_cache, store_copy=store_copy
+    )
+
+# ==================== PRE-SCREEN LOCAL ====================
+
+async def run_prescreen(file_bytes: FileData, mime_type: str) -> Optional[Dict[str, Any]]:
+    """Métricas locales de imagen (Pillow) antes de llamar a Gemini; None si no aplica."""
+    if not is_prescreenable(mime_type):
+        return None
+    return await asyncio.to_thread(prescreen_image, file_bytes)
+
+def with_prescreen(entry: Dict[str, Any], prescreen: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if prescreen is not None:
+        entry["prescreen"] = prescreen
+    return entry
+
+# ==================== ALMACENAMIENTO (VULTR) ====================
+
+async def with_storage(result: Dict[str, Any], storage: Optional["asyncio.Task[Dict[str, Any]]"]) -> Dict[str, Any]:
+    """Añade al resultado la subida al bucket, que corrió en paralelo con el análisis."""
+    if storage is not None:
+        result["storage"] = await storage
+    return result
+
+async def release_after_ingest(upload: SpooledUpload, storage: Optional["asyncio.Task[Dict[str, Any]]"]) -> None:
+    """Borra el temporal cuando la subida ya no lo lee (también si la petición se canceló)."""
+    try:
+        if storage is not None and not storage.done():
+            await asyncio.wait({storage})
+    finally:
+        upload.release()
+
+async def ingest_only(file: UploadFile) -> Dict[str, Any]:
+    """Sube al bucket un archivo que no se analiza (duplicado de otro del lote o de una ejecución anterior)."""
+    try:
+        upload = await spool_upload(file)
+    except UploadTooLarge as e:
+        return {"error": str(e), "status": "failed"}
+    storage = start_ingest(upload, file.filename, upload.mime_type)
+    try:
+        return await storage
+    finally:
+        await release_after_ingest(upload, storage)
+
+# ==================== STREAMING DE RESULTADOS ====================
+
+STREAM_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream"
+}
+
+def _encode_stream_record(record: Dict[str, Any], stream_format: str) -> bytes:
+    data = json.dumps(record, ensure_ascii=False)
+    if stream_format == "sse":
+        return f"event: {record['type']}\ndata: {data}\n\n".encode("utf-8")
+    return f"{data}\n".encode("utf-8")
+
+def stream_results(
+    results: AsyncIterator[Tuple[int, Dict[str, Any]]],
+    total: int,
+    stream_format: str,
+    summary_extra: Optional[Dict[str, Any]] = None
+) -> StreamingResponse:
+    """
+    Emite cada resultado (con `index` y `filename`) en cuanto termina, en formato
+    NDJSON o SSE, y al final un registro `summary` con los totales.
+
+    `summary_extra` se lee al final, así que puede completarse durante el stream.
+    """
+    if stream_format not in STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Formato de stream no soportado: {stream_format}")
+
+    async def event_stream():
+        started = time.perf_counter()
+        succeeded = 0
+        rejected = 0
+        async for index, result in results:
+            if result.get("status") == "success":
+                succeeded += 1
+            elif result.get("status") == "rejected":
+                rejected += 1
+            record = {"type": "result", "index": index, **result}
+            yield _encode_stream_record(record, stream_format)
+
+        summary = {
+            "type": "summary",
+            "total": total,
+            "succeeded": succeeded,
+            "rejected": rejected,
+            "failed": total - succeeded - rejected,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000),
+            **(summary_extra or {})
+        }
+        # En un stream las cabeceras salen antes que los resultados: el uso va en el resumen
+        usage = current_usage()
+        if usage is not None:
+            summary["token_usage"] = usage.summary()
+        yield _encode_stream_record(summary, stream_format)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type=STREAM_MEDIA_TYPES[stream_format],
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # ==================== MODELOS PYDANTIC ====================
 
 class JSONAnalysisRequest(BaseModel):
     data: Dict[str, Any] = Field(..., description="JSON data a analizar")
     prompt: str = Field(..., description="Objetivo del análisis")
     model: Optional[str] = Field(GeminiModel.PRO_2_5.value, description="Modelo de Gemini")
+    bypass_cache: bool = Field(False, description="Ignorar la caché de resultados")
 
 class CompareRequest(BaseModel):
     datasets: List[Dict[str, Any]] = Field(..., description="Lista de datasets a comparar")
@@ -59,97 +439,399 @@ class BatchReportRequest(BaseModel):
     analysis_results: List[Dict[str, Any]] = Field(..., description="Resultados de análisis previos")
     model: Optional[str] = Field(GeminiModel.PRO_2_5.value, description="Modelo de Gemini")
 
+class PresignRequest(BaseModel):
+    filename: str = Field(..., description="Nombre original (se conserva la extensión)")
+    content_type: str = Field("application/octet-stream", description="MIME type del archivo")
+    size: int = Field(..., ge=0, description="Tamaño en bytes")
+    sha256: str = Field(..., description="SHA-256 del contenido en hexadecimal (lo calcula el navegador)")
+
 # Modelo para la solicitud de voz (TTS)
 class SpeakRequest(BaseModel):
     text: str
+    pipeline: Optional[bool] = Field(None, description="Sintetizar por frases (por defecto, solo textos largos)")
 
 # ==================== ENDPOINTS DE AUDIO (NUEVOS) ====================
 
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+async def open_cached_speech(text: str) -> AsyncIterator[bytes]:
+    """Como `open_speech_stream`, pero sirve el audio desde la caché o lo guarda en ella."""
+    key = speech_cache_key(text)
+    # Buscar y abrir van juntos en el hilo: si esta tarea se cancela, la copia ya está liberada
+    cached_audio = await asyncio.to_thread(audio_cache.stream, key) if TTS_CACHE_ENABLED else None
+    if cached_audio is not None:
+        return cached_audio
+    audio_stream = await open_speech_stream(text)
+    return audio_cache.tee(key, audio_stream) if TTS_CACHE_ENABLED else audio_stream
+
+async def speech_response(text: str, http_request: Request, pipeline: Optional[bool] = None) -> Response:
+    """
+    Audio de `text` desde la caché en disco si ya se generó (con ETag y rangos,
+    para que el reproductor pueda saltar sin volver a sintetizar) o, si no,
+    el stream de ElevenLabs, que se guarda en la caché mientras se envía.
+    Lanza `TTSError` si ElevenLabs rechaza la petición.
+
+    Los textos largos (o con `pipeline=True`) se sintetizan por frases, varias a
+    la vez, y cada frase usa también la caché.
+    """
+    key = speech_cache_key(text)
+    headers = {"ETag": f'"{key}"', "Cache-Control": "no-cache"}
+    path = await asyncio.to_thread(audio_cache.lookup, key) if TTS_CACHE_ENABLED else None
+    if path is not None:
+        headers["X-Cache"] = "HIT"
+        if _etag_matches(http_request.headers.get("if-none-match"), headers["ETag"]):
+            audio_cache.release(path)
+            return Response(status_code=304, headers=headers)
+        # `path` es una copia privada: la expulsión no puede borrarla a mitad de la respuesta
+        return FileResponse(
+            path, media_type="audio/mpeg", headers=headers,
+            background=BackgroundTask(audio_cache.release, path)
+        )
+
+    if pipeline is None:
+        pipeline = len(text) >= TTS_PIPELINE_MIN_CHARS
+    segments = split_speech_segments(text) if pipeline else [text]
+    if len(segments) > 1:
+        audio_stream = await open_pipelined_stream(segments, open_cached_speech)
+        headers["X-TTS-Segments"] = str(len(segments))
+    else:
+        audio_stream = await open_speech_stream(text)
+    if TTS_CACHE_ENABLED:
+        audio_stream = audio_cache.tee(key, audio_stream)
+    headers["X-Cache"] = "MISS"
+    return StreamingResponse(audio_stream, media_type="audio/mpeg", headers=headers)
+
 @app.post("/speak")
-async def speak_text(request: SpeakRequest):
+async def speak_text(request: SpeakRequest, http_request: Request):
     """
     TEXT-TO-SPEECH (TTS): Convierte texto a voz usando ElevenLabs.
     Retorna un stream de audio MP3.
     """
     try:
-        audio_stream = text_to_speech_stream(request.text)
-        return StreamingResponse(audio_stream, media_type="audio/mpeg")
+        return await speech_response(request.text, http_request, request.pipeline)
+    except TTSError as e:
+        raise HTTPException(status_code=e.status_code, detail=f"Error en TTS: {str(e)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error en TTS: {str(e)}")
+
+@app.get("/speak")
+async def speak_text_get(http_request: Request, text: str = Query(...), pipeline: Optional[bool] = Query(None)):
+    """
+    Igual que POST /speak, pero utilizable como `src` de un `<audio>`: el
+    navegador puede pedir rangos y revalidar con If-None-Match.
+    """
+    try:
+        return await speech_response(text, http_request, pipeline)
+    except TTSError as e:
+        raise HTTPException(status_code=e.status_code, detail=f"Error en TTS: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error en TTS: {str(e)}")
 
+def stream_transcription(
+    audio: FileData,
+    segments: Optional[List[Any]],
+    use_cache: bool,
+    stream_format: str,
+    mime_type: str = "audio/wav",
+    duration: Optional[float] = None
+) -> StreamingResponse:
+    """
+    Emite un registro `segment` por cada segmento que termina (en orden de
+    finalización) con `transcript_delta`, el texto nuevo que ya se puede
+    mostrar en orden, y al final un `summary` con la transcripción completa.
+    Si un segmento falla, el último registro es de tipo `error`.
+
+    Sin `segments` (audio corto o que no es WAV) el archivo entero se emite
+    como un único segmento, con el mismo formato.
+    """
+    if stream_format not in STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Formato de stream no soportado: {stream_format}")
+
+    async def transcripts() -> AsyncIterator[Tuple[Dict[str, Any], str]]:
+        if segments is None:
+            text = await transcribe_audio_with_gemini_async(audio, mime_type, use_cache=use_cache)
+            end_s = round(duration, 2) if duration is not None else None
+            yield {"index": 0, "start_s": 0.0, "end_s": end_s}, text
+            return
+        async for segment, text in iter_segment_transcripts(audio, segments, use_cache):
+            yield segment.describe(), text
+
+    async def event_stream():
+        started = time.perf_counter()
+        assembler = TranscriptAssembler(len(segments or [audio]))
+        try:
+            async for described, text in transcripts():
+                record = {
+                    "type": "segment",
+                    **described,
+                    "text": text,
+                    "transcript_delta": assembler.add(described["index"], text)
+                }
+                yield _encode_stream_record(record, stream_format)
+        except Exception as e:
+            yield _encode_stream_record({"type": "error", "detail": f"Error en Transcripción: {str(e)}"}, stream_format)
+            return
+        finally:
+            audio.release()
+        summary = {
+            "type": "summary",
+            "transcription": assembler.transcript,
+            "segments": len(segments or [audio]),
+            "elapsed_ms": round((time.perf_counter() - started) * 1000)
+        }
+        usage = current_usage()
+        if usage is not None:
+            summary["token_usage"] = usage.summary()
+        yield _encode_stream_record(summary, stream_format)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type=STREAM_MEDIA_TYPES[stream_format],
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/transcribe")
-async def transcribe_audio(file: UploadFile = File(...)):
+async def transcribe_audio(
+    response: Response,
+    file: UploadFile = File(...),
+    bypass_cache: bool = Form(False),
+    long_audio: Optional[bool] = Form(None),
+    stream: Optional[str] = Form(None)
+):
     """
     SPEECH-TO-TEXT (STT): Recibe un archivo de audio (mp3, wav, webm) 
     y retorna la transcripción de texto usando Gemini 1.5 Flash.
+
+    Los WAV largos (más de TRANSCRIBE_LONG_AUDIO_SECONDS, o con `long_audio=true`)
+    se dividen en segmentos solapados que se transcriben en paralelo. Con
+    `stream=ndjson` o `stream=sse` cada segmento se emite en cuanto termina
+    (un audio sin dividir sale como un único segmento).
     """
+    audio = await spool_upload(file)
+    streaming = False
     try:
-        audio_bytes = await file.read()
         mime_type = file.content_type or "audio/mp3"
-        
-        # Usamos la función nueva de gemini_service
-        text = transcribe_audio_with_gemini(audio_bytes, mime_type)
-        
-        return {"transcription": text, "status": "success"}
+
+        segments = None
+        duration = None
+        if long_audio is not False and is_wav(mime_type, file.filename):
+            duration = await asyncio.to_thread(wav_duration, audio)
+            if duration is not None and (long_audio or duration > TRANSCRIBE_LONG_AUDIO_SECONDS):
+                segments = await asyncio.to_thread(plan_segments, audio)
+
+        if stream:
+            streamed = stream_transcription(audio, segments, not bypass_cache, stream, mime_type, duration)
+            # El stream libera el archivo al terminar
+            streaming = True
+            return streamed
+
+        with track_cache() as trace:
+            if segments is None:
+                # Usamos la función nueva de gemini_service
+                text = await transcribe_audio_with_gemini_async(audio, mime_type, use_cache=not bypass_cache)
+            else:
+                assembler = TranscriptAssembler(len(segments))
+                async for segment, segment_text in iter_segment_transcripts(audio, segments, not bypass_cache):
+                    assembler.add(segment.index, segment_text)
+                text = assembler.transcript
+        response.headers.update(trace.headers())
+
+        return {"transcription": text, "status": "success", "segments": len(segments or [audio])}
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error en Transcripción: {str(e)}")
+        raise HTTPException(status_code=502, detail=f"Error en Transcripción: {str(e)}")
+    finally:
+        if not streaming:
+            audio.release()
+
+# ==================== SUBIDAS DIRECTAS AL BUCKET ====================
+
+@app.post("/uploads/presign")
+async def presign_upload(request: PresignRequest):
+    """
+    URL firmada para que el navegador suba un archivo grande directo a Vultr
+    (PUT con las cabeceras devueltas). Si el contenido ya está en el bucket
+    devuelve `exists: true` y no hace falta subir nada.
+    """
+    try:
+        return await asyncio.to_thread(
+            storage_ingest.presign_upload, request.sha256.lower(), request.size, request.filename, request.content_type
+        )
+    except StorageError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
 
 # ==================== ENDPOINTS DE ANÁLISIS DE DATOS ====================
 
 @app.post("/analyze-batch")
 async def analyze_batch(
+    response: Response,
     files: List[UploadFile] = File(...),
-    prompt: str = Form(...)
+    prompt: str = Form(...),
+    concurrency: Optional[int] = Form(None),
+    bypass_cache: bool = Form(False),
+    stream: Optional[str] = Form(None),
+    prescreen_reject: Optional[bool] = Form(None),
+    dedup: bool = Form(False),
+    dedup_distance: int = Form(DEDUP_MAX_DISTANCE)
 ):
-    """ENDPOINT ORIGINAL - Mantiene compatibilidad con frontend actual."""
-    results = []
-    for file in files:
+    """
+    ENDPOINT ORIGINAL - Mantiene compatibilidad con frontend actual.
+
+    Con `stream=ndjson` o `stream=sse` los resultados se emiten según terminan.
+    Con `prescreen_reject=true` las imágenes que no pasan el pre-screen local
+    no se envían a Gemini (status "rejected").
+    Con `dedup=true` solo se analiza un representante por grupo de duplicados.
+    """
+    check_request_size(files)
+
+    async def analyze_one(file: UploadFile) -> Dict[str, Any]:
+        upload = await spool_upload(file)
+        # La subida a Vultr corre en paralelo con el pre-screen y el análisis
+        storage = start_ingest(upload, file.filename, upload.mime_type)
         try:
-            file_bytes = await file.read()
-            mime_type = file.content_type or "application/octet-stream"
-            analysis = quick_analysis(file_bytes, mime_type, prompt)
-            results.append({
+            mime_type = upload.mime_type
+            prescreen = await run_prescreen(upload, mime_type)
+            if should_reject(prescreen, prescreen_reject):
+                result = {"filename": file.filename, "mime_type": mime_type, "prescreen": prescreen, "status": "rejected"}
+                return await with_storage(result, storage)
+
+            analysis = await quick_analysis_async(upload, mime_type, prompt, use_cache=not bypass_cache)
+            return await with_storage(with_prescreen({
                 "filename": file.filename,
                 "mime_type": mime_type,
                 "analysis": analysis,
                 "status": "success"
-            })
-        except Exception as e:
-            results.append({"filename": file.filename, "error": str(e), "status": "failed"})
-    return {"results": results, "total": len(results)}
+            }, prescreen), storage)
+        finally:
+            await release_after_ingest(upload, storage)
+
+    # Mismo modelo y nivel que quick_analysis_async
+    dedup_context = make_cache_key(
+        "analyze-batch", prompt, GeminiModel.FLASH_2_5.value, AnalysisLevel.STANDARD.value
+    ) if dedup else None
+    # Los duplicados no pasan por analyze_one, pero también se guardan en el bucket
+    store_copy = ingest_only if STORAGE_ENABLED else None
+    report: Dict[str, Any] = {}
+    if stream:
+        results_iter = iter_batch_results(
+            files, analyze_one, concurrency, dedup_context, dedup_distance, report, bypass_cache, store_copy
+        )
+        return stream_results(results_iter, len(files), stream, {"duplicates": report} if dedup else None)
+
+    with track_cache() as trace:
+        results_iter = iter_batch_results(
+            files, analyze_one, concurrency, dedup_context, dedup_distance, report, bypass_cache, store_copy
+        )
+        results = await collect_results(results_iter, len(files))
+    response.headers.update(trace.headers())
+    body = {"results": results, "total": len(results)}
+    if dedup:
+        body["duplicates"] = report
+    return body
 
 @app.post("/analyze-advanced")
 async def analyze_advanced(
+    response: Response,
     files: List[UploadFile] = File(...),
     prompt: str = Form(...),
     model: str = Form(GeminiModel.PRO_2_5.value),
-    analysis_level: str = Form(AnalysisLevel.EXPERT.value)
+    analysis_level: str = Form(AnalysisLevel.EXPERT.value),
+    concurrency: Optional[int] = Form(None),
+    bypass_cache: bool = Form(False),
+    stream: Optional[str] = Form(None),
+    prescreen_reject: Optional[bool] = Form(None),
+    dedup: bool = Form(False),
+    dedup_distance: int = Form(DEDUP_MAX_DISTANCE),
+    cascade: bool = Form(CASCADE_DEFAULT)
 ):
-    """Análisis AVANZADO con Gemini Pro y niveles configurables."""
-    results = []
-    for file in files:
+    """
+    Análisis AVANZADO con Gemini Pro y niveles configurables.
+
+    Con `stream=ndjson` o `stream=sse` los resultados se emiten según terminan.
+    Con `dedup=true` solo se analiza un representante por grupo de duplicados.
+    Con `cascade=true` se ignora `model`: cada archivo pasa primero por Flash y
+    solo se escala a Pro si hace falta (`analysis.cascade.tier`).
+    """
+    check_request_size(files)
+
+    async def analyze_one(file: UploadFile) -> Dict[str, Any]:
+        upload = await spool_upload(file)
         try:
-            file_bytes = await file.read()
-            mime_type = file.content_type or "application/octet-stream"
-            analysis = analyze_file_with_gemini(
-                file_bytes, mime_type, prompt, model_name=model, analysis_level=analysis_level
-            )
-            results.append({
+            mime_type = upload.mime_type
+            prescreen = await run_prescreen(upload, mime_type)
+            if should_reject(prescreen, prescreen_reject):
+                return {"filename": file.filename, "prescreen": prescreen, "status": "rejected"}
+
+            if cascade:
+                analysis = await cascade_analysis_async(
+                    upload, mime_type, prompt, analysis_level=analysis_level, use_cache=not bypass_cache
+                )
+            else:
+                analysis = await analyze_file_with_gemini_async(
+                    upload, mime_type, prompt, model_name=model, analysis_level=analysis_level,
+                    use_cache=not bypass_cache
+                )
+            return with_prescreen({
                 "filename": file.filename,
                 "analysis": analysis,
                 "status": "success"
-            })
-        except Exception as e:
-            results.append({"filename": file.filename, "error": str(e), "status": "failed"})
-    
-    return {"results": results, "total": len(results), "model_used": model}
+            }, prescreen)
+        finally:
+            upload.release()
+
+    model_used = "cascade" if cascade else model
+    dedup_context = make_cache_key("analyze-advanced", prompt, model_used, analysis_level) if dedup else None
+    report: Dict[str, Any] = {}
+    if stream:
+        results_iter = iter_batch_results(files, analyze_one, concurrency, dedup_context, dedup_distance, report, bypass_cache)
+        summary_extra = {"model_used": model_used, **({"duplicates": report} if dedup else {})}
+        return stream_results(results_iter, len(files), stream, summary_extra)
+
+    with track_cache() as trace:
+        results_iter = iter_batch_results(files, analyze_one, concurrency, dedup_context, dedup_distance, report, bypass_cache)
+        results = await collect_results(results_iter, len(files))
+    response.headers.update(trace.headers())
+    body = {"results": results, "total": len(results), "model_used": model_used}
+    if dedup:
+        body["duplicates"] = report
+    return body
 
 @app.post("/analyze-json")
 async def analyze_json(request: JSONAnalysisRequest):
     """Analiza datasets JSON estructurados."""
     try:
-        result = analyze_json_dataset(request.data, request.prompt, model_name=request.model)
-        return JSONResponse(content=result)
+        with track_cache() as trace:
+            result = await analyze_json_dataset_async(
+                request.data, request.prompt, model_name=request.model, use_cache=not request.bypass_cache
+            )
+        return JSONResponse(content=result, headers=trace.headers())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/analyze-json-file")
+async def analyze_json_file(
+    file: UploadFile = File(...),
+    prompt: str = Form(...),
+    model: str = Form(GeminiModel.PRO_2_5.value),
+    bypass_cache: bool = Form(False)
+):
+    """
+    Igual que /analyze-json, pero para archivos JSON o NDJSON grandes.
+
+    El archivo se perfila en streaming (memoria acotada) y a Gemini solo llega
+    el perfil más una muestra de registros.
+    """
+    try:
+        with track_cache() as trace:
+            result = await analyze_json_file_async(
+                file.file, prompt, model_name=model, use_cache=not bypass_cache
+            )
+        return JSONResponse(content=result, headers=trace.headers())
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -157,7 +839,7 @@ async def analyze_json(request: JSONAnalysisRequest):
 async def compare_datasets_endpoint(request: CompareRequest):
     """Compara múltiples datasets."""
     try:
-        result = compare_datasets(request.datasets, request.criteria, model_name=request.model)
+        result = await compare_datasets_async(request.datasets, request.criteria, model_name=request.model)
         return JSONResponse(content=result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -166,7 +848,7 @@ async def compare_datasets_endpoint(request: CompareRequest):
 async def synthetic_data_plan(request: SyntheticDataRequest):
     """Genera un plan para datos sintéticos."""
     try:
-        result = generate_synthetic_data_plan(request.original_summary, request.improvements, model_name=request.model)
+        result = await generate_synthetic_data_plan_async(request.original_summary, request.improvements, model_name=request.model)
         return JSONResponse(content=result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -175,24 +857,32 @@ async def synthetic_data_plan(request: SyntheticDataRequest):
 async def bias_analysis(
     file: UploadFile = File(...),
     focus_areas: str = Form('["gender", "race", "age", "geographic", "temporal", "selection"]'),
-    model: str = Form(GeminiModel.PRO_2_5.value)
+    model: str = Form(GeminiModel.PRO_2_5.value),
+    bypass_cache: bool = Form(False)
 ):
     """Análisis EXHAUSTIVO de sesgos."""
+    upload = await spool_upload(file)
     try:
-        import json
-        file_bytes = await file.read()
         mime_type = file.content_type or "application/octet-stream"
         areas = json.loads(focus_areas)
-        result = analyze_bias_detailed(file_bytes, mime_type, areas, model_name=model)
-        return JSONResponse(content={"filename": file.filename, "bias_analysis": result, "status": "success"})
+        with track_cache() as trace:
+            result = await analyze_bias_detailed_async(
+                upload, mime_type, areas, model_name=model, use_cache=not bypass_cache
+            )
+        return JSONResponse(
+            content={"filename": file.filename, "bias_analysis": result, "status": "success"},
+            headers=trace.headers()
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        upload.release()
 
 @app.post("/generate-report")
 async def generate_report(request: BatchReportRequest):
     """Genera reporte ejecutivo consolidado."""
     try:
-        result = generate_data_quality_report(request.analysis_results, model_name=request.model)
+        result = await generate_data_quality_report_async(request.analysis_results, model_name=request.model)
         return JSONResponse(content=result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -200,30 +890,131 @@ async def generate_report(request: BatchReportRequest):
 @app.post("/quick-check")
 async def quick_check(
     file: UploadFile = File(...),
-    prompt: str = Form("Analiza rápidamente si este dato sirve para IA")
+    prompt: str = Form("Analiza rápidamente si este dato sirve para IA"),
+    bypass_cache: bool = Form(False),
+    prescreen_reject: Optional[bool] = Form(None)
 ):
     """Análisis ULTRA-RÁPIDO."""
+    upload = await spool_upload(file)
     try:
-        file_bytes = await file.read()
         mime_type = file.content_type or "application/octet-stream"
-        result = quick_analysis(file_bytes, mime_type, prompt)
-        return JSONResponse(content={"filename": file.filename, "quick_check": result, "status": "success"})
+        prescreen = await run_prescreen(upload, mime_type)
+        if should_reject(prescreen, prescreen_reject):
+            return JSONResponse(content={"filename": file.filename, "prescreen": prescreen, "status": "rejected"})
+
+        with track_cache() as trace:
+            result = await quick_analysis_async(upload, mime_type, prompt, use_cache=not bypass_cache)
+        return JSONResponse(
+            content=with_prescreen({"filename": file.filename, "quick_check": result, "status": "success"}, prescreen),
+            headers=trace.headers()
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        upload.release()
 
 @app.post("/deep-analysis")
 async def deep_analysis_endpoint(
     file: UploadFile = File(...),
-    prompt: str = Form("Análisis experto completo para entrenamiento de IA")
+    prompt: str = Form("Análisis experto completo para entrenamiento de IA"),
+    bypass_cache: bool = Form(False),
+    prescreen_reject: Optional[bool] = Form(None),
+    cascade: bool = Form(CASCADE_DEFAULT)
 ):
-    """Análisis PROFUNDO con Gemini Pro + nivel EXPERT."""
+    """
+    Análisis PROFUNDO con Gemini Pro + nivel EXPERT.
+
+    Con `cascade=true` se intenta primero con Flash y solo se escala a Pro si hace falta.
+    """
+    upload = await spool_upload(file)
     try:
-        file_bytes = await file.read()
         mime_type = file.content_type or "application/octet-stream"
-        result = deep_analysis(file_bytes, mime_type, prompt)
-        return JSONResponse(content={"filename": file.filename, "deep_analysis": result, "status": "success"})
+        prescreen = await run_prescreen(upload, mime_type)
+        if should_reject(prescreen, prescreen_reject):
+            return JSONResponse(content={"filename": file.filename, "prescreen": prescreen, "status": "rejected"})
+
+        with track_cache() as trace:
+            if cascade:
+                result = await cascade_analysis_async(upload, mime_type, prompt, use_cache=not bypass_cache)
+            else:
+                result = await deep_analysis_async(upload, mime_type, prompt, use_cache=not bypass_cache)
+        return JSONResponse(
+            content=with_prescreen({"filename": file.filename, "deep_analysis": result, "status": "success"}, prescreen),
+            headers=trace.headers()
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        upload.release()
+
+# ==================== JOBS ASÍNCRONOS ====================
+
+@app.post("/jobs")
+async def create_job(
+    files: List[UploadFile] = File(...),
+    kind: str = Form("advanced"),
+    prompt: str = Form("Análisis experto completo para entrenamiento de IA"),
+    model: str = Form(GeminiModel.PRO_2_5.value),
+    analysis_level: str = Form(AnalysisLevel.EXPERT.value),
+    focus_areas: str = Form('["gender", "race", "age", "geographic", "temporal", "selection"]'),
+    cascade: bool = Form(CASCADE_DEFAULT)
+):
+    """
+    Encola un análisis grande y devuelve un `job_id` al instante.
+
+    kind: "advanced" (como /analyze-advanced) o "bias" (como /analyze-bias-detailed por archivo).
+    """
+    if kind not in JOB_KINDS:
+        raise HTTPException(status_code=400, detail=f"kind debe ser uno de {list(JOB_KINDS)}")
+    check_request_size(files)
+    try:
+        params = {"prompt": prompt, "model": model, "analysis_level": analysis_level, "cascade": cascade}
+        if kind == "bias":
+            params = {"focus_areas": json.loads(focus_areas), "model": model}
+        job_files = [
+            (file.filename, file.content_type or "application/octet-stream", file.file)
+            for file in files
+        ]
+        job_id = await asyncio.to_thread(job_store.create_job, kind, params, job_files)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return await asyncio.to_thread(job_store.job_status, job_id)
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Estado y progreso del job."""
+    status = await asyncio.to_thread(job_store.job_status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job no encontrado")
+    return status
+
+@app.get("/jobs/{job_id}/results")
+async def get_job_results(job_id: str, since: int = -1):
+    """Resultados terminados hasta ahora (parciales o completos). `since` filtra por índice."""
+    status = await asyncio.to_thread(job_store.job_status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job no encontrado")
+    return {**status, "results": await asyncio.to_thread(job_store.job_results, job_id, since)}
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Progreso del job por SSE: un evento `progress` por cambio y `completed` al terminar."""
+    if await asyncio.to_thread(job_store.job_status, job_id) is None:
+        raise HTTPException(status_code=404, detail="Job no encontrado")
+
+    async def event_stream():
+        last_completed = -1
+        while True:
+            status = await asyncio.to_thread(job_store.job_status, job_id)
+            if status["completed"] != last_completed:
+                last_completed = status["completed"]
+                event = "completed" if status["status"] == "completed" else "progress"
+                yield f"event: {event}\ndata: {json.dumps(status)}\n\n".encode("utf-8")
+                if event == "completed":
+                    return
+            await asyncio.sleep(1)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 # ==================== ENDPOINTS DE UTILIDAD ====================
 
@@ -231,6 +1022,31 @@ async def deep_analysis_endpoint(
 async def health_check():
     return {"status": "healthy", "version": "2.1.0", "services": ["Gemini", "ElevenLabs"]}
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """Métricas de la caché de análisis (aciertos, bytes ahorrados) y de peticiones agrupadas."""
+    return {**analysis_cache.stats(), "singleflight": in_flight.stats()}
+
+@app.get("/scheduler/stats")
+async def scheduler_stats():
+    """Cola de llamadas a Gemini: profundidad y espera por prioridad, cuota disponible por modelo."""
+    return gemini_scheduler.stats()
+
+@app.get("/resilience/stats")
+async def resilience_stats():
+    """Reintentos, hedges y fallbacks de las llamadas a Gemini; estado del circuito y latencia por modelo."""
+    return resilience.stats()
+
+@app.get("/storage/stats")
+async def storage_stats():
+    """Subidas a Vultr: archivos subidos, deduplicados por contenido y URLs firmadas emitidas."""
+    return storage_ingest.stats()
+
+@app.get("/cache/tts/stats")
+async def tts_cache_stats():
+    """Métricas de la caché de audio de /speak."""
+    return audio_cache.stats()
+
 @app.get("/")
 async def root():
     return {
@@ -0,0 +1,106 @@
+import json
+import os
+import time
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+# ==================== RECORRIDO DE CARPETAS ====================
+
+def iter_directory_files(directory: str) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    Archivos de `directory` y sus subcarpetas, en orden estable.
+
+    Se lee una carpeta a la vez (os.scandir), así que el recorrido empieza a
+    producir rutas sin esperar a listar todo el árbol.
+    """
+    with os.scandir(directory) as scan:
+        entries = sorted(scan, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_directory_files(entry.path)
+        elif entry.is_file():
+            yield entry.path, entry.stat()
+
+# ==================== MANIFIESTO INCREMENTAL ====================
+
+MANIFEST_FILENAME = ".optima_manifest.jsonl"
+
+class BatchManifest:
+    """
+    Resultados de un procesamiento de carpeta, una línea JSON por archivo.
+
+    Cada línea guarda ruta relativa, tamaño, mtime, SHA-256 y el resultado, y se
+    escribe en cuanto termina el archivo: si el proceso se cae, lo ya hecho no se
+    pierde. Al releerlo, la última línea de cada ruta es la vigente.
+    """
+
+    def __init__(self, path: str, resume: bool = True):
+        self.path = path
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._by_digest: Dict[str, Dict[str, Any]] = {}
+        self._lines = 0
+        if resume and os.path.exists(path):
+            self._load()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a" if resume else "w", encoding="utf-8")
+
+    def _load(self) -> None:
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Línea a medio escribir por una caída: se ignora
+                    continue
+                self._lines += 1
+                self._index(record)
+
+    def _index(self, record: Dict[str, Any]) -> None:
+        self._entries[record["path"]] = record
+        self._by_digest[record["sha256"]] = record
+
+    def unchanged(self, rel_path: str, stat: os.stat_result) -> Optional[Dict[str, Any]]:
+        """Registro de `rel_path` si su tamaño y mtime no cambiaron desde que se analizó."""
+        record = self._entries.get(rel_path)
+        if record is not None and record["size"] == stat.st_size and record["mtime_ns"] == stat.st_mtime_ns:
+            return record
+        return None
+
+    def by_content(self, digest: str) -> Optional[Dict[str, Any]]:
+        """Registro de cualquier archivo ya analizado con el mismo contenido."""
+        return self._by_digest.get(digest)
+
+    def record(self, rel_path: str, stat: os.stat_result, digest: str, result: Dict[str, Any]) -> None:
+        record = {
+            "path": rel_path,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": digest,
+            "result": result,
+            "updated": time.time()
+        }
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self._lines += 1
+        self._index(record)
+
+    def compact(self, keep: Iterable[str]) -> None:
+        """
+        Reescribe el manifiesto con una línea por ruta de `keep` (las que siguen
+        existiendo). Solo si hay líneas repetidas u obsoletas.
+        """
+        records = [self._entries[path] for path in keep if path in self._entries]
+        if len(records) == self._lines:
+            return
+        self._file.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+        self._lines = len(records)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def close(self) -> None:
+        self._file.close()
@@ -0,0 +1,101 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from budget_service import estimate_tokens
+
+# ==================== CONFIGURACIÓN ====================
+
+# Presupuesto (estimado) de tokens de entrada por llamada; por encima se trocea
+MAPREDUCE_CHUNK_TOKENS = int(os.getenv("MAPREDUCE_CHUNK_TOKENS", "100000"))
+# Llamadas simultáneas al modelo dentro de un mismo map-reduce
+MAPREDUCE_FAN_OUT = int(os.getenv("MAPREDUCE_FAN_OUT", "4"))
+# Resultados parciales que se combinan en cada llamada de reduce
+MAPREDUCE_REDUCE_GROUP = int(os.getenv("MAPREDUCE_REDUCE_GROUP", "8"))
+# Niveles máximos de reduce; en el último se combina todo lo que quede
+MAPREDUCE_MAX_DEPTH = int(os.getenv("MAPREDUCE_MAX_DEPTH", "3"))
+
+Chunk = List[Tuple[int, Any]]
+
+# ==================== TROCEO ====================
+
+def pack_chunks(
+    items: List[Any],
+    max_tokens: int = MAPREDUCE_CHUNK_TOKENS,
+    max_items: Optional[int] = None
+) -> List[Chunk]:
+    """
+    Agrupa `items` en bloques consecutivos de como mucho `max_tokens` (y
+    `max_items`). Cada elemento conserva su índice original. Un elemento que por
+    sí solo supera el presupuesto va en un bloque propio.
+    """
+    chunks: List[Chunk] = []
+    current: Chunk = []
+    used = 0
+    for index, item in enumerate(items):
+        size = estimate_tokens(item)
+        full = max_items is not None and len(current) >= max_items
+        if current and (used + size > max_tokens or full):
+            chunks.append(current)
+            current, used = [], 0
+        current.append((index, item))
+        used += size
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _reduce_groups(partials: List[Dict[str, Any]], depth: int, max_depth: int, group_size: int) -> List[List[Dict[str, Any]]]:
+    if depth >= max_depth:
+        return [partials]
+    groups = pack_chunks(partials, max_items=group_size)
+    return [[partial for _, partial in group] for group in groups]
+
+# ==================== MAP-REDUCE ====================
+
+def map_reduce(
+    chunks: List[Chunk],
+    map_chunk: Callable[[Chunk, int, int], Dict[str, Any]],
+    reduce_partials: Callable[[List[Dict[str, Any]]], Dict[str, Any]],
+    fan_out: int = MAPREDUCE_FAN_OUT,
+    group_size: int = MAPREDUCE_REDUCE_GROUP,
+    max_depth: int = MAPREDUCE_MAX_DEPTH
+) -> Tuple[Dict[str, Any], Dict[str, int]]:
+    """
+    Analiza cada bloque con `map_chunk(chunk, posición, total)` y combina los
+    parciales con `reduce_partials` de forma jerárquica (grupos de `group_size`,
+    como mucho `max_depth` niveles). Devuelve el resultado y métricas del proceso.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, fan_out)) as pool:
+        partials = list(pool.map(lambda args: map_chunk(args[1], args[0], len(chunks)), enumerate(chunks)))
+        depth = 0
+        while len(partials) > 1:
+            depth += 1
+            groups = _reduce_groups(partials, depth, max_depth, group_size)
+            partials = list(pool.map(reduce_partials, groups))
+    return partials[0], {"chunks": len(chunks), "reduce_levels": depth}
+
+async def map_reduce_async(
+    chunks: List[Chunk],
+    map_chunk: Callable[[Chunk, int, int], Awaitable[Dict[str, Any]]],
+    reduce_partials: Callable[[List[Dict[str, Any]]], Awaitable[Dict[str, Any]]],
+    fan_out: int = MAPREDUCE_FAN_OUT,
+    group_size: int = MAPREDUCE_REDUCE_GROUP,
+    max_depth: int = MAPREDUCE_MAX_DEPTH
+) -> Tuple[Dict[str, Any], Dict[str, int]]:
+    """Versión asíncrona de `map_reduce` (fan-out acotado con un semáforo)."""
+    semaphore = asyncio.Semaphore(max(1, fan_out))
+
+    async def bounded(call: Awaitable[Dict[str, Any]]) -> Dict[str, Any]:
+        async with semaphore:
+            return await call
+
+    partials = await asyncio.gather(*(
+        bounded(map_chunk(chunk, position, len(chunks))) for position, chunk in enumerate(chunks)
+    ))
+    depth = 0
+    while len(partials) > 1:
+        depth += 1
+        groups = _reduce_groups(list(partials), depth, max_depth, group_size)
+        partials = await asyncio.gather(*(bounded(reduce_partials(group)) for group in groups))
+    return partials[0], {"chunks": len(chunks), "reduce_levels": depth}
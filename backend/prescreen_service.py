@@ -0,0 +1,149 @@
+import io
+import math
+import os
+from typing import Any, Dict, List, Optional
+
+from PIL import Image, ImageFilter, ImageStat
+
+from spool_service import FileData, open_data
+
+# ==================== CONFIGURACIÓN ====================
+
+PRESCREEN_ENABLED = os.getenv("PRESCREEN_ENABLED", "1") != "0"
+# Si es 1, las imágenes que no pasan los umbrales NO se envían a Gemini
+PRESCREEN_REJECT = os.getenv("PRESCREEN_REJECT", "0") == "1"
+
+PRESCREEN_MIN_WIDTH = int(os.getenv("PRESCREEN_MIN_WIDTH", "64"))
+PRESCREEN_MIN_HEIGHT = int(os.getenv("PRESCREEN_MIN_HEIGHT", "64"))
+PRESCREEN_MAX_ASPECT_RATIO = float(os.getenv("PRESCREEN_MAX_ASPECT_RATIO", "8"))
+PRESCREEN_MIN_BRIGHTNESS = float(os.getenv("PRESCREEN_MIN_BRIGHTNESS", "12"))
+PRESCREEN_MAX_BRIGHTNESS = float(os.getenv("PRESCREEN_MAX_BRIGHTNESS", "243"))
+PRESCREEN_MIN_CONTRAST = float(os.getenv("PRESCREEN_MIN_CONTRAST", "6"))
+PRESCREEN_MIN_BLUR_SCORE = float(os.getenv("PRESCREEN_MIN_BLUR_SCORE", "15"))
+PRESCREEN_MAX_CLIPPED_FRACTION = float(os.getenv("PRESCREEN_MAX_CLIPPED_FRACTION", "0.9"))
+
+# Las métricas de brillo/nitidez se calculan sobre una versión reducida
+_ANALYSIS_SIZE = 512
+
+_LAPLACIAN = ImageFilter.Kernel((3, 3), [0, 1, 0, 1, -4, 1, 0, 1, 0], scale=1, offset=128)
+
+# ==================== PRE-SCREEN ====================
+
+def is_prescreenable(mime_type: str) -> bool:
+    return PRESCREEN_ENABLED and mime_type.startswith("image/")
+
+def _histogram_stats(histogram: List[int]) -> Dict[str, float]:
+    total = sum(histogram) or 1
+    mean = sum(value * count for value, count in enumerate(histogram)) / total
+    variance = sum(count * (value - mean) ** 2 for value, count in enumerate(histogram)) / total
+    return {
+        "brightness": round(mean, 2),
+        "contrast": round(math.sqrt(variance), 2),
+        "dark_fraction": round(sum(histogram[:16]) / total, 4),
+        "bright_fraction": round(sum(histogram[240:]) / total, 4)
+    }
+
+def prescreen_image(file_bytes: FileData) -> Dict[str, Any]:
+    """
+    Métricas locales (sin llamar al modelo) para descartar imágenes inservibles.
+
+    Devuelve resolución, relación de aspecto, brillo/contraste (histograma),
+    fracción de píxeles quemados/negros, nitidez (varianza del Laplaciano) y
+    si el archivo se puede decodificar. `passed` indica si cumple los umbrales.
+
+    Acepta bytes o un archivo en disco: Pillow lee de él solo lo que necesita.
+    """
+    try:
+        with open_data(file_bytes) as f, Image.open(f) as probe:
+            probe.verify()
+        with open_data(file_bytes) as f, Image.open(f) as image:
+            width, height = image.size
+            # draft() deja que el decoder JPEG reduzca al decodificar (mucho más rápido)
+            image.draft("L", (_ANALYSIS_SIZE, _ANALYSIS_SIZE))
+            gray = image.convert("L")
+        gray.thumbnail((_ANALYSIS_SIZE, _ANALYSIS_SIZE))
+    except Exception as e:
+        return {"valid": False, "passed": False, "issues": ["corrupt"], "error": str(e)}
+
+    histogram = gray.histogram()
+    stats = _histogram_stats(histogram)
+    # PIL no filtra el borde de 1 px (lo copia tal cual), así que lo recortamos
+    laplacian = gray.filter(_LAPLACIAN).crop((1, 1, max(2, gray.width - 1), max(2, gray.height - 1)))
+    blur_score = ImageStat.Stat(laplacian).var[0]
+
+    aspect_ratio = max(width, height) / max(1, min(width, height))
+    issues = []
+    if width < PRESCREEN_MIN_WIDTH or height < PRESCREEN_MIN_HEIGHT:
+        issues.append("low_resolution")
+    if aspect_ratio > PRESCREEN_MAX_ASPECT_RATIO:
+        issues.append("extreme_aspect_ratio")
+    if stats["brightness"] < PRESCREEN_MIN_BRIGHTNESS or stats["dark_fraction"] > PRESCREEN_MAX_CLIPPED_FRACTION:
+        issues.append("too_dark")
+    if stats["brightness"] > PRESCREEN_MAX_BRIGHTNESS or stats["bright_fraction"] > PRESCREEN_MAX_CLIPPED_FRACTION:
+        issues.append("overexposed")
+    if stats["contrast"] < PRESCREEN_MIN_CONTRAST:
+        issues.append("low_contrast")
+    if blur_score < PRESCREEN_MIN_BLUR_SCORE:
+        issues.append("blurry")
+
+    return {
+        "valid": True,
+        "passed": not issues,
+        "issues": issues,
+        "width": width,
+        "height": height,
+        "aspect_ratio": round(aspect_ratio, 3),
+        "format": image.format,
+        "mode": image.mode,
+        **stats,
+        "blur_score": round(blur_score, 2),
+        # Histograma compacto de 16 bins (fracciones) para inspección
+        "histogram_16": [
+            round(sum(histogram[i:i + 16]) / (sum(histogram) or 1), 4) for i in range(0, 256, 16)
+        ]
+    }
+
+def should_reject(prescreen: Optional[Dict[str, Any]], reject: Optional[bool] = None) -> bool:
+    """True si el pre-screen falló y el rechazo está activo (por petición o por entorno)."""
+    if prescreen is None:
+        return False
+    enabled = PRESCREEN_REJECT if reject is None else reject
+    return enabled and not prescreen["passed"]
+
+# ==================== BENCHMARK ====================
+
+if __name__ == "__main__":
+    # Throughput del pre-screen sobre un set sintético:  python prescreen_service.py
+    import random
+    import time
+
+    random.seed(0)
+
+    def synthetic_jpeg(kind: str, size=(1280, 960)) -> bytes:
+        if kind == "noise":
+            image = Image.effect_noise(size, 64).convert("RGB")
+        elif kind == "black":
+            image = Image.new("RGB", size, (2, 2, 2))
+        elif kind == "blurred":
+            image = Image.effect_noise(size, 64).convert("RGB").filter(ImageFilter.GaussianBlur(12))
+        elif kind == "tiny":
+            image = Image.effect_noise((32, 32), 64).convert("RGB")
+        else:
+            # "Foto" normal: degradado con textura
+            gradient = Image.linear_gradient("L").resize(size)
+            image = Image.blend(gradient, Image.effect_noise(size, 48), 0.3).convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=90)
+        return buffer.getvalue()
+
+    kinds = ["photo", "photo", "noise", "black", "blurred", "tiny"]
+    dataset = [synthetic_jpeg(random.choice(kinds)) for _ in range(200)]
+    dataset.append(b"not an image")
+
+    started = time.perf_counter()
+    results = [prescreen_image(data) for data in dataset]
+    elapsed = time.perf_counter() - started
+
+    rejected = sum(1 for r in results if not r["passed"])
+    print(f"{len(dataset)} imágenes en {elapsed:.2f}s -> {len(dataset) / elapsed:.1f} img/s")
+    print(f"{rejected} no pasarían el pre-screen (llamadas a Gemini evitadas)")
@@ -0,0 +1,480 @@
+import codecs
+import heapq
+import json
+import math
+import os
+import random
+from collections import Counter
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# ==================== CONFIGURACIÓN ====================
+
+# Registros por bloque: el perfil se calcula columna a columna sobre cada bloque
+PROFILE_CHUNK_ROWS = int(os.getenv("PROFILE_CHUNK_ROWS", "10000"))
+PROFILE_TOP_K = int(os.getenv("PROFILE_TOP_K", "5"))
+PROFILE_SAMPLE_RECORDS = int(os.getenv("PROFILE_SAMPLE_RECORDS", "5"))
+# Hasta cuántas filas distintas se cuentan duplicados de forma exacta (luego se estima)
+PROFILE_EXACT_ROW_LIMIT = int(os.getenv("PROFILE_EXACT_ROW_LIMIT", "1000000"))
+
+_KMV_SIZE = 4096              # tamaño del sketch de valores distintos
+_DISTINCT_EXACT_LIMIT = 8192  # valores distintos exactos por columna antes de estimar
+_TOP_K_CAPACITY = 1024        # candidatos a top-k que se mantienen por columna
+_RESERVOIR_SIZE = 1024        # muestra por columna numérica (cuantiles y outliers)
+_MAX_STRING_CHARS = 120
+_MAX_LIST_ITEMS = 10
+
+# Serialización canónica de cada registro (para detectar filas duplicadas)
+_encode_row = json.JSONEncoder(sort_keys=True, ensure_ascii=False, default=str).encode
+
+_TYPE_NAMES = {
+    str: "string",
+    int: "integer",
+    float: "number",
+    bool: "boolean",
+    type(None): "null",
+    list: "array",
+    dict: "object"
+}
+
+# ==================== ACUMULADORES ====================
+
+def _merge_sample(sample: List[Any], seen: int, chunk: List[Any], size: int, rng: random.Random) -> List[Any]:
+    """Fusiona una muestra uniforme de `seen` elementos con los de `chunk` (sin recorrer uno a uno)."""
+    total = seen + len(chunk)
+    if total <= size:
+        return sample + chunk
+    share = len(chunk) / total
+    from_chunk = sum(1 for _ in range(size) if rng.random() < share)
+    from_sample = min(size - from_chunk, len(sample))
+    from_chunk = min(size - from_sample, len(chunk))
+    return rng.sample(sample, from_sample) + rng.sample(chunk, from_chunk)
+
+class _DistinctCounter:
+    """Valores distintos: exacto hasta `exact_limit`, después estimación KMV (k minimum values)."""
+
+    def __init__(self, exact_limit: int):
+        self.exact_limit = max(exact_limit, _KMV_SIZE)
+        self.exact: Optional[set] = set()
+        self.kmv: List[int] = []
+
+    def add_many(self, hashes: set) -> None:
+        if self.exact is not None:
+            self.exact |= hashes
+            if len(self.exact) > self.exact_limit:
+                self.kmv = heapq.nsmallest(_KMV_SIZE, self.exact)
+                self.exact = None
+            return
+        threshold = self.kmv[-1]
+        candidates = [h for h in hashes if h < threshold]
+        if candidates:
+            self.kmv = heapq.nsmallest(_KMV_SIZE, set(self.kmv).union(candidates))
+
+    def estimate(self) -> Tuple[int, bool]:
+        if self.exact is not None:
+            return len(self.exact), True
+        # hash() de Python está en [-2^63, 2^63): lo normalizamos a (0, 1]
+        kth = (self.kmv[-1] + 2 ** 63 + 1) / 2 ** 64
+        return int((len(self.kmv) - 1) / kth), False
+
+class _NumericStats:
+    """Media/varianza combinando bloques (Chan et al.), min/max y una muestra para cuantiles."""
+
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+        self.sample: List[float] = []
+
+    def add_many(self, values: List[float]) -> None:
+        n = len(values)
+        mean = math.fsum(values) / n
+        m2 = math.fsum([(v - mean) ** 2 for v in values])
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.count * n / total
+        low, high = min(values), max(values)
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self.sample = _merge_sample(self.sample, self.count, values, _RESERVOIR_SIZE, self.rng)
+        self.count = total
+
+    def result(self) -> Dict[str, Any]:
+        ordered = sorted(self.sample)
+
+        def quantile(q: float) -> float:
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+        q1, q3 = quantile(0.25), quantile(0.75)
+        fence = 1.5 * (q3 - q1)
+        outside = sum(1 for v in ordered if v < q1 - fence or v > q3 + fence)
+        return {
+            "count": self.count,
+            "mean": _round(self.mean),
+            "std": _round(math.sqrt(self.m2 / self.count)),
+            "min": self.min,
+            "max": self.max,
+            "p05": quantile(0.05),
+            "p25": q1,
+            "p50": quantile(0.5),
+            "p75": q3,
+            "p95": quantile(0.95),
+            "outliers": round(outside / len(ordered) * self.count),
+            "approximate": self.count > len(ordered)
+        }
+
+class _ColumnProfile:
+    def __init__(self, rng: random.Random):
+        self.present = 0
+        self.types: Counter = Counter()
+        self.numeric = _NumericStats(rng)
+        self.distinct = _DistinctCounter(_DISTINCT_EXACT_LIMIT)
+        self.top: Counter = Counter()
+        self.top_pruned = False
+
+    def add_chunk(self, values: List[Any]) -> None:
+        self.present += len(values)
+        self.types.update(Counter(map(type, values)))
+        # type() en lugar de isinstance(): los bool no cuentan como números
+        numbers = [v for v in values if (type(v) is int or type(v) is float) and v == v]
+        if numbers:
+            self.numeric.add_many(numbers)
+        scalars = {hash((v,)) for v in values if type(v) in (str, int, float, bool)}
+        if scalars:
+            self.distinct.add_many(scalars)
+        labels = [v for v in values if type(v) is str or type(v) is bool]
+        if labels:
+            self.top.update(labels)
+            if len(self.top) > _TOP_K_CAPACITY:
+                self.top = Counter(dict(self.top.most_common(_TOP_K_CAPACITY // 2)))
+                self.top_pruned = True
+
+    def result(self, records: int) -> Dict[str, Any]:
+        types = {_TYPE_NAMES.get(t, t.__name__): count for t, count in self.types.most_common()}
+        distinct, exact = self.distinct.estimate()
+        profile = {
+            "types": types,
+            "missing": records - self.present,
+            "nulls": types.get("null", 0),
+            "distinct": distinct,
+            "distinct_exact": exact
+        }
+        if self.numeric.count:
+            profile["numeric"] = self.numeric.result()
+        if self.top:
+            profile["top_values"] = [[_truncate(value), count] for value, count in self.top.most_common(PROFILE_TOP_K)]
+            profile["top_values_exact"] = not self.top_pruned
+        return profile
+
+def _round(value: float) -> float:
+    return round(value, 6) if math.isfinite(value) else value
+
+def _truncate(value: Any) -> Any:
+    """Recorta strings y listas largas para que la muestra no dispare el tamaño del prompt."""
+    if isinstance(value, str):
+        return value if len(value) <= _MAX_STRING_CHARS else value[:_MAX_STRING_CHARS] + "…"
+    if isinstance(value, list):
+        items = [_truncate(v) for v in value[:_MAX_LIST_ITEMS]]
+        if len(value) > _MAX_LIST_ITEMS:
+            items.append(f"… (+{len(value) - _MAX_LIST_ITEMS})")
+        return items
+    if isinstance(value, dict):
+        return {key: _truncate(v) for key, v in value.items()}
+    return value
+
+def _flatten(value: Any, prefix: str, depth: int, out: Dict[str, Any]) -> int:
+    """Aplana objetos anidados en rutas `a.b.c`; devuelve la profundidad máxima."""
+    if isinstance(value, dict) and value:
+        deepest = depth
+        for key, child in value.items():
+            deepest = max(deepest, _flatten(child, f"{prefix}.{key}" if prefix else str(key), depth + 1, out))
+        return deepest
+    out[prefix or "$"] = value
+    return depth
+
+# ==================== PERFILADOR ====================
+
+class DatasetProfiler:
+    """
+    Perfil de un dataset en una sola pasada y con memoria acotada.
+
+    Los registros se procesan por bloques de `chunk_rows`: cada bloque se aplana,
+    se traspone a columnas y cada columna se resume con operaciones en bloque
+    (Counter, fsum, min/max, sets de hashes). Entre bloques solo se guardan
+    acumuladores de tamaño fijo.
+    """
+
+    def __init__(self, chunk_rows: int = PROFILE_CHUNK_ROWS, sample_records: int = PROFILE_SAMPLE_RECORDS):
+        self.chunk_rows = chunk_rows
+        self.sample_records = sample_records
+        # Semilla fija: el mismo dataset produce el mismo perfil (y el mismo prompt)
+        self.rng = random.Random(0)
+        self.records = 0
+        self.depth = 0
+        self.approx_bytes = 0
+        self.columns: Dict[str, _ColumnProfile] = {}
+        self.rows = _DistinctCounter(PROFILE_EXACT_ROW_LIMIT)
+        self.sample: List[Any] = []
+
+    def add_records(self, records: Iterable[Any]) -> "DatasetProfiler":
+        chunk: List[Any] = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= self.chunk_rows:
+                self._add_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._add_chunk(chunk)
+        return self
+
+    def _add_chunk(self, chunk: List[Any]) -> None:
+        serialized = [_encode_row(record) for record in chunk]
+        self.approx_bytes += sum(map(len, serialized))
+        self.rows.add_many(set(map(hash, serialized)))
+
+        flat_rows = []
+        for record in chunk:
+            flat: Dict[str, Any] = {}
+            self.depth = max(self.depth, _flatten(record, "", 0, flat))
+            flat_rows.append(flat)
+
+        paths = set().union(*flat_rows)
+        for path in paths:
+            column = self.columns.get(path)
+            if column is None:
+                column = self.columns[path] = _ColumnProfile(self.rng)
+            column.add_chunk([row[path] for row in flat_rows if path in row])
+
+        self.sample = _merge_sample(self.sample, self.records, chunk, self.sample_records, self.rng)
+        self.records += len(chunk)
+
+    def result(self) -> Dict[str, Any]:
+        distinct_rows, exact = self.rows.estimate()
+        fields = {path: self.columns[path].result(self.records) for path in sorted(self.columns)}
+        cells = self.records * len(fields)
+        empty = sum(field["missing"] + field["nulls"] for field in fields.values())
+        return {
+            "records": self.records,
+            "fields_count": len(fields),
+            "nested_levels": self.depth,
+            "approx_bytes": self.approx_bytes,
+            "completeness": round(100 * (1 - empty / cells), 2) if cells else 100.0,
+            "duplicates": self.records - distinct_rows,
+            "duplicates_exact": exact,
+            "fields": fields,
+            "sample": [_truncate(record) for record in self.sample]
+        }
+
+def find_records(data: Any) -> Tuple[str, List[Any]]:
+    """
+    Localiza la "tabla" principal dentro de un JSON: la propia lista si la raíz
+    es una lista, o la lista de objetos más larga (hasta 3 niveles). Si no hay
+    ninguna, el objeto completo es un único registro.
+    """
+    if isinstance(data, list):
+        return "$", data
+    best_path, best = "$", None
+    stack = [("$", data, 0)]
+    while stack:
+        path, node, depth = stack.pop()
+        if not isinstance(node, dict) or depth >= 3:
+            continue
+        for key, child in node.items():
+            child_path = f"{path}.{key}"
+            if isinstance(child, list) and child and isinstance(child[0], dict):
+                if best is None or len(child) > len(best):
+                    best_path, best = child_path, child
+            elif isinstance(child, dict):
+                stack.append((child_path, child, depth + 1))
+    if best is None:
+        return "$", [data]
+    return best_path, best
+
+def profile_records(records: Iterable[Any]) -> Dict[str, Any]:
+    return DatasetProfiler().add_records(records).result()
+
+def profile_json(data: Any) -> Dict[str, Any]:
+    """Perfil de un JSON ya cargado en memoria (p. ej. el body de /analyze-json)."""
+    root, records = find_records(data)
+    profile = profile_records(records)
+    profile["root"] = root
+    return profile
+
+# ==================== LECTURA EN STREAMING ====================
+
+class _JSONStreamReader:
+    """Lee valores JSON consecutivos de un stream binario sin cargarlo entero."""
+
+    def __init__(self, stream: IO[bytes], block_size: int):
+        self.stream = stream
+        self.block_size = block_size
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        block = self.stream.read(self.block_size)
+        if not block:
+            self.eof = True
+            self.buffer += self.utf8.decode(b"", final=True)
+            return False
+        if self.pos > self.block_size:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += self.utf8.decode(block)
+        return True
+
+    def peek(self) -> str:
+        """Siguiente carácter no blanco ("" al final del stream)."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # Un número al final del buffer podría seguir en el siguiente bloque
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+def iter_json_records(stream: IO[bytes], block_size: int = 1 << 20) -> Iterator[Any]:
+    """
+    Itera los registros de un archivo JSON o NDJSON con memoria acotada.
+
+    - Lista en la raíz (`[{...}, {...}]`): se leen los elementos de a uno.
+    - NDJSON / valores concatenados: cada valor es un registro.
+    - Un único objeto: se carga y se usa `find_records` para ubicar la tabla.
+    """
+    reader = _JSONStreamReader(stream, block_size)
+    if reader.peek() == "[":
+        reader.pos += 1
+        if reader.peek() == "]":
+            return
+        while True:
+            yield reader.value()
+            separator = reader.peek()
+            if separator == ",":
+                reader.pos += 1
+            elif separator == "]":
+                return
+            else:
+                raise ValueError(f"JSON inválido: se esperaba ',' o ']' y llegó {separator!r}")
+
+    if reader.peek() == "":
+        return
+    first = reader.value()
+    if reader.peek() == "":
+        yield from find_records(first)[1]
+        return
+    yield first
+    while reader.peek():
+        yield reader.value()
+
+# ==================== SECCIONES DEL REPORTE ====================
+
+def profile_report_sections(profile: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Traduce el perfil a las secciones `data_structure`, `data_quality` y
+    `statistical_analysis` con el formato que ya devolvía /analyze-json.
+    """
+    fields = profile["fields"]
+    data_types = {}
+    consistency = []
+    for path, field in fields.items():
+        non_null = {t: c for t, c in field["types"].items() if t != "null"}
+        dominant = max(non_null, key=non_null.get) if non_null else "null"
+        data_types[path] = dominant
+        if non_null:
+            consistency.append(non_null[dominant] / sum(non_null.values()))
+
+    numeric_fields = [
+        {"field": path, **{k: field["numeric"][k] for k in ("mean", "std", "min", "max")}}
+        for path, field in fields.items() if "numeric" in field
+    ]
+    categorical_fields = [
+        {"field": path, "unique_values": field["distinct"], "most_common": field["top_values"][0][0]}
+        for path, field in fields.items() if "top_values" in field and "numeric" not in field
+    ]
+    return {
+        "data_structure": {
+            "schema_valid": True,
+            "fields_count": profile["fields_count"],
+            "nested_levels": profile["nested_levels"],
+            "data_types": data_types
+        },
+        "data_quality": {
+            "completeness": profile["completeness"],
+            "consistency_score": round(100 * sum(consistency) / len(consistency), 2) if consistency else 100.0,
+            "missing_values": {
+                path: field["missing"] + field["nulls"]
+                for path, field in fields.items() if field["missing"] + field["nulls"]
+            },
+            "duplicates": profile["duplicates"],
+            "outliers_detected": any(field["numeric"]["outliers"] for field in fields.values() if "numeric" in field)
+        },
+        "statistical_analysis": {
+            "numeric_fields": numeric_fields,
+            "categorical_fields": categorical_fields
+        }
+    }
+
+# ==================== BENCHMARK ====================
+
+if __name__ == "__main__":
+    # Perfil de un dataset sintético grande:  python profile_service.py [registros]
+    import io
+    import resource
+    import sys
+    import time
+
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    rng = random.Random(1)
+    cities = ["Lima", "Bogotá", "Quito", "Santiago", "CDMX", "Madrid", None]
+
+    def synthetic():
+        for i in range(total):
+            record = {
+                "id": i,
+                "age": rng.randint(18, 90) if i % 50 else None,
+                "income": round(rng.lognormvariate(10, 0.5), 2),
+                "city": rng.choice(cities),
+                "active": rng.random() < 0.7,
+                "meta": {"source": rng.choice(["web", "app"]), "score": rng.random()}
+            }
+            yield record
+            if i % 1000 == 0:  # un duplicado cada 1000 registros
+                yield record
+
+    ndjson = io.BytesIO()
+    for record in synthetic():
+        ndjson.write(json.dumps(record).encode("utf-8") + b"\n")
+    print(f"NDJSON sintético: {total} registros, {ndjson.tell() / 1e6:.1f} MB")
+    ndjson.seek(0)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    profile = profile_records(iter_json_records(ndjson))
+    elapsed = time.perf_counter() - started
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    print(f"Perfil en {elapsed:.2f}s ({total / elapsed:,.0f} registros/s), "
+          f"memoria adicional {rss_growth / 1024:.1f} MB")
+    print(f"duplicados={profile['duplicates']} campos={profile['fields_count']} "
+          f"prompt={len(json.dumps(profile, separators=(',', ':')))} caracteres")
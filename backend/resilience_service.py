@@ -0,0 +1,360 @@
+import asyncio
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from google.api_core.exceptions import Aborted, DeadlineExceeded, InternalServerError, ServiceUnavailable, Unknown
+
+from scheduler_service import SCHEDULER_MAX_IN_FLIGHT
+
+# ==================== CONFIGURACIÓN ====================
+
+# Tiempo máximo de cada intento contra Gemini (sin contar la espera en el planificador)
+GEMINI_CALL_TIMEOUT = float(os.getenv("GEMINI_CALL_TIMEOUT", "120"))
+# Pasado este plazo desde el primer intento ya no se reintenta
+GEMINI_CALL_DEADLINE = float(os.getenv("GEMINI_CALL_DEADLINE", "300"))
+# Reintentos ante errores transitorios (5xx, timeouts, conexión), con backoff exponencial y jitter
+GEMINI_RETRIES = int(os.getenv("GEMINI_RETRIES", "3"))
+GEMINI_RETRY_BASE_SECONDS = float(os.getenv("GEMINI_RETRY_BASE_SECONDS", "0.5"))
+GEMINI_RETRY_MAX_SECONDS = float(os.getenv("GEMINI_RETRY_MAX_SECONDS", "8"))
+# Hedging: si un intento supera este percentil de latencia del modelo se lanza un
+# duplicado y gana el primero (0 = desactivado)
+GEMINI_HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "0"))
+GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+# Circuit breaker: tras N fallos seguidos el modelo se da por caído durante el enfriamiento
+GEMINI_BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "5"))
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+# Modelo al que se desvían las llamadas mientras el circuito de otro está abierto
+DEFAULT_FALLBACKS = {
+    "gemini-2.5-pro": "gemini-2.5-flash",
+    "gemini-2.5-flash": "gemini-1.5-flash",
+    "gemini-1.5-pro": "gemini-2.5-pro",
+    "gemini-1.5-flash": "gemini-2.5-flash"
+}
+GEMINI_FALLBACKS: Dict[str, str] = {**DEFAULT_FALLBACKS, **json.loads(os.getenv("GEMINI_FALLBACKS", "{}"))}
+
+# Latencias recientes que se guardan por modelo
+_LATENCY_SAMPLES = 200
+
+RETRYABLE_ERRORS = (
+    ServiceUnavailable, InternalServerError, DeadlineExceeded, Aborted, Unknown,
+    TimeoutError, ConnectionError
+)
+
+class UpstreamUnavailable(Exception):
+    """El circuito del modelo (y de sus alternativas) está abierto: se falla sin llamar."""
+
+    def __init__(self, model_name: str):
+        super().__init__(f"{model_name} no está disponible (circuito abierto) y no hay modelo alternativo")
+        self.model_name = model_name
+
+# ==================== SALUD POR MODELO ====================
+
+class _ModelHealth:
+    """Circuit breaker y latencias recientes de un modelo."""
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.latencies: Deque[float] = deque(maxlen=_LATENCY_SAMPLES)
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < GEMINI_BREAKER_COOLDOWN:
+            return "open"
+        return "half_open"
+
+class ResilienceRegistry:
+    """Estado compartido por todas las llamadas del proceso."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._health: Dict[str, _ModelHealth] = {}
+        self._stats = {"retries": 0, "hedges": 0, "hedge_wins": 0, "fallbacks": 0, "short_circuits": 0, "timeouts": 0}
+
+    def _model(self, model_name: str) -> _ModelHealth:
+        health = self._health.get(model_name)
+        if health is None:
+            health = self._health[model_name] = _ModelHealth()
+        return health
+
+    def count(self, stat: str) -> None:
+        with self._lock:
+            self._stats[stat] += 1
+
+    def allow(self, model_name: str) -> bool:
+        """Cerrado: sí. Abierto: no. Medio abierto: deja pasar una sola llamada de prueba."""
+        with self._lock:
+            health = self._model(model_name)
+            state = health.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not health.probing:
+                health.probing = True
+                return True
+            return False
+
+    def choose(self, model_name: str) -> str:
+        """`model_name` o, si su circuito está abierto, la primera alternativa disponible."""
+        seen = set()
+        candidate: Optional[str] = model_name
+        while candidate is not None and candidate not in seen:
+            if self.allow(candidate):
+                if candidate != model_name:
+                    self.count("fallbacks")
+                return candidate
+            seen.add(candidate)
+            candidate = GEMINI_FALLBACKS.get(candidate)
+        self.count("short_circuits")
+        raise UpstreamUnavailable(model_name)
+
+    def success(self, model_name: str, latency: float) -> None:
+        with self._lock:
+            health = self._model(model_name)
+            health.failures = 0
+            health.opened_at = None
+            health.probing = False
+            health.latencies.append(latency)
+
+    def release(self, model_name: str) -> None:
+        """La llamada terminó sin decir nada de la salud del modelo (error del cliente, cancelación)."""
+        with self._lock:
+            self._model(model_name).probing = False
+
+    def failure(self, model_name: str) -> None:
+        with self._lock:
+            health = self._model(model_name)
+            health.failures += 1
+            if health.probing or health.failures >= GEMINI_BREAKER_FAILURES:
+                health.opened_at = time.monotonic()
+            health.probing = False
+
+    def hedge_delay(self, model_name: str) -> Optional[float]:
+        """Latencia en el percentil configurado, o None si el hedging está desactivado o faltan muestras."""
+        if GEMINI_HEDGE_PERCENTILE <= 0:
+            return None
+        with self._lock:
+            samples = sorted(self._model(model_name).latencies)
+        if len(samples) < GEMINI_HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * GEMINI_HEDGE_PERCENTILE))]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            models = {}
+            for model_name, health in self._health.items():
+                samples = sorted(health.latencies)
+                models[model_name] = {
+                    "circuit": health.state,
+                    "consecutive_failures": health.failures,
+                    "latency_p50_ms": round(samples[len(samples) // 2] * 1000) if samples else None,
+                    "latency_p95_ms": round(samples[int(len(samples) * 0.95)] * 1000) if samples else None
+                }
+            return {**self._stats, "models": models}
+
+resilience = ResilienceRegistry()
+
+def _backoff(attempt: int) -> float:
+    """Espera antes del reintento `attempt` (0, 1, ...): exponencial con jitter completo."""
+    return random.uniform(0, min(GEMINI_RETRY_MAX_SECONDS, GEMINI_RETRY_BASE_SECONDS * 2 ** attempt))
+
+# ==================== LLAMADA SÍNCRONA ====================
+
+# Hilos para los intentos (principal y duplicado) de las llamadas síncronas con
+# hedging. Cada intento puede quedarse esperando turno en el planificador, así
+# que hay sitio para el principal y el duplicado de cada llamada en vuelo: el
+# pool nunca limita por debajo del planificador ni deja un duplicado en cola
+# detrás de intentos que solo esperan permiso.
+_hedge_pool = ThreadPoolExecutor(max_workers=2 * max(1, SCHEDULER_MAX_IN_FLIGHT), thread_name_prefix="gemini-hedge")
+
+def _hedged(model_name: str, attempt: Callable[[str, float], Any], timeout: float) -> Any:
+    delay = resilience.hedge_delay(model_name)
+    if delay is None or delay >= timeout:
+        return attempt(model_name, timeout)
+
+    # Los intentos corren en el pool con el contexto del llamante (prioridad del planificador)
+    context = contextvars.copy_context()
+    primary = _hedge_pool.submit(context.copy().run, attempt, model_name, timeout)
+    done, pending = wait({primary}, timeout=delay)
+    if not done:
+        resilience.count("hedges")
+        pending.add(_hedge_pool.submit(context.copy().run, attempt, model_name, timeout))
+    error: Optional[BaseException] = None
+    while True:
+        for future in done:
+            if future.exception() is None:
+                if future is not primary:
+                    resilience.count("hedge_wins")
+                # Un hilo no se puede cancelar: el perdedor termina solo y se descarta
+                return future.result()
+            error = future.exception()
+        if not pending:
+            raise error
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+def call_with_resilience(model_name: str, attempt: Callable[[str, float], Any]) -> Tuple[str, Any]:
+    """
+    Ejecuta `attempt(modelo, timeout)` con reintentos, hedging y circuit breaker.
+    Devuelve (modelo usado, respuesta); el modelo puede ser una alternativa si el
+    circuito del pedido está abierto.
+    """
+    deadline = time.monotonic() + GEMINI_CALL_DEADLINE
+    for retry in range(GEMINI_RETRIES + 1):
+        chosen = resilience.choose(model_name)
+        timeout = min(GEMINI_CALL_TIMEOUT, max(1.0, deadline - time.monotonic()))
+        started = time.monotonic()
+        try:
+            response = _hedged(chosen, attempt, timeout)
+        except RETRYABLE_ERRORS as e:
+            resilience.failure(chosen)
+            if isinstance(e, (TimeoutError, DeadlineExceeded)):
+                resilience.count("timeouts")
+            pause = _backoff(retry)
+            if retry == GEMINI_RETRIES or time.monotonic() + pause >= deadline:
+                raise
+            resilience.count("retries")
+            time.sleep(pause)
+            continue
+        except BaseException:
+            resilience.release(chosen)
+            raise
+        resilience.success(chosen, time.monotonic() - started)
+        return chosen, response
+
+# ==================== LLAMADA ASÍNCRONA ====================
+
+async def _hedged_async(model_name: str, attempt: Callable[[str, float], Awaitable[Any]], timeout: float) -> Any:
+    delay = resilience.hedge_delay(model_name)
+    if delay is None or delay >= timeout:
+        return await attempt(model_name, timeout)
+
+    primary = asyncio.ensure_future(attempt(model_name, timeout))
+    tasks: List[asyncio.Future] = [primary]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            resilience.count("hedges")
+            tasks.append(asyncio.ensure_future(attempt(model_name, timeout)))
+        error: Optional[BaseException] = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        resilience.count("hedge_wins")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        # El intento perdedor se cancela (y libera su turno en el planificador)
+        for task in tasks:
+            task.cancel()
+
+async def call_with_resilience_async(
+    model_name: str,
+    attempt: Callable[[str, float], Awaitable[Any]]
+) -> Tuple[str, Any]:
+    """Versión asíncrona de `call_with_resilience`; el intento perdedor de un hedge se cancela."""
+    deadline = time.monotonic() + GEMINI_CALL_DEADLINE
+    for retry in range(GEMINI_RETRIES + 1):
+        chosen = resilience.choose(model_name)
+        timeout = min(GEMINI_CALL_TIMEOUT, max(1.0, deadline - time.monotonic()))
+        started = time.monotonic()
+        try:
+            response = await _hedged_async(chosen, attempt, timeout)
+        except RETRYABLE_ERRORS as e:
+            resilience.failure(chosen)
+            if isinstance(e, (TimeoutError, DeadlineExceeded)):
+                resilience.count("timeouts")
+            pause = _backoff(retry)
+            if retry == GEMINI_RETRIES or time.monotonic() + pause >= deadline:
+                raise
+            resilience.count("retries")
+            await asyncio.sleep(pause)
+            continue
+        except BaseException:
+            resilience.release(chosen)
+            raise
+        resilience.success(chosen, time.monotonic() - started)
+        return chosen, response
+
+if __name__ == "__main__":
+    # Benchmark con un modelo falso que inyecta fallos:  python resilience_service.py [llamadas]
+    # Un 10% de errores 503, un 5% de respuestas en cola (3 s) y un modelo Pro que se cae a mitad.
+    import sys
+
+    CALLS = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    GEMINI_CALL_TIMEOUT = 1.0
+    GEMINI_RETRY_BASE_SECONDS = 0.05
+    GEMINI_HEDGE_PERCENTILE = 0.9
+    GEMINI_BREAKER_COOLDOWN = 2.0
+
+    class FaultyModel:
+        def __init__(self, error_rate: float, tail_rate: float, down: bool = False):
+            self.error_rate = error_rate
+            self.tail_rate = tail_rate
+            self.down = down
+            self.calls = 0
+
+        async def generate_content_async(self, timeout: float) -> str:
+            self.calls += 1
+            await asyncio.sleep(0.01)
+            if self.down or random.random() < self.error_rate:
+                raise ServiceUnavailable("fallo inyectado")
+            await asyncio.sleep(3.0 if random.random() < self.tail_rate else random.uniform(0.05, 0.15))
+            return "ok"
+
+    def percentile(values: List[float], fraction: float) -> float:
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+    async def run(label: str, models: Dict[str, FaultyModel], protected: bool) -> None:
+        latencies: List[float] = []
+        failures = 0
+        semaphore = asyncio.Semaphore(32)
+
+        async def attempt(model_name: str, timeout: float) -> str:
+            return await asyncio.wait_for(models[model_name].generate_content_async(timeout), timeout)
+
+        async def one(index: int) -> None:
+            nonlocal failures
+            # Llegadas repartidas en el tiempo; Pro se cae a mitad del benchmark
+            await asyncio.sleep(index * 0.005)
+            if index == CALLS // 2:
+                models["gemini-2.5-pro"].down = True
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    if protected:
+                        await call_with_resilience_async("gemini-2.5-pro", attempt)
+                    else:
+                        await models["gemini-2.5-pro"].generate_content_async(GEMINI_CALL_TIMEOUT)
+                except Exception:
+                    failures += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(index) for index in range(CALLS)))
+        elapsed = time.perf_counter() - started
+        upstream = sum(model.calls for model in models.values())
+        print(
+            f"{label}: éxito {100 * (CALLS - failures) / CALLS:.1f}% · p50 {percentile(latencies, 0.5):.0f} ms · "
+            f"p99 {percentile(latencies, 0.99):.0f} ms · {upstream} llamadas reales · {elapsed:.1f}s"
+        )
+
+    def fake_models() -> Dict[str, FaultyModel]:
+        return {name: FaultyModel(0.1, 0.05) for name in ("gemini-2.5-pro", "gemini-2.5-flash", "gemini-1.5-flash")}
+
+    asyncio.run(run("sin resiliencia", fake_models(), protected=False))
+    asyncio.run(run("con resiliencia", fake_models(), protected=True))
+    print(json.dumps(resilience.stats(), indent=2))
@@ -0,0 +1,324 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, List, Optional, Tuple
+
+# ==================== CONFIGURACIÓN ====================
+
+SCHEDULER_ENABLED = os.getenv("GEMINI_SCHEDULER_ENABLED", "1") != "0"
+
+# Cuotas por minuto de cada modelo (peticiones y tokens de entrada). Se ajustan a
+# la cuota real del proyecto con GEMINI_RATE_LIMITS='{"gemini-2.5-pro": {"rpm": 150, "tpm": 2000000}}'
+DEFAULT_RATE_LIMITS: Dict[str, Dict[str, int]] = {
+    "gemini-2.5-pro": {"rpm": 150, "tpm": 2_000_000},
+    "gemini-2.5-flash": {"rpm": 1000, "tpm": 1_000_000},
+    "gemini-1.5-pro": {"rpm": 150, "tpm": 2_000_000},
+    "gemini-1.5-flash": {"rpm": 1000, "tpm": 1_000_000}
+}
+RATE_LIMITS: Dict[str, Dict[str, int]] = {**DEFAULT_RATE_LIMITS, **json.loads(os.getenv("GEMINI_RATE_LIMITS", "{}"))}
+
+# Llamadas a Gemini en vuelo por proceso (todas las prioridades)
+SCHEDULER_MAX_IN_FLIGHT = int(os.getenv("GEMINI_MAX_IN_FLIGHT", "16"))
+# Reintentos tras un 429 de Gemini (la petición vuelve a la cola, no falla)
+SCHEDULER_429_RETRIES = int(os.getenv("GEMINI_429_RETRIES", "3"))
+# Tras un 429 el modelo se pausa este tiempo si la respuesta no indica otro
+SCHEDULER_429_COOLDOWN = float(os.getenv("GEMINI_429_COOLDOWN", "10"))
+
+# Esperas recientes que se guardan por prioridad para calcular percentiles
+_WAIT_SAMPLES = 1000
+
+class Priority(IntEnum):
+    """Clases de prioridad, de mayor a menor."""
+    INTERACTIVE = 0
+    REPORT = 1
+    BATCH = 2
+
+# ==================== CONTEXTO DE LA LLAMADA ====================
+
+# (prioridad, cliente) de las llamadas hechas en el contexto actual. Fuera de una
+# petición HTTP (jobs, scripts) las llamadas son de lote.
+_call_context: ContextVar[Tuple[Priority, str]] = ContextVar("gemini_call_context", default=(Priority.BATCH, "local"))
+
+@contextmanager
+def call_context(priority: Optional[Priority] = None, client: Optional[str] = None) -> Iterator[None]:
+    """Fija la prioridad y/o el cliente de las llamadas a Gemini hechas dentro del bloque."""
+    current_priority, current_client = _call_context.get()
+    token = _call_context.set((
+        current_priority if priority is None else priority,
+        current_client if client is None else client
+    ))
+    try:
+        yield
+    finally:
+        _call_context.reset(token)
+
+# ==================== TOKEN BUCKETS ====================
+
+class _Bucket:
+    """Cuota por minuto que se recarga de forma continua (capacidad = un minuto)."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(max(1, per_minute))
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float, now: float) -> float:
+        """Segundos hasta poder gastar `amount` (0 si ya se puede)."""
+        # Una petición más grande que la cuota entera pasa con el balde lleno
+        amount = min(amount, self.capacity)
+        pause = max(0.0, self.paused_until - now)
+        if self.level >= amount:
+            return pause
+        return max(pause, (amount - self.level) / self.rate)
+
+class _ModelQuota:
+    def __init__(self, limits: Dict[str, int]):
+        self.requests = _Bucket(limits.get("rpm", 1000))
+        self.tokens = _Bucket(limits.get("tpm", 1_000_000))
+
+    def wait_for(self, tokens: int, now: float) -> float:
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return max(self.requests.wait_for(1, now), self.tokens.wait_for(tokens, now))
+
+    def take(self, tokens: int) -> None:
+        self.requests.level -= 1
+        self.tokens.level -= tokens
+
+# ==================== PLANIFICADOR ====================
+
+class _Waiter:
+    def __init__(self, model: str, tokens: int, priority: Priority, client: str):
+        self.model = model
+        self.tokens = tokens
+        self.priority = priority
+        self.client = client
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.cancelled = False
+        self._event = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._future: Optional[asyncio.Future] = None
+
+    def wake(self) -> None:
+        if self._future is not None:
+            self._loop.call_soon_threadsafe(lambda: self._future.done() or self._future.set_result(None))
+        else:
+            self._event.set()
+
+class Permit:
+    """Autorización para una llamada; `settle` corrige los tokens con el uso real."""
+
+    def __init__(self, scheduler: "GeminiScheduler", waiter: _Waiter):
+        self._scheduler = scheduler
+        self.model = waiter.model
+        self.tokens = waiter.tokens
+        self.waited = time.monotonic() - waiter.enqueued
+
+    def settle(self, actual_tokens: Optional[int]) -> None:
+        if actual_tokens is not None:
+            self._scheduler._adjust(self.model, actual_tokens - self.tokens)
+            self.tokens = actual_tokens
+
+class GeminiScheduler:
+    """
+    Cola única para todas las llamadas a Gemini del proceso.
+
+    Cada modelo tiene un token bucket de peticiones y otro de tokens por
+    minuto: cuando se agota la cuota las llamadas esperan en cola en lugar de
+    recibir un 429. La cola atiende primero la prioridad más alta y, dentro de
+    una prioridad, reparte por turnos entre clientes para que uno con muchas
+    llamadas no acapare la cuota. Una llamada de menor prioridad solo se
+    adelanta si usa otro modelo que el de las que esperan por encima.
+    """
+
+    def __init__(self, limits: Dict[str, Dict[str, int]] = RATE_LIMITS, max_in_flight: int = SCHEDULER_MAX_IN_FLIGHT):
+        self.limits = limits
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        self._quotas: Dict[str, _ModelQuota] = {}
+        # prioridad -> cliente -> cola; el orden de clientes es el turno
+        self._queues: Dict[Priority, "OrderedDict[str, Deque[_Waiter]]"] = {p: OrderedDict() for p in Priority}
+        self._in_flight = 0
+        self._timer: Optional[threading.Timer] = None
+        self._timer_due = 0.0
+        self._waits: Dict[Priority, Deque[float]] = {p: deque(maxlen=_WAIT_SAMPLES) for p in Priority}
+        self._stats = {"granted": 0, "rate_limited": 0, "cancelled": 0}
+
+    def _quota(self, model: str) -> _ModelQuota:
+        quota = self._quotas.get(model)
+        if quota is None:
+            quota = self._quotas[model] = _ModelQuota(self.limits.get(model, {}))
+        return quota
+
+    # ---------- cola ----------
+
+    def _enqueue(self, waiter: _Waiter) -> None:
+        with self._lock:
+            self._queues[waiter.priority].setdefault(waiter.client, deque()).append(waiter)
+            self._dispatch()
+
+    def _remove(self, waiter: _Waiter) -> None:
+        clients = self._queues[waiter.priority]
+        queue = clients.get(waiter.client)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del clients[waiter.client]
+
+    def _dispatch(self) -> None:
+        """Concede turnos mientras haya capacidad. Se llama con `_lock` tomado."""
+        while self._in_flight < self.max_in_flight:
+            now = time.monotonic()
+            waiter, retry_in = self._next_waiter(now)
+            if waiter is None:
+                if retry_in is not None:
+                    self._schedule(retry_in)
+                return
+            self._remove(waiter)
+            # El cliente atendido pasa al final del turno de su prioridad
+            if waiter.client in self._queues[waiter.priority]:
+                self._queues[waiter.priority].move_to_end(waiter.client)
+            self._quota(waiter.model).take(waiter.tokens)
+            self._in_flight += 1
+            waiter.granted = True
+            self._waits[waiter.priority].append(now - waiter.enqueued)
+            self._stats["granted"] += 1
+            waiter.wake()
+
+    def _next_waiter(self, now: float) -> Tuple[Optional[_Waiter], Optional[float]]:
+        blocked_models = set()
+        retry_in: Optional[float] = None
+        for priority in Priority:
+            for queue in self._queues[priority].values():
+                waiter = queue[0]
+                if waiter.model in blocked_models:
+                    continue
+                wait = self._quota(waiter.model).wait_for(waiter.tokens, now)
+                if wait <= 0:
+                    return waiter, None
+                blocked_models.add(waiter.model)
+                retry_in = wait if retry_in is None else min(retry_in, wait)
+        return None, retry_in
+
+    def _schedule(self, delay: float) -> None:
+        due = time.monotonic() + delay
+        if self._timer is not None and self._timer_due <= due:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._on_timer)
+        self._timer.daemon = True
+        self._timer_due = due
+        self._timer.start()
+
+    def _on_timer(self) -> None:
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+    def _release(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            self._dispatch()
+
+    def _adjust(self, model: str, tokens: int) -> None:
+        with self._lock:
+            self._quota(model).tokens.level -= tokens
+
+    def rate_limited(self, model: str, retry_after: Optional[float] = None) -> None:
+        """Gemini respondió 429: el modelo no recibe más llamadas durante un rato."""
+        with self._lock:
+            quota = self._quota(model)
+            until = time.monotonic() + (retry_after or SCHEDULER_429_COOLDOWN)
+            quota.requests.paused_until = max(quota.requests.paused_until, until)
+            self._stats["rate_limited"] += 1
+
+    # ---------- API ----------
+
+    def _waiter(self, model: str, tokens: int) -> _Waiter:
+        priority, client = _call_context.get()
+        return _Waiter(model, max(0, tokens), priority, client)
+
+    @contextmanager
+    def acquire(self, model: str, tokens: int) -> Iterator[Permit]:
+        """Espera (bloqueando el hilo) un turno para llamar a `model` con ~`tokens` de entrada."""
+        waiter = self._waiter(model, tokens)
+        self._enqueue(waiter)
+        waiter._event.wait()
+        try:
+            yield Permit(self, waiter)
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def acquire_async(self, model: str, tokens: int) -> AsyncIterator[Permit]:
+        """Versión asíncrona de `acquire`: la espera no bloquea el event loop."""
+        waiter = self._waiter(model, tokens)
+        waiter._loop = asyncio.get_running_loop()
+        waiter._future = waiter._loop.create_future()
+        self._enqueue(waiter)
+        try:
+            await waiter._future
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    self._remove(waiter)
+                    self._stats["cancelled"] += 1
+            if granted:
+                self._release()
+            raise
+        try:
+            yield Permit(self, waiter)
+        finally:
+            self._release()
+
+    def stats(self) -> Dict[str, Any]:
+        def percentile(samples: List[float], fraction: float) -> float:
+            return round(samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000, 1)
+
+        with self._lock:
+            now = time.monotonic()
+            queues = {}
+            for priority in Priority:
+                waiting = [waiter for queue in self._queues[priority].values() for waiter in queue]
+                waits = sorted(self._waits[priority])
+                queues[priority.name.lower()] = {
+                    "depth": len(waiting),
+                    "clients": len(self._queues[priority]),
+                    "oldest_wait_ms": round(max((now - w.enqueued for w in waiting), default=0) * 1000, 1),
+                    "wait_p50_ms": percentile(waits, 0.5) if waits else 0.0,
+                    "wait_p95_ms": percentile(waits, 0.95) if waits else 0.0
+                }
+            models = {}
+            for model, quota in self._quotas.items():
+                quota.requests.refill(now)
+                quota.tokens.refill(now)
+                models[model] = {
+                    "requests_available": int(quota.requests.level),
+                    "tokens_available": int(quota.tokens.level),
+                    "paused_s": round(max(0.0, quota.requests.paused_until - now), 1)
+                }
+            return {
+                "enabled": SCHEDULER_ENABLED,
+                "in_flight": self._in_flight,
+                "max_in_flight": self.max_in_flight,
+                "queues": queues,
+                "models": models,
+                **self._stats
+            }
+
+gemini_scheduler = GeminiScheduler()
@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import io
+import os
+import tempfile
+import weakref
+from typing import BinaryIO, Iterator, List, Tuple, Union
+
+from fastapi import UploadFile
+
+# ==================== CONFIGURACIÓN ====================
+
+# Tamaño de bloque al copiar/leer archivos subidos
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1024 * 1024)))
+# Límite por archivo y por petición (suma de todos los archivos)
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(2 * 1024 ** 3)))
+UPLOAD_MAX_REQUEST_BYTES = int(os.getenv("UPLOAD_MAX_REQUEST_BYTES", str(20 * 1024 ** 3)))
+# Starlette mantiene en memoria cada archivo de hasta este tamaño mientras dura la petición
+UPLOAD_MEMORY_BYTES = int(os.getenv("UPLOAD_MEMORY_BYTES", str(256 * 1024)))
+# Carpeta de los archivos volcados a disco (por defecto la temporal del sistema)
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None
+
+# Contenido de un archivo: bytes en memoria o un archivo en disco
+FileData = Union[bytes, os.PathLike]
+
+class UploadTooLarge(Exception):
+    """El archivo (o la petición) supera el límite configurado."""
+
+    def __init__(self, filename: str, limit: int):
+        super().__init__(f"{filename} supera el límite de {limit} bytes")
+        self.filename = filename
+        self.limit = limit
+
+# ==================== ACCESO A DATOS ====================
+
+def data_size(data: FileData) -> int:
+    if isinstance(data, os.PathLike):
+        return os.path.getsize(data)
+    return len(data)
+
+def open_data(data: FileData) -> BinaryIO:
+    """Abre el contenido como archivo binario (el llamador lo cierra)."""
+    if isinstance(data, os.PathLike):
+        return open(data, "rb")
+    return io.BytesIO(data)
+
+def read_data(data: FileData) -> bytes:
+    """Contenido completo en memoria; usar solo justo antes de necesitarlo."""
+    if isinstance(data, os.PathLike):
+        with open(data, "rb") as f:
+            return f.read()
+    return bytes(data)
+
+def iter_blocks(stream: BinaryIO, block_size: int = UPLOAD_CHUNK_BYTES) -> Iterator[bytes]:
+    return iter(lambda: stream.read(block_size), b"")
+
+def digest_stream(stream: BinaryIO) -> Tuple[str, int]:
+    """SHA-256 y tamaño de un archivo leído por bloques; deja el cursor al inicio."""
+    digest = hashlib.sha256()
+    size = 0
+    for block in iter_blocks(stream):
+        digest.update(block)
+        size += len(block)
+    stream.seek(0)
+    return digest.hexdigest(), size
+
+# ==================== VOLCADO A DISCO ====================
+
+def _unlink(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+class SpooledUpload:
+    """
+    Archivo subido copiado a un temporal propio.
+
+    Es `os.PathLike`, así que se pasa directamente a los servicios de análisis
+    en lugar de los bytes. `release()` borra el temporal (también al recolectarse).
+    """
+
+    def __init__(self, path: str, filename: str, mime_type: str, size: int):
+        self.path = path
+        self.filename = filename
+        self.mime_type = mime_type
+        self.size = size
+        self._finalizer = weakref.finalize(self, _unlink, path)
+
+    def __fspath__(self) -> str:
+        return self.path
+
+    def release(self) -> None:
+        self._finalizer()
+
+def _copy_to_spool(source: BinaryIO, filename: str, max_bytes: int) -> Tuple[str, int]:
+    fd, path = tempfile.mkstemp(prefix="upload-", dir=UPLOAD_SPOOL_DIR)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for block in iter_blocks(source):
+                size += len(block)
+                if size > max_bytes:
+                    raise UploadTooLarge(filename, max_bytes)
+                out.write(block)
+    except BaseException:
+        _unlink(path)
+        raise
+    return path, size
+
+async def spool_upload(file: UploadFile, max_bytes: int = UPLOAD_MAX_FILE_BYTES) -> SpooledUpload:
+    """
+    Copia un `UploadFile` por bloques a un temporal y cierra el original.
+
+    El contenido nunca está completo en memoria; lanza `UploadTooLarge` si
+    supera `max_bytes`.
+    """
+    filename = file.filename or "upload"
+    if file.size is not None and file.size > max_bytes:
+        raise UploadTooLarge(filename, max_bytes)
+    await file.seek(0)
+    path, size = await asyncio.to_thread(_copy_to_spool, file.file, filename, max_bytes)
+    await file.close()
+    return SpooledUpload(path, filename, file.content_type or "application/octet-stream", size)
+
+def check_request_size(files: List[UploadFile], max_bytes: int = UPLOAD_MAX_REQUEST_BYTES) -> None:
+    """Rechaza la petición completa si la suma de los archivos supera `max_bytes`."""
+    total = sum(file.size or 0 for file in files)
+    if total > max_bytes:
+        raise UploadTooLarge(f"La petición ({len(files)} archivos)", max_bytes)
+
+if __name__ == "__main__":
+    # Memoria pico al volcar un lote grande:  python spool_service.py [archivos] [MB por archivo]
+    import resource
+    import sys
+    import time
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    megabytes = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    block = os.urandom(UPLOAD_CHUNK_BYTES)
+
+    def synthetic_upload(index: int) -> UploadFile:
+        source = tempfile.TemporaryFile(dir=UPLOAD_SPOOL_DIR)
+        for _ in range(megabytes * 1024 * 1024 // len(block)):
+            source.write(block)
+        size = source.tell()
+        source.seek(0)
+        return UploadFile(source, size=size, filename=f"file{index}.bin")
+
+    async def process(upload: UploadFile, semaphore: asyncio.Semaphore) -> int:
+        # Como /analyze-batch: volcar, leer el contenido al "llamar" y liberar
+        async with semaphore:
+            spooled = await spool_upload(upload)
+            try:
+                with open_data(spooled) as f:
+                    return sum(len(chunk) for chunk in iter_blocks(f))
+            finally:
+                spooled.release()
+
+    async def main() -> int:
+        semaphore = asyncio.Semaphore(8)
+        uploads = [synthetic_upload(index) for index in range(count)]
+        return sum(await asyncio.gather(*(process(upload, semaphore) for upload in uploads)))
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    total = asyncio.run(main())
+    elapsed = time.perf_counter() - started
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    print(f"{count} archivos, {total / 1e6:.0f} MB en {elapsed:.2f}s; "
+          f"memoria adicional {rss_growth / 1024:.1f} MB")
@@ -0,0 +1,93 @@
+import asyncio
+
+from budget_service import estimate_tokens
+from mapreduce_service import map_reduce, map_reduce_async, pack_chunks
+
+
+def _text(tokens):
+    """Texto que estima exactamente `tokens` tokens."""
+    text = "x" * ((tokens - 1) * 4)
+    assert estimate_tokens(text) == tokens
+    return text
+
+
+def test_pack_chunks_respects_budget_and_keeps_indexes():
+    items = [_text(40), _text(40), _text(40), _text(40)]
+    chunks = pack_chunks(items, max_tokens=100)
+    assert [[index for index, _ in chunk] for chunk in chunks] == [[0, 1], [2, 3]]
+    assert chunks[1][0] == (2, items[2])
+
+
+def test_pack_chunks_oversized_item_gets_its_own_chunk():
+    items = [_text(10), _text(500), _text(10)]
+    chunks = pack_chunks(items, max_tokens=100)
+    assert [[index for index, _ in chunk] for chunk in chunks] == [[0], [1], [2]]
+
+
+def test_pack_chunks_max_items():
+    chunks = pack_chunks(list(range(7)), max_tokens=10_000, max_items=3)
+    assert [len(chunk) for chunk in chunks] == [3, 3, 1]
+
+
+def test_pack_chunks_empty():
+    assert pack_chunks([]) == []
+
+
+def _map(chunk, position, total):
+    return {"items": [index for index, _ in chunk]}
+
+
+def _reduce(partials):
+    return {"items": sorted(index for partial in partials for index in partial["items"])}
+
+
+def test_map_reduce_hierarchical_levels():
+    chunks = pack_chunks(list(range(20)), max_items=1)
+    result, stats = map_reduce(chunks, _map, _reduce, group_size=4, max_depth=5)
+    assert result == {"items": list(range(20))}
+    # 20 parciales -> 5 -> 2 -> 1
+    assert stats == {"chunks": 20, "reduce_levels": 3}
+
+
+def test_map_reduce_depth_cap_collapses_to_one_group():
+    groups = []
+
+    def reduce_partials(partials):
+        groups.append(len(partials))
+        return _reduce(partials)
+
+    chunks = pack_chunks(list(range(20)), max_items=1)
+    result, stats = map_reduce(chunks, _map, reduce_partials, group_size=4, max_depth=1)
+    assert result == {"items": list(range(20))}
+    assert stats["reduce_levels"] == 1
+    assert groups == [20]
+
+
+def test_map_reduce_single_chunk_skips_reduce():
+    calls = []
+    result, stats = map_reduce(pack_chunks([1, 2]), _map, lambda p: calls.append(p), max_depth=3)
+    assert result == {"items": [0, 1]}
+    assert stats == {"chunks": 1, "reduce_levels": 0}
+    assert calls == []
+
+
+def test_map_reduce_async_bounds_fan_out():
+    running = 0
+    peak = 0
+
+    async def map_chunk(chunk, position, total):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return _map(chunk, position, total)
+
+    async def reduce_partials(partials):
+        return _reduce(partials)
+
+    chunks = pack_chunks(list(range(12)), max_items=1)
+    result, stats = asyncio.run(map_reduce_async(chunks, map_chunk, reduce_partials, fan_out=3, group_size=4, max_depth=2))
+    assert result == {"items": list(range(12))}
+    assert stats == {"chunks": 12, "reduce_levels": 2}
+    assert peak == 3
@@ -0,0 +1,179 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from google.api_core.exceptions import InvalidArgument, ServiceUnavailable
+
+import resilience_service
+from resilience_service import ResilienceRegistry, UpstreamUnavailable, call_with_resilience, call_with_resilience_async
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Registro limpio por test y reintentos sin espera."""
+    fresh = ResilienceRegistry()
+    monkeypatch.setattr(resilience_service, "resilience", fresh)
+    monkeypatch.setattr(resilience_service, "GEMINI_RETRY_BASE_SECONDS", 0)
+    monkeypatch.setattr(resilience_service, "GEMINI_HEDGE_PERCENTILE", 0)
+    return fresh
+
+
+def _failing(error, calls):
+    def attempt(model_name, timeout):
+        calls.append(model_name)
+        raise error
+    return attempt
+
+
+def test_breaker_opens_and_falls_back(registry, monkeypatch):
+    monkeypatch.setattr(resilience_service, "GEMINI_BREAKER_FAILURES", 2)
+    monkeypatch.setattr(resilience_service, "GEMINI_RETRIES", 0)
+    calls = []
+    for _ in range(2):
+        with pytest.raises(ServiceUnavailable):
+            call_with_resilience("gemini-2.5-pro", _failing(ServiceUnavailable("503"), calls))
+    assert registry.stats()["models"]["gemini-2.5-pro"]["circuit"] == "open"
+
+    used, response = call_with_resilience("gemini-2.5-pro", lambda model_name, timeout: model_name)
+    assert (used, response) == ("gemini-2.5-flash", "gemini-2.5-flash")
+    assert registry.stats()["fallbacks"] == 1
+
+
+def test_breaker_without_fallback_short_circuits(registry, monkeypatch):
+    monkeypatch.setattr(resilience_service, "GEMINI_FALLBACKS", {})
+    monkeypatch.setattr(resilience_service, "GEMINI_BREAKER_FAILURES", 1)
+    registry.failure("gemini-2.5-pro")
+    calls = []
+    with pytest.raises(UpstreamUnavailable):
+        call_with_resilience("gemini-2.5-pro", _failing(AssertionError("no debe llamarse"), calls))
+    assert calls == []
+
+
+def test_half_open_allows_one_probe_and_success_closes(registry, monkeypatch):
+    monkeypatch.setattr(resilience_service, "GEMINI_BREAKER_FAILURES", 1)
+    monkeypatch.setattr(resilience_service, "GEMINI_BREAKER_COOLDOWN", 60)
+    registry.failure("gemini-2.5-pro")
+    assert not registry.allow("gemini-2.5-pro")
+
+    # Pasado el enfriamiento solo entra una llamada de prueba
+    monkeypatch.setattr(resilience_service, "GEMINI_BREAKER_COOLDOWN", 0)
+    assert registry.allow("gemini-2.5-pro")
+    assert not registry.allow("gemini-2.5-pro")
+
+    registry.success("gemini-2.5-pro", 0.1)
+    assert registry.stats()["models"]["gemini-2.5-pro"]["circuit"] == "closed"
+    assert registry.allow("gemini-2.5-pro") and registry.allow("gemini-2.5-pro")
+
+
+def test_failed_probe_reopens(registry, monkeypatch):
+    monkeypatch.setattr(resilience_service, "GEMINI_BREAKER_FAILURES", 5)
+    for _ in range(5):
+        registry.failure("gemini-2.5-pro")
+    monkeypatch.setattr(resilience_service, "GEMINI_BREAKER_COOLDOWN", 0)
+    assert registry.allow("gemini-2.5-pro")
+
+    # Un solo fallo de la prueba reabre el circuito, aunque no llegue al umbral
+    monkeypatch.setattr(resilience_service, "GEMINI_BREAKER_COOLDOWN", 60)
+    registry.failure("gemini-2.5-pro")
+    assert registry.stats()["models"]["gemini-2.5-pro"]["circuit"] == "open"
+
+
+def test_backoff_is_capped(monkeypatch):
+    monkeypatch.setattr(resilience_service, "GEMINI_RETRY_BASE_SECONDS", 1)
+    monkeypatch.setattr(resilience_service, "GEMINI_RETRY_MAX_SECONDS", 2)
+    assert all(0 <= resilience_service._backoff(10) <= 2 for _ in range(100))
+
+
+def test_retries_stop_at_the_deadline(registry, monkeypatch):
+    monkeypatch.setattr(resilience_service, "GEMINI_RETRIES", 50)
+    monkeypatch.setattr(resilience_service, "GEMINI_CALL_DEADLINE", 0.25)
+    monkeypatch.setattr(resilience_service, "GEMINI_BREAKER_FAILURES", 100)
+    monkeypatch.setattr(resilience_service, "_backoff", lambda retry: 0.1)
+    calls = []
+    started = time.monotonic()
+    with pytest.raises(ServiceUnavailable):
+        call_with_resilience("gemini-2.5-pro", _failing(ServiceUnavailable("503"), calls))
+    # No se duerme un backoff que terminaría después del plazo (margen para el planificador del SO)
+    assert time.monotonic() - started < 0.25 + 0.1
+    assert 1 <= len(calls) <= 3
+
+
+def test_only_retryable_errors_are_retried(registry, monkeypatch):
+    monkeypatch.setattr(resilience_service, "GEMINI_RETRIES", 2)
+    monkeypatch.setattr(resilience_service, "GEMINI_BREAKER_FAILURES", 100)
+
+    calls = []
+    with pytest.raises(ServiceUnavailable):
+        call_with_resilience("gemini-2.5-pro", _failing(ServiceUnavailable("503"), calls))
+    assert len(calls) == 3
+    assert registry.stats()["retries"] == 2
+
+    calls = []
+    with pytest.raises(InvalidArgument):
+        call_with_resilience("gemini-2.5-flash", _failing(InvalidArgument("prompt inválido"), calls))
+    assert len(calls) == 1
+    # Un error del cliente no cuenta contra la salud del modelo
+    assert registry.stats()["models"]["gemini-2.5-flash"]["consecutive_failures"] == 0
+
+
+def test_async_only_retryable_errors_are_retried(registry, monkeypatch):
+    monkeypatch.setattr(resilience_service, "GEMINI_RETRIES", 2)
+    calls = []
+
+    async def attempt(model_name, timeout):
+        calls.append(model_name)
+        raise InvalidArgument("prompt inválido")
+
+    with pytest.raises(InvalidArgument):
+        asyncio.run(call_with_resilience_async("gemini-2.5-pro", attempt))
+    assert len(calls) == 1
+
+
+def _enable_hedging(registry, monkeypatch, latency):
+    monkeypatch.setattr(resilience_service, "GEMINI_HEDGE_PERCENTILE", 0.5)
+    monkeypatch.setattr(resilience_service, "GEMINI_HEDGE_MIN_SAMPLES", 1)
+    registry.success("gemini-2.5-pro", latency)
+
+
+def test_async_hedge_winner_cancels_loser(registry, monkeypatch):
+    _enable_hedging(registry, monkeypatch, 0.02)
+    started = []
+    cancelled = []
+
+    async def attempt(model_name, timeout):
+        index = len(started)
+        started.append(index)
+        try:
+            # El primer intento se queda colgado; el duplicado responde enseguida
+            await asyncio.sleep(10 if index == 0 else 0.01)
+        except asyncio.CancelledError:
+            cancelled.append(index)
+            raise
+        return f"intento {index}"
+
+    used, response = asyncio.run(call_with_resilience_async("gemini-2.5-pro", attempt))
+    assert (used, response) == ("gemini-2.5-pro", "intento 1")
+    assert cancelled == [0]
+    stats = registry.stats()
+    assert stats["hedges"] == 1 and stats["hedge_wins"] == 1
+
+
+def test_sync_hedge_returns_first_success(registry, monkeypatch):
+    _enable_hedging(registry, monkeypatch, 0.02)
+    release = threading.Event()
+    started = []
+
+    def attempt(model_name, timeout):
+        index = len(started)
+        started.append(index)
+        if index == 0:
+            release.wait(5)
+        return f"intento {index}"
+
+    try:
+        used, response = call_with_resilience("gemini-2.5-pro", attempt)
+    finally:
+        release.set()
+    assert (used, response) == ("gemini-2.5-pro", "intento 1")
+    assert registry.stats()["hedge_wins"] == 1
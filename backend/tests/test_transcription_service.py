@@ -0,0 +1,87 @@
+import io
+import math
+import struct
+import wave
+
+from transcription_service import TranscriptAssembler, plan_segments, segment_wav_bytes, stitch, wav_duration
+
+
+def test_stitch_removes_overlap_ignoring_case_and_punctuation():
+    assert stitch("el modelo detecta sesgos en las imágenes", "En las imágenes, de entrenamiento") == "de entrenamiento"
+
+
+def test_stitch_with_clipped_boundary_word():
+    # El final de `previous` corta "entrenamiento" a medias; `following` la repite entera
+    previous = "los datos sirven para el entrena"
+    following = "sirven para el entrenamiento del modelo"
+    assert stitch(previous, following) == "entrenamiento del modelo"
+
+
+def test_stitch_with_clipped_first_word_of_following():
+    previous = "la calidad general es buena"
+    following = "dad general es buena pero hay ruido"
+    assert stitch(previous, following) == "pero hay ruido"
+
+
+def test_stitch_without_overlap_keeps_text():
+    assert stitch("primera parte del audio", "segunda parte distinta") == "segunda parte distinta"
+
+
+def test_stitch_single_shared_word_is_not_an_overlap():
+    assert stitch("termina con datos", "datos nuevos aquí") == "datos nuevos aquí"
+
+
+def test_assembler_out_of_order_segments():
+    assembler = TranscriptAssembler(3)
+    assert assembler.add(2, "cinco seis siete ocho") == ""
+    assert assembler.add(1, "tres cuatro cinco seis") == ""
+    assert assembler.add(0, "uno dos tres cuatro") == "uno dos tres cuatro cinco seis siete ocho"
+    assert assembler.transcript == "uno dos tres cuatro cinco seis siete ocho"
+
+
+def test_assembler_emits_contiguous_prefix_only():
+    assembler = TranscriptAssembler(3)
+    assert assembler.add(0, "hola a todos") == "hola a todos"
+    assert assembler.add(2, "fin del audio") == ""
+    assert assembler.add(1, "a todos y bienvenidos") == "y bienvenidos fin del audio"
+    assert assembler.transcript == "hola a todos y bienvenidos fin del audio"
+
+
+def test_assembler_skips_empty_segments():
+    assembler = TranscriptAssembler(2)
+    assert assembler.add(0, "") == ""
+    assert assembler.add(1, "solo este") == "solo este"
+    assert assembler.transcript == "solo este"
+
+
+def _wav(seconds, rate=8000):
+    """Tono de 0.8 s y silencio de 0.2 s en cada segundo."""
+    frames = bytearray()
+    for i in range(int(seconds * rate)):
+        t = (i % rate) / rate
+        frames += struct.pack("<h", int(8000 * math.sin(2 * math.pi * 440 * i / rate)) if t < 0.8 else 0)
+    out = io.BytesIO()
+    with wave.open(out, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(bytes(frames))
+    return out.getvalue()
+
+
+def test_plan_segments_overlap_and_cut_in_silence():
+    rate = 8000
+    audio = _wav(25, rate)
+    segments = plan_segments(audio, segment_seconds=10, overlap_seconds=1, search_seconds=3)
+    assert segments[0].start == 0
+    assert segments[-1].end == 25 * rate
+    for previous, following in zip(segments, segments[1:]):
+        # Cada corte cae en silencio (últimos 0.2 s de un segundo) y el siguiente solapa 1 s
+        assert (previous.end % rate) / rate >= 0.8
+        assert following.start == previous.end - rate
+    assert wav_duration(segment_wav_bytes(audio, segments[1])) == (segments[1].end - segments[1].start) / rate
+
+
+def test_plan_segments_short_audio_is_one_segment():
+    segments = plan_segments(_wav(3), segment_seconds=10)
+    assert [(s.start, s.end) for s in segments] == [(0, 3 * 8000)]
@@ -0,0 +1,222 @@
+import array
+import asyncio
+import io
+import os
+import re
+import sys
+import wave
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from gemini_service import transcribe_audio_with_gemini_async
+from spool_service import FileData, open_data
+
+# ==================== CONFIGURACIÓN ====================
+
+# Audios WAV más largos que esto se transcriben por segmentos (modo audio largo)
+TRANSCRIBE_LONG_AUDIO_SECONDS = float(os.getenv("TRANSCRIBE_LONG_AUDIO_SECONDS", "120"))
+TRANSCRIBE_SEGMENT_SECONDS = float(os.getenv("TRANSCRIBE_SEGMENT_SECONDS", "60"))
+# Solapamiento entre segmentos: una palabra cortada en un borde sale entera en el otro
+TRANSCRIBE_OVERLAP_SECONDS = float(os.getenv("TRANSCRIBE_OVERLAP_SECONDS", "2"))
+# Los cortes se mueven al tramo más silencioso de los últimos N segundos del segmento
+TRANSCRIBE_SILENCE_SEARCH_SECONDS = float(os.getenv("TRANSCRIBE_SILENCE_SEARCH_SECONDS", "5"))
+# Segmentos transcribiéndose a la vez por petición
+TRANSCRIBE_CONCURRENCY = int(os.getenv("TRANSCRIBE_CONCURRENCY", "4"))
+
+# Ventana con la que se mide la energía al buscar silencios
+_ENERGY_WINDOW_SECONDS = 0.02
+# Palabras del final/inicio de dos segmentos que se comparan al unirlos
+_STITCH_MAX_WORDS = 40
+
+WAV_MIME_TYPES = {"audio/wav", "audio/x-wav", "audio/wave", "audio/vnd.wave"}
+
+# ==================== SEGMENTACIÓN DE WAV ====================
+
+class AudioSegment:
+    """Tramo [start, end) de un WAV, en frames."""
+
+    def __init__(self, index: int, start: int, end: int, frame_rate: int):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.frame_rate = frame_rate
+
+    def describe(self) -> Dict[str, float]:
+        return {
+            "index": self.index,
+            "start_s": round(self.start / self.frame_rate, 2),
+            "end_s": round(self.end / self.frame_rate, 2)
+        }
+
+def is_wav(mime_type: Optional[str], filename: Optional[str] = None) -> bool:
+    return (mime_type or "").lower() in WAV_MIME_TYPES or (filename or "").lower().endswith(".wav")
+
+def wav_duration(audio: FileData) -> Optional[float]:
+    """Duración en segundos si `audio` es un WAV PCM legible; None si no."""
+    try:
+        with open_data(audio) as f, wave.open(f, "rb") as wav:
+            return wav.getnframes() / wav.getframerate()
+    except (wave.Error, EOFError):
+        return None
+
+def _samples(frames: bytes, sample_width: int) -> array.array:
+    """Muestras como enteros con signo (los 16 bits altos), suficiente para medir energía."""
+    if sample_width == 1:
+        # PCM de 8 bits es sin signo
+        return array.array("h", (sample - 128 for sample in frames))
+    high = bytearray(len(frames) // sample_width * 2)
+    high[0::2] = frames[sample_width - 2::sample_width]
+    high[1::2] = frames[sample_width - 1::sample_width]
+    samples = array.array("h", bytes(high))
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return samples
+
+def _quietest_frame(wav: wave.Wave_read, start: int, end: int) -> int:
+    """Centro de la ventana de menor energía entre los frames `start` y `end`."""
+    window = max(1, int(wav.getframerate() * _ENERGY_WINDOW_SECONDS))
+    channels = wav.getnchannels()
+    wav.setpos(start)
+    samples = _samples(wav.readframes(end - start), wav.getsampwidth())
+    step = window * channels
+    best_frame, best_energy = end, None
+    for offset in range(0, len(samples) - step + 1, step):
+        energy = sum(sample * sample for sample in samples[offset:offset + step])
+        # Ante empates gana la ventana más tardía (segmentos lo más largos posible)
+        if best_energy is None or energy <= best_energy:
+            best_energy = energy
+            best_frame = start + offset // channels + window // 2
+    return best_frame
+
+def plan_segments(
+    audio: FileData,
+    segment_seconds: float = TRANSCRIBE_SEGMENT_SECONDS,
+    overlap_seconds: float = TRANSCRIBE_OVERLAP_SECONDS,
+    search_seconds: float = TRANSCRIBE_SILENCE_SEARCH_SECONDS
+) -> List[AudioSegment]:
+    """
+    Divide un WAV en segmentos de hasta `segment_seconds` que se solapan
+    `overlap_seconds`. Cada corte se hace en el tramo más silencioso de los
+    últimos `search_seconds` del segmento, para no partir palabras.
+    """
+    with open_data(audio) as f, wave.open(f, "rb") as wav:
+        rate = wav.getframerate()
+        total = wav.getnframes()
+        length = max(1, int(segment_seconds * rate))
+        overlap = min(int(overlap_seconds * rate), length // 2)
+        search = min(int(search_seconds * rate), length // 2)
+
+        segments: List[AudioSegment] = []
+        start = 0
+        while True:
+            end = start + length
+            if end >= total:
+                segments.append(AudioSegment(len(segments), start, total, rate))
+                return segments
+            end = _quietest_frame(wav, end - search, end) if search else end
+            segments.append(AudioSegment(len(segments), start, end, rate))
+            start = max(end - overlap, start + 1)
+
+def segment_wav_bytes(audio: FileData, segment: AudioSegment) -> bytes:
+    """WAV independiente con los frames del segmento (mismo formato que el original)."""
+    with open_data(audio) as f, wave.open(f, "rb") as source:
+        source.setpos(segment.start)
+        frames = source.readframes(segment.end - segment.start)
+        params = source.getparams()
+    out = io.BytesIO()
+    with wave.open(out, "wb") as target:
+        target.setparams(params)
+        target.writeframes(frames)
+    return out.getvalue()
+
+# ==================== UNIÓN DE SEGMENTOS ====================
+
+def _normalize(word: str) -> str:
+    return re.sub(r"[^\w]", "", word.lower())
+
+def stitch(previous: str, following: str, max_words: int = _STITCH_MAX_WORDS) -> str:
+    """
+    Parte de `following` que no repite el final de `previous`.
+
+    Como los segmentos se solapan, el inicio de un texto suele repetir las
+    últimas palabras del anterior (a veces con la primera palabra cortada):
+    se busca el solapamiento más largo entre el final de uno y el inicio del
+    otro, ignorando mayúsculas y puntuación.
+    """
+    tail = [_normalize(word) for word in previous.split()[-max_words:]]
+    words = following.split()
+    head = [_normalize(word) for word in words[:max_words]]
+    for size in range(min(len(tail), len(head)), 1, -1):
+        # `drop`: última palabra de `previous` cortada; `skip`: primeras de `following` cortadas
+        for drop in range(2):
+            for skip in range(3):
+                if drop + skip > 1 and size < 3:
+                    continue
+                end = len(tail) - drop
+                if size <= end and tail[end - size:end] == head[skip:skip + size]:
+                    return " ".join(words[skip + size:])
+    return following
+
+# ==================== TRANSCRIPCIÓN POR SEGMENTOS ====================
+
+async def iter_segment_transcripts(
+    audio: FileData,
+    segments: List[AudioSegment],
+    use_cache: bool = True,
+    concurrency: int = TRANSCRIBE_CONCURRENCY
+) -> AsyncIterator[Tuple[AudioSegment, str]]:
+    """
+    Transcribe los segmentos en paralelo (como mucho `concurrency` a la vez) y
+    produce (segmento, texto) en orden de finalización. Si un segmento falla,
+    se cancelan los demás y se propaga el error.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def transcribe(segment: AudioSegment) -> Tuple[AudioSegment, str]:
+        async with semaphore:
+            data = await asyncio.to_thread(segment_wav_bytes, audio, segment)
+            return segment, await transcribe_audio_with_gemini_async(data, "audio/wav", use_cache=use_cache)
+
+    tasks = [asyncio.create_task(transcribe(segment)) for segment in segments]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+class TranscriptAssembler:
+    """
+    Junta los textos de segmentos que llegan en desorden: cada vez que se completa
+    un prefijo contiguo, devuelve el texto nuevo (ya sin el solapamiento).
+    """
+
+    def __init__(self, total: int):
+        self.texts: List[Optional[str]] = [None] * total
+        self.ready = 0
+        self.transcript = ""
+
+    def add(self, index: int, text: str) -> str:
+        self.texts[index] = text
+        added = []
+        while self.ready < len(self.texts) and self.texts[self.ready] is not None:
+            text = self.texts[self.ready]
+            addition = stitch(self.transcript, text) if self.transcript else text
+            if addition:
+                added.append(addition)
+                self.transcript = f"{self.transcript} {addition}".strip()
+            self.ready += 1
+        return " ".join(added)
+
+if __name__ == "__main__":
+    # Segmentación de un WAV local:  python transcription_service.py audio.wav [segundos]
+    import pathlib
+    import time
+
+    path = pathlib.Path(sys.argv[1])
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else TRANSCRIBE_SEGMENT_SECONDS
+    started = time.perf_counter()
+    planned = plan_segments(path, seconds)
+    elapsed = time.perf_counter() - started
+    for planned_segment in planned:
+        print(planned_segment.describe())
+    print(f"{len(planned)} segmentos de {wav_duration(path):.1f}s en {elapsed * 1000:.0f} ms")
@@ -1,53 +1,365 @@
-import requests
+import asyncio
 import os
+import re
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+
+import httpx
 from dotenv import load_dotenv
 
+from cache_service import make_cache_key
+
 load_dotenv()
 
 # Voz: Rachel
-VOICE_ID = "21m00Tcm4TlvDq8ikWAM" 
+VOICE_ID = "21m00Tcm4TlvDq8ikWAM"
+TTS_MODEL_ID = "eleven_multilingual_v2" # Intenta usar v2 para español
+VOICE_SETTINGS = {
+    "stability": 0.5,
+    "similarity_boost": 0.5
+}
+
+# ==================== CONFIGURACIÓN ====================
+
+# Se puede apuntar a un servidor local (python tts_service.py stub)
+ELEVENLABS_API_URL = os.getenv("ELEVENLABS_API_URL", "https://api.elevenlabs.io")
+# Tamaño de los bloques reenviados al cliente
+TTS_CHUNK_BYTES = int(os.getenv("TTS_CHUNK_BYTES", str(16 * 1024)))
+TTS_CONNECT_TIMEOUT = float(os.getenv("TTS_CONNECT_TIMEOUT", "5"))
+# Espera máxima entre dos bloques del audio (no la duración total)
+TTS_READ_TIMEOUT = float(os.getenv("TTS_READ_TIMEOUT", "30"))
+# Conexiones a ElevenLabs por worker (streams simultáneos) y cuántas quedan abiertas en reposo
+TTS_MAX_CONNECTIONS = int(os.getenv("TTS_MAX_CONNECTIONS", "32"))
+TTS_KEEPALIVE_CONNECTIONS = int(os.getenv("TTS_KEEPALIVE_CONNECTIONS", "8"))
+
+# Modo por frases: textos desde este largo se sintetizan por segmentos en paralelo
+TTS_PIPELINE_MIN_CHARS = int(os.getenv("TTS_PIPELINE_MIN_CHARS", "300"))
+TTS_SEGMENT_MAX_CHARS = int(os.getenv("TTS_SEGMENT_MAX_CHARS", "250"))
+# Segmentos sintetizándose a la vez (el que suena y los siguientes)
+TTS_PIPELINE_AHEAD = int(os.getenv("TTS_PIPELINE_AHEAD", "3"))
+
+# Estados de ElevenLabs que se devuelven tal cual; el resto es un 502
+_FORWARDED_STATUS = {400: 400, 422: 400, 429: 429}
+
+class TTSError(Exception):
+    """ElevenLabs no pudo generar el audio; `status_code` es el que debe ver el cliente."""
+
+    def __init__(self, message: str, status_code: int = 502):
+        super().__init__(message)
+        self.status_code = status_code
+
+def speech_cache_key(text):
+    """Clave del audio en caché: cambia si cambia el texto, la voz, el modelo o sus ajustes."""
+    return make_cache_key("tts", text, VOICE_ID, TTS_MODEL_ID, VOICE_SETTINGS)
+
+# ==================== CLIENTE HTTP COMPARTIDO ====================
+
+_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def _get_client() -> httpx.AsyncClient:
+    """Cliente con pool de conexiones keep-alive, uno por event loop (uno por worker en uvicorn)."""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            base_url=ELEVENLABS_API_URL,
+            timeout=httpx.Timeout(TTS_READ_TIMEOUT, connect=TTS_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=TTS_MAX_CONNECTIONS,
+                max_keepalive_connections=TTS_KEEPALIVE_CONNECTIONS
+            )
+        )
+        _client_loop = loop
+    return _client
+
+async def close_tts_client() -> None:
+    global _client, _client_loop
+    if _client is not None:
+        await _client.aclose()
+    _client = None
+    _client_loop = None
 
-def text_to_speech_stream(text):
+# ==================== STREAM DE AUDIO ====================
+
+async def open_speech_stream(text: str, chunk_size: int = TTS_CHUNK_BYTES) -> AsyncIterator[bytes]:
+    """
+    Pide el audio de `text` a ElevenLabs y devuelve un iterador de bloques MP3.
+
+    Espera solo hasta recibir los encabezados: si ElevenLabs responde con error
+    (o falta la clave) lanza `TTSError` antes de empezar a enviar nada, así que
+    el endpoint puede responder con el estado correcto.
+    """
     api_key = os.getenv("ELEVENLABS_API_KEY")
-    
-    # 1. Chequeo de seguridad: ¿Existe la clave?
     if not api_key:
-        print(" ERROR: No se encontró ELEVENLABS_API_KEY en el archivo .env")
-        yield b""
-        return
-
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{VOICE_ID}"
-
-    headers = {
-        "Accept": "audio/mpeg",
-        "Content-Type": "application/json",
-        "xi-api-key": api_key
-    }
-
-    data = {
-        "text": text,
-        "model_id": "eleven_multilingual_v2", # Intenta usar v2 para español
-        "voice_settings": {
-            "stability": 0.5,
-            "similarity_boost": 0.5
-        }
-    }
-
-    print(f"📡 Enviando petición a ElevenLabs... (Key termina en: ...{api_key[-4:]})")
-    
-    # Hacemos la petición
-    response = requests.post(url, json=data, headers=headers, stream=True)
-
-    # 2. Si falla, imprimimos el mensaje EXACTO de ElevenLabs
+        raise TTSError("No se encontró ELEVENLABS_API_KEY en el archivo .env", status_code=503)
+
+    request = _get_client().build_request(
+        "POST",
+        f"/v1/text-to-speech/{VOICE_ID}/stream",
+        headers={"Accept": "audio/mpeg", "xi-api-key": api_key},
+        json={"text": text, "model_id": TTS_MODEL_ID, "voice_settings": VOICE_SETTINGS}
+    )
+    try:
+        response = await _get_client().send(request, stream=True)
+    except httpx.TimeoutException as e:
+        raise TTSError(f"ElevenLabs no respondió a tiempo: {e!r}", status_code=504) from e
+    except httpx.HTTPError as e:
+        raise TTSError(f"No se pudo conectar con ElevenLabs: {e!r}") from e
+
     if response.status_code != 200:
-        print(f" ERROR CRÍTICO ELEVENLABS ({response.status_code}):")
-        print(response.text) # <--- ESTO NOS DIRÁ EL PROBLEMA REAL
-        yield b""
-        return
-
-    print("✅ Audio recibido correctamente, iniciando stream...")
-    
-    # Devolvemos el audio
-    for chunk in response.iter_content(chunk_size=1024):
-        if chunk:
-            yield chunk
\ No newline at end of file
+        detail = (await response.aread()).decode("utf-8", "replace")
+        await response.aclose()
+        raise TTSError(
+            f"ElevenLabs respondió {response.status_code}: {detail}",
+            status_code=_FORWARDED_STATUS.get(response.status_code, 502)
+        )
+
+    async def chunks() -> AsyncIterator[bytes]:
+        try:
+            async for chunk in response.aiter_bytes(chunk_size):
+                yield chunk
+        finally:
+            # Devuelve la conexión al pool aunque el cliente se desconecte a mitad
+            await response.aclose()
+
+    return chunks()
+
+async def text_to_speech_stream(text: str, chunk_size: int = TTS_CHUNK_BYTES) -> AsyncIterator[bytes]:
+    """Bloques MP3 de `text`; los errores de ElevenLabs se propagan como `TTSError`."""
+    async for chunk in await open_speech_stream(text, chunk_size):
+        yield chunk
+
+# ==================== MODO POR FRASES ====================
+
+_SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+_CLAUSE_END = re.compile(r"(?<=[,;:])\s+")
+
+def _pack(pieces: List[str], max_chars: int) -> List[str]:
+    """Une piezas consecutivas mientras quepan en `max_chars`; corta por palabras las que no caben."""
+    segments: List[str] = []
+    for piece in pieces:
+        while len(piece) > max_chars:
+            cut = piece.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            segments.append(piece[:cut].strip())
+            piece = piece[cut:].strip()
+        if segments and len(segments[-1]) + 1 + len(piece) <= max_chars:
+            segments[-1] = f"{segments[-1]} {piece}"
+        elif piece:
+            segments.append(piece)
+    return segments
+
+def split_speech_segments(text: str, max_chars: int = TTS_SEGMENT_MAX_CHARS) -> List[str]:
+    """
+    Divide `text` en frases; las que superan `max_chars` se dividen por comas
+    (o por palabras). Cada frase es un segmento propio, así que una frase que se
+    repite entre textos tiene siempre la misma clave de caché.
+    """
+    segments: List[str] = []
+    for sentence in _SENTENCE_END.split(text.strip()):
+        if len(sentence) <= max_chars:
+            segments.append(sentence)
+        else:
+            segments += _pack(_CLAUSE_END.split(sentence), max_chars)
+    return [segment for segment in segments if segment]
+
+async def open_pipelined_stream(
+    segments: List[str],
+    open_segment: Callable[[str], Awaitable[AsyncIterator[bytes]]] = open_speech_stream,
+    ahead: int = TTS_PIPELINE_AHEAD
+) -> AsyncIterator[bytes]:
+    """
+    Audio de varios segmentos, en orden, sintetizando hasta `ahead` a la vez.
+
+    El primer segmento se reenvía a medida que llega y los siguientes se van
+    acumulando mientras tanto, así que el primer audio tarda lo mismo que un
+    texto corto sin importar el largo total. Igual que `open_speech_stream`,
+    espera el primer bloque y lanza `TTSError` si el primer segmento falla.
+    """
+    queues: List[asyncio.Queue] = [asyncio.Queue() for _ in segments]
+    tasks: List[asyncio.Task] = []
+
+    async def produce(segment: str, queue: asyncio.Queue) -> None:
+        try:
+            stream = await open_segment(segment)
+            try:
+                async for chunk in stream:
+                    queue.put_nowait(chunk)
+            finally:
+                await stream.aclose()
+        except Exception as e:
+            queue.put_nowait(e)
+        else:
+            queue.put_nowait(None)
+
+    def start_until(count: int) -> None:
+        while len(tasks) < min(count, len(segments)):
+            index = len(tasks)
+            tasks.append(asyncio.create_task(produce(segments[index], queues[index])))
+
+    def cancel() -> None:
+        for task in tasks:
+            task.cancel()
+
+    start_until(max(1, ahead))
+    first = await queues[0].get()
+    if isinstance(first, Exception):
+        cancel()
+        raise first
+
+    async def chunks() -> AsyncIterator[bytes]:
+        try:
+            item = first
+            for index, queue in enumerate(queues):
+                start_until(index + max(1, ahead))
+                if index:
+                    item = await queue.get()
+                while item is not None:
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+                    item = await queue.get()
+        finally:
+            cancel()
+
+    return chunks()
+
+# ==================== SERVIDOR DE PRUEBA ====================
+
+def create_stub_app(
+    first_byte_ms: float = 150,
+    audio_bytes: int = 256 * 1024,
+    chunk_bytes: int = 4096,
+    chunk_ms: float = 1,
+    char_ms: float = 0
+):
+    """
+    Imita el endpoint de streaming de ElevenLabs sin llamar a la API real:
+    espera `first_byte_ms` (+ `char_ms` por carácter del texto), luego envía
+    `audio_bytes` en bloques. Un texto que empieza por "error:NNN" responde
+    con ese estado.
+    """
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+
+    stub = FastAPI()
+
+    @stub.post("/v1/text-to-speech/{voice_id}/stream")
+    async def synthesize(voice_id: str, request: Request):
+        text = (await request.json()).get("text", "")
+        if text.startswith("error:"):
+            status = int(text.split(":", 1)[1][:3])
+            return JSONResponse(status_code=status, content={"detail": {"status": "stub_error"}})
+
+        async def audio() -> AsyncIterator[bytes]:
+            await asyncio.sleep((first_byte_ms + char_ms * len(text)) / 1000)
+            block = (text.encode("utf-8") or b"\0") * (chunk_bytes // max(1, len(text.encode("utf-8"))) + 1)
+            sent = 0
+            while sent < audio_bytes:
+                size = min(chunk_bytes, audio_bytes - sent)
+                yield block[:size]
+                sent += size
+                await asyncio.sleep(chunk_ms / 1000)
+
+        return StreamingResponse(audio(), media_type="audio/mpeg")
+
+    return stub
+
+if __name__ == "__main__":
+    #   python tts_service.py stub [puerto]                  -> servidor falso de ElevenLabs
+    #   python tts_service.py benchmark [streams] [rondas]   -> TTFB y streams simultáneos
+    #   python tts_service.py pipeline                       -> primer audio según el largo del texto
+    import statistics
+    import sys
+    import threading
+    import time
+
+    import uvicorn
+
+    mode = sys.argv[1] if len(sys.argv) > 1 else "benchmark"
+    if mode == "stub":
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 8765
+        uvicorn.run(create_stub_app(), host="127.0.0.1", port=port, log_level="warning")
+        sys.exit(0)
+
+    streams = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    os.environ.setdefault("ELEVENLABS_API_KEY", "stub")
+    ELEVENLABS_API_URL = "http://127.0.0.1:8765"
+    # En modo pipeline el stub tarda más en empezar cuanto más largo es el texto
+    stub_app = create_stub_app(char_ms=2, audio_bytes=32 * 1024) if mode == "pipeline" else create_stub_app()
+    server = uvicorn.Server(uvicorn.Config(stub_app, host="127.0.0.1", port=8765, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    async def one_stream(index: int, pooled: bool = True):
+        started = time.perf_counter()
+        first_byte = None
+        size = 0
+        if pooled:
+            chunks = text_to_speech_stream(f"texto {index}")
+        else:
+            chunks = unpooled_stream(f"texto {index}")
+        async for chunk in chunks:
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            size += len(chunk)
+        return first_byte, time.perf_counter() - started, size
+
+    async def unpooled_stream(text: str):
+        # Como antes: conexión nueva por petición y bloques de 1 KB
+        async with httpx.AsyncClient(base_url=ELEVENLABS_API_URL) as client:
+            async with client.stream(
+                "POST", f"/v1/text-to-speech/{VOICE_ID}/stream",
+                json={"text": text, "model_id": TTS_MODEL_ID}
+            ) as response:
+                async for chunk in response.aiter_bytes(1024):
+                    yield chunk
+
+    async def run(pooled: bool):
+        results = []
+        for _ in range(rounds):
+            results += await asyncio.gather(*(one_stream(index, pooled) for index in range(streams)))
+        return results
+
+    async def main():
+        # Calentamiento: abre las conexiones del pool
+        await asyncio.gather(*(one_stream(index) for index in range(streams)))
+        for label, pooled in (("sin pool", False), ("pool keep-alive", True)):
+            started = time.perf_counter()
+            results = await run(pooled)
+            elapsed = time.perf_counter() - started
+            ttfb = sorted(r[0] * 1000 for r in results)
+            print(f"{label:>16}: {streams} streams x {rounds} rondas en {elapsed:.2f}s; "
+                  f"TTFB p50 {statistics.median(ttfb):.1f} ms, p95 {ttfb[int(len(ttfb) * 0.95) - 1]:.1f} ms; "
+                  f"{sum(r[2] for r in results) / elapsed / 1e6:.1f} MB/s")
+        await close_tts_client()
+
+    async def time_to_first_audio(stream: AsyncIterator[bytes]):
+        started = time.perf_counter()
+        first_audio = None
+        async for _ in stream:
+            if first_audio is None:
+                first_audio = time.perf_counter() - started
+        return first_audio * 1000, (time.perf_counter() - started) * 1000
+
+    async def pipeline():
+        sentence = "El conjunto de datos tiene una calidad aceptable, aunque conviene revisar los valores nulos. "
+        await time_to_first_audio(text_to_speech_stream("hola"))  # abre la conexión
+        print(f"{'caracteres':>10} {'segmentos':>9} {'único (1er audio / total)':>28} {'por frases':>22}")
+        for sentences in (1, 4, 16, 32):
+            text = sentence * sentences
+            segments = split_speech_segments(text)
+            single = await time_to_first_audio(text_to_speech_stream(text))
+
+            async def pipelined():
+                async for chunk in await open_pipelined_stream(segments):
+                    yield chunk
+
+            piped = await time_to_first_audio(pipelined())
+            print(f"{len(text):>10} {len(segments):>9} {single[0]:>12.0f} / {single[1]:>6.0f} ms {piped[0]:>10.0f} / {piped[1]:>6.0f} ms")
+        await close_tts_client()
+
+    asyncio.run(pipeline() if mode == "pipeline" else main())
+    server.should_exit = True
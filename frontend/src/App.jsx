@@ -45,22 +45,47 @@ function App() {
     if (!files) return alert("⚠️ Por favor selecciona archivos primero.");
 
     setLoading(true);
+    setResults([]);
     const formData = new FormData();
     formData.append("prompt", prompt);
+    // NDJSON: cada archivo llega en cuanto Gemini termina de analizarlo
+    formData.append("stream", "ndjson");
 
     for (let i = 0; i < files.length; i++) {
       formData.append("files", files[i]);
     }
 
     try {
-      const response = await axios.post(
+      const response = await fetch(
         "http://45.77.163.127:8000/analyze-batch",
-        formData,
-        {
-          headers: { "Content-Type": "multipart/form-data" },
-        }
+        { method: "POST", body: formData }
       );
-      setResults(response.data.results);
+      if (!response.ok || !response.body) {
+        throw new Error(`HTTP ${response.status}`);
+      }
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split("\n");
+        buffer = lines.pop();
+
+        for (const line of lines) {
+          if (!line.trim()) continue;
+          const record = JSON.parse(line);
+          if (record.type === "result") {
+            setResults((prev) => [...prev, record]);
+          }
+        }
+      }
+
+      // Al terminar, dejamos los resultados en el orden original de los archivos
+      setResults((prev) => [...prev].sort((a, b) => a.index - b.index));
     } catch (error) {
       console.error(error);
       alert(